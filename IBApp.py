@@ -1,22 +1,41 @@
 import logging
 import os
-import datetime as dt
 import time
+import datetime as dt
 import threading
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
 from collections import OrderedDict
-from random import randint
 from abc import ABC, abstractmethod
 from collections import defaultdict
 
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 from ibapi.contract import Contract
-from IBUtils import get_req_id, get_opt_arr_from_line, get_arr_from_line, Config
-from Utils import get_closest_expiry, take_closest
+from ibapi.ticktype import TickTypeEnum
+from IBUtils import get_req_id, is_weekly_options, get_bar_time, Config
+from IBPacing import PacingScheduler
+from IBWriter import BarWriter, parse_bar_times, OPT_BAR_DTYPE, BAR_DTYPE
+from IBFormat import write_header, finalize, prepare_append, get_file_dtype, SIDE_CODES
+from IBDecoder import BatchDecoder, to_bar_data
+from IBPlanner import BAR_SIZE_NAMES, BAR_SIZE, get_pacing_cost
+from IBCache import ContractCache, NoDataRegistry
+from IBJournal import RequestJournal
+from IBMetrics import Metrics, TimedQueue
+from IBShared import SharedBarPublisher, get_segment_name
+from IBConnection import ConnectionManager, CONNECTION_ERROR_CODES
+from IBRequests import RequestTracker, RequestState, TrackedRequest, is_retryable_error, NO_DATA_MESSAGE, INFORMATIVE_ERROR_CODES
+from IBExpiry import ExpiryCalendar
+from Utils import take_closest
 
 OPEN_SPOT_PRICE_REQ_ID = 1
 ALL_OPTION_CONTRACTS_DETAILS_REQ_ID = 2
+UNDERLINE_DETAILS_REQ_ID = 3
+LISTED_EXPIRIES_REQ_ID = 4
+RESPONSE_TIMEOUT = 120
+REAL_TIME_BAR_SIZE = 5  # the only size of real time bars IB supports
 SUPPORTED_SEC_TYPES = ['OPT', 'STK', 'FX']
+TXT_SIDES = {"ASK": "S", "BID": "B", "BID_ASK": "BA"}
 
 logging.getLogger("IBLog")
 logging.basicConfig(format='%(message)s')
@@ -27,82 +46,386 @@ class DataRequest:
     """
     DataRequest holds all the necessary information needed to send a new data request
     """
-    __slots__ = ['contract', 'query_time', 'interval_size', 'bid_or_ask', 'req_id']
+    __slots__ = ['contract', 'query_time', 'interval_size', 'bid_or_ask', 'req_id', 'day_job']
 
-    def __init__(self, contract: Contract, query_time: dt, interval_size: int, bid_or_ask: str):
+    def __init__(self, contract: Contract, query_time: dt, interval_size: int, bid_or_ask: str, day_job=None):
         """
         create new DataRequest object
         :param contract: contract of the request
         :param query_time: start time of the request
         :param interval_size: time span of the request (i.e. 30 minutes, 60 minutes, etc)
-        :param bid_or_ask: bid side or ask side request
+        :param bid_or_ask: bid side or ask side request, or BID_ASK for both
+        :param day_job: the DayJob the request belongs to, its bars are written to the output of that day
         """
         self.contract = contract
         self.query_time = query_time
         self.interval_size = interval_size
         self.bid_or_ask = bid_or_ask
         self.req_id = -1
+        self.day_job = day_job
+
+    def get_pacing_key(self) -> tuple:
+        """
+        Two requests with the same key are considered identical by IB pacing rules
+        """
+        contract = self.contract
+        return (contract.symbol, contract.secType, contract.lastTradeDateOrContractMonth, contract.strike, contract.right,
+                contract.currency, self.query_time, self.interval_size, self.bid_or_ask)
+
+    def get_pacing_cost(self) -> int:
+        """
+        :return: number of requests this request counts as for IB pacing
+        """
+        return get_pacing_cost(self.bid_or_ask)
 
 
 class OptionChainData:
     """
     When handling options data, we keep the entire options chain, with the contract for each specific option
     """
-    __slots__ = ['underline', 'open_spot_price', 'all_contracts', 'all_contracts_fetched']
+    __slots__ = ['underline', 'expiry', 'open_spot_price', 'all_contracts']
 
     def __init__(self, underline: str):
         """
         :param underline: the underline asset of the options
         """
         self.underline = underline
+        self.expiry = None
         self.open_spot_price = -1
         self.all_contracts = defaultdict(lambda: {})
-        self.all_contracts_fetched = False
 
     def __del__(self):
         self.all_contracts = {}
 
 
+class DayJob:
+    """
+    DayJob holds all the state of collecting a single asset on a single date: its option chain, output file, journal and
+    open requests. Several days may be in flight at the same time, responses are routed to their day through the
+    DataRequest they belong to.
+    """
+    def __init__(self, asset: str, date: dt, file_name: str):
+        """
+        :param asset: requested asset, as written in the config
+        :param date: requested date
+        :param file_name: path of the output file
+        """
+        self.asset = asset
+        self.base_asset, self.is_weekly = is_weekly_options(asset)
+        self.date = date
+        self.file_name = file_name
+        self.journal_path = f"{file_name}.journal"
+        self.is_resumed = os.path.exists(self.journal_path)  # a journal means a previous run of this day was interrupted
+        self.journal = None
+        self.option_chain_data = None
+        self.expiry = None  # expiry of the options of the day, None to find it when its chain is resolved
+        self.contracts_to_delete = defaultdict(lambda: [])
+        self.output_file = None
+        self.writer = None
+        self.publisher = None
+        self.open_requests = 0
+        self.failed = 0  # requests that were given up on, a day with any of them is not complete
+        self.all_requests_sent = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.start_time = None
+        self.metrics = None
+
+    def open_output(self, output_type: str, bar_dtype, sec_type: str, metrics: Metrics, shift_hours: int = 0,
+                    publisher: SharedBarPublisher = None):
+        """
+        Open the journal and the output file, and start the writer thread that writes to it.
+        Binary files start with a header describing their content, see IBFormat. Days that are resumed are appended to,
+        unless the file was written with a different layout of bars, then the day is collected again.
+        :param output_type: bin or txt
+        :param bar_dtype: dtype of the records of binary output
+        :param sec_type: OPT, STK or FX
+        :param metrics: metrics of the run, disk time is added to them
+        :param shift_hours: hours to subtract from the times of the bars
+        :param publisher: shared memory segment the bars are published to as they are written, None to skip it
+        """
+        self.start_time = dt.datetime.now()
+        self.metrics = metrics
+        append = self.is_resumed and os.path.exists(self.file_name)
+        if append and output_type == "bin" and get_file_dtype(self.file_name) != bar_dtype:
+            logging.getLogger("IBLog").warning(f"{self.file_name} was written with a different layout, collecting the day again")
+            os.remove(self.journal_path)
+            append = False
+        self.journal = RequestJournal(self.journal_path)
+        if append:
+            logging.getLogger("IBLog").info(f"Resuming {self.file_name}, {len(self.journal)} requests already completed")
+            self.output_file = open(self.file_name, f"{'a' if output_type == 'txt' else 'r+b'}")
+            if output_type == "bin":
+                prepare_append(self.output_file)
+        else:
+            self.output_file = open(self.file_name, f"{'w+' if output_type == 'txt' else 'wb+'}")
+        if output_type == "bin" and not append:
+            expiry = self.option_chain_data.expiry if self.option_chain_data is not None else None
+            write_header(self.output_file, bar_dtype, sec_type, self.base_asset, self.date, expiry)
+        self.publisher = publisher
+        self.writer = BarWriter(self.output_file, bar_dtype if output_type == "bin" else None, metrics=metrics,
+                                shift_hours=shift_hours, publisher=publisher)
+
+    def close_output(self, output_type: str, complete: bool = True):
+        """
+        Write all pending bars, fsync and close the output file. Binary files are then sorted and indexed, and the shared
+        memory segment of the day is removed.
+        :param complete: mark the day as complete in its journal. Otherwise the journal is kept, and the next run
+        resumes the day, even if it was marked as complete before
+        """
+        self.writer.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if output_type == "bin":
+            with self.metrics.timer("ib_disk_seconds_total", op="finalize"):
+                finalize(self.file_name)
+        if complete:
+            self.journal.record_day_complete()
+        elif self.journal.is_day_complete:
+            # requests that fill the gaps of a complete day were given up on
+            self.journal.record_day_incomplete()
+        self.journal.close()
+        logging.getLogger("IBLog").info(f"Process time of {self.asset} - {self.date.strftime('%Y%m%d')} - {divmod((dt.datetime.now() - self.start_time).total_seconds(), 60)}")
+        self.done.set()
+
+    def journal_request(self, data_request: DataRequest):
+        """
+        Record a request as completed, once all its bars were written to the output file
+        :param data_request: the completed request
+        """
+        self.writer.call_after_flush(lambda: self.journal.record(data_request))
+
+    def request_sent(self):
+        with self.lock:
+            self.open_requests += 1
+
+    def request_ended(self) -> bool:
+        """
+        :return: True if that was the last request of the day
+        """
+        with self.lock:
+            self.open_requests -= 1
+            return self.all_requests_sent and self.open_requests == 0
+
+    def request_failed(self) -> bool:
+        """
+        A request was given up on, it ended without its data
+        :return: True if that was the last request of the day
+        """
+        with self.lock:
+            self.failed += 1
+        return self.request_ended()
+
+    def all_sent(self) -> bool:
+        """
+        Mark that all the requests of the day were sent
+        :return: True if none of them is still open
+        """
+        with self.lock:
+            self.all_requests_sent = True
+            return self.open_requests == 0
+
+
 class IBapi(EWrapper, EClient, ABC):
     """
     Abstract class that handles all communication with TWS.
     """
+    bar_dtype = BAR_DTYPE
+
     def __init__(self, config: Config):
         EClient.__init__(self, self)
+        self.metrics = Metrics()
+        self.msg_queue = TimedQueue(self.metrics)  # times how long the messages of TWS take to decode
+        self.sec_type = type(self).__name__
         self.output_type = config.output_type
-        self.output_file = ""
         self.option_chain_data = None
-        self.contracts_to_delete = defaultdict(lambda: [])
-        self.req_id_to_contract = {}
-        self.open_requests = 0
-        self.sent_time_queue = []
+        self.requests = RequestTracker(self.request_timed_out, self.send_tracked_request, config.request_timeout, config.max_attempts)
+        self.ignored_req_ids = set()
+        self.day_closer = ThreadPoolExecutor(max_workers=1)
+        self.pacing = PacingScheduler()
+        self.pending_responses = {}
+        self.contract_cache = ContractCache(config.cache_dir, config.chain_cache_days)
+        self.no_data_registry = NoDataRegistry(config.cache_dir, config.no_data_days)
+        self.expiry_calendar = ExpiryCalendar(config.cache_dir, config.chain_cache_days)
+        self.listed_expiries = set()
         self.mode = "historical"
-        self.lock = threading.Lock()
+        self.live_requests = {}  # req_id of live subscriptions and streams -> the LiveSession they belong to
         self.shift_hours = config.shift_hours
+        self.fast_decoding = config.fast_decoding and config.output_type == "bin"
+        self.shared_memory = (config.shared_memory_slots, config.shared_memory_bars) if config.shared_memory else None
+        self.connection = ConnectionManager(self, config.host, config.port, config.client_id, self.restore_requests, config.connect_timeout)
+        self.metrics.set_gauge("ib_connected", lambda: int(self.connection.is_connected))
+        self.metrics.set_gauge("ib_requests_in_flight", lambda: self.pacing.in_flight)
+        self.metrics.set_gauge("ib_requests_tracked", lambda: len(self.requests))
 
     @abstractmethod
     def historicalData(self, req_id: int, bar):
         """
         The answer from the IB server, with the requested data.
-        Each inheriting class has it's own implementation
+        Each inheriting class has it's own implementation.
+        bar.date is kept as sent by TWS, binary output parses and shifts the times of a whole buffer at once when it's
+        written, see BarWriter
         :param req_id: the id of the request
         :param bar: the bar object, containing date, open, low, high and close
         """
-        update_time = dt.datetime.strptime(bar.date, '%Y%m%d  %H:%M:%S')
-        update_time = update_time.replace(hour=update_time.hour - self.shift_hours)  # shift time if needed
-        bar.date = update_time.strftime('%H%M%S')
 
-    def send_live_data_request(self, contract):
-        pass
+    @property
+    def open_requests(self) -> int:
+        return self.pacing.in_flight
+
+    def connect(self, host: str, port: int, client_id: int):
+        """
+        Connect to TWS. With fast_decoding the decoder of the connection is replaced by a BatchDecoder, before the message
+        loop starts
+        """
+        super().connect(host, port, client_id)
+        if self.fast_decoding and self.isConnected():
+            self.decoder = BatchDecoder(self, self.serverVersion())
+
+    def nextValidId(self, order_id: int):
+        """
+        TWS is ready to accept requests on a new connection
+        :param order_id: the next valid order id
+        """
+        super().nextValidId(order_id)
+        self.connection.on_next_valid_id(order_id)
+
+    def connectionClosed(self):
+        """
+        The socket was closed, either by us or because TWS went away. The connection manager reconnects in the latter case
+        """
+        super().connectionClosed()
+        self.connection.on_connection_closed()
+
+    def restore_requests(self, subscriptions_lost: bool):
+        """
+        The connection was restored after it was lost. Everything that was in flight is lost: open requests are sent again,
+        waiters of single responses fail, and live sessions subscribe again if their subscriptions were dropped as well.
+        Nothing is sent before this returns.
+        :param subscriptions_lost: False if TWS kept the live subscriptions
+        """
+        lost = self.requests.resend_all()
+        for req_id, tracked in lost:
+            if self.isConnected():
+                self.cancelHistoricalData(req_id)  # it may still be answered if the socket stayed open
+            self.pacing.release()
+        self.metrics.inc("ib_requests_resubmitted_total", len(lost), sec_type=self.sec_type)
+        logging.getLogger("IBLog").info(f"Connection restored, sending {len(lost)} open requests again")
+        for req_id in list(self.pending_responses):
+            self.fail_response(req_id, 504, "Connection lost")
+        if subscriptions_lost:
+            for session in set(self.live_requests.values()):
+                session.resubscribe()
+
+    def expect_response(self, req_id: int) -> Future:
+        """
+        Register a future for a request, which is resolved by the callbacks as soon as the response arrives.
+        Must be called before sending the request.
+        :param req_id: the request id
+        :return: the future of the response
+        """
+        future = Future()
+        self.pending_responses[req_id] = future
+        return future
+
+    def resolve_response(self, req_id: int, result=None):
+        """
+        Wake whoever is waiting for the response of the request
+        :param req_id: the request id
+        :param result: the result of the request
+        """
+        if (future := self.pending_responses.pop(req_id, None)) is not None:
+            future.set_result(result)
+
+    def fail_response(self, req_id: int, error_code: int, error_string: str):
+        """
+        Wake whoever is waiting for the response of the request with an error
+        :param req_id: the request id
+        :param error_code: IB error code
+        :param error_string: IB error message
+        """
+        if (future := self.pending_responses.pop(req_id, None)) is not None:
+            future.set_exception(Exception(f"Request {req_id} failed: {error_code} {error_string}"))
+
+    def send_live_data_request(self, data_request: DataRequest):
+        """
+        Subscribe to the real time bars of a contract. Subscriptions count for pacing as historical requests do, but
+        they don't stay in flight.
+        :param data_request: the contract and side of the subscription, with its req_id already set
+        """
+        self.connection.wait_connected()
+        with self.metrics.timer("ib_pacing_wait_seconds_total"):
+            self.pacing.acquire()
+        self.pacing.release()
+        self.metrics.inc("ib_live_subscriptions_total", sec_type=self.sec_type)
+        try:
+            self.reqRealTimeBars(data_request.req_id, data_request.contract, REAL_TIME_BAR_SIZE, data_request.bid_or_ask, False, [])
+        except OSError:
+            logging.getLogger("IBLog").warning(f"Subscription {data_request.req_id} was not sent, the connection is lost")
+            self.connection.on_connection_closed()
 
     def send_historical_data_request(self, data_request: DataRequest):
         """
-        add new request to sent_time_queue and increase the open requests counter.
-        further implementation is specific for each inheriting class
+        Send a new request, and track it until it ends. The request is resent if it fails on a retryable error or doesn't
+        end in time.
         :param data_request: the new request
         """
-        self.sent_time_queue.append(dt.datetime.now())
-        self.open_requests += 1
+        data_request.day_job.request_sent()
+        self.send_tracked_request(TrackedRequest(data_request))
+
+    def send_tracked_request(self, tracked: TrackedRequest):
+        """
+        Block until the request can be sent without violating IB pacing limitations, generate a new random request id
+        and send it. Nothing is sent while the connection is down, a request that is sent as it's lost stays tracked, and
+        is sent again once the connection is restored.
+        :param tracked: the request
+        """
+        data_request = tracked.data_request
+        self.connection.wait_connected()
+        with self.metrics.timer("ib_pacing_wait_seconds_total"):
+            self.pacing.acquire(data_request.get_pacing_key(), data_request.get_pacing_cost())
+        data_request.req_id = get_req_id(self.requests.keys())
+        self.requests.sent(data_request.req_id, tracked)
+        self.metrics.inc("ib_requests_sent_total", sec_type=self.sec_type)
+        try:
+            self.reqHistoricalData(data_request.req_id, data_request.contract, f"{data_request.query_time.strftime('%Y%m%d %H:%M:%S')} EST", f"{data_request.interval_size * 60} S", BAR_SIZE_NAMES[BAR_SIZE], data_request.bid_or_ask, 1, 1, False, [])
+        except OSError:
+            logging.getLogger("IBLog").warning(f"Request {data_request.req_id} was not sent, the connection is lost")
+            self.connection.on_connection_closed()
+
+    def request_timed_out(self, req_id: int, tracked: TrackedRequest):
+        """
+        The request didn't end in time, IB might have silently dropped it. Cancel it and try again.
+        :param req_id: the request id
+        :param tracked: the request
+        """
+        self.cancelHistoricalData(req_id)
+        self.metrics.inc("ib_requests_timed_out_total", sec_type=self.sec_type)
+        self.fail_request(req_id, "timeout", retryable=True)
+
+    def fail_request(self, req_id: int, error: str, retryable: bool):
+        """
+        A request failed. Free its pacing slot, it is either resent later or given up on. Requests that were given up on
+        are not journaled, so the next run tries them again.
+        :param req_id: the request id
+        :param error: description of the failure
+        :param retryable: False if sending the request again is pointless
+        """
+        if (tracked := self.requests.fail(req_id, error, retryable)) is None:
+            return
+        self.metrics.inc("ib_requests_failed_total" if tracked.state == RequestState.FAILED else "ib_requests_retried_total", sec_type=self.sec_type)
+        if tracked.state == RequestState.FAILED and tracked.data_request.day_job.request_failed():
+            self.close_day(tracked.data_request.day_job)
+        self.pacing.release()
+
+    def ignore_unknown_request(self, req_id: int):
+        """
+        Data of requests that were cancelled or timed out may still arrive, it's dropped
+        :param req_id: the request id
+        """
+        if req_id not in self.ignored_req_ids:
+            self.ignored_req_ids.add(req_id)
+            logging.getLogger("IBLog").warning(f"Ignoring data of unknown request {req_id}")
 
     def historicalDataEnd(self, req_id: int, start: str, end: str):
         """
@@ -112,18 +435,55 @@ class IBapi(EWrapper, EClient, ABC):
         :param end: end time of the request
         """
         super().historicalDataEnd(req_id, start, end)
-        if req_id in self.req_id_to_contract.keys():
-            # calculate the time it took for the request the be delivered, and than remove it from the requests dictionary
-            fetch_time = (dt.datetime.now() - self.req_id_to_contract[req_id]['time']).seconds
-            data_req = self.req_id_to_contract[req_id]["data_request"]
-            msg = f"HistoricalDataEnd - {req_id:05}. Strike: {data_req.contract.right}{data_req.contract.strike}, from: {start}, to: {end}, send time: {self.req_id_to_contract[req_id]['time'].strftime('%H:%M:%S')}, end time: {dt.datetime.now().strftime('%H:%M:%S')}, fetch time: {fetch_time}"
+        if (tracked := self.requests.complete(req_id)) is not None:
+            # calculate the time it took for the request the be delivered
+            fetch_time = time.time() - tracked.send_time
+            self.metrics.observe("ib_request_latency_seconds", fetch_time, sec_type=self.sec_type)
+            self.metrics.inc("ib_requests_completed_total", sec_type=self.sec_type)
+            send_time = dt.datetime.fromtimestamp(tracked.send_time)
+            data_req = tracked.data_request
+            msg = f"HistoricalDataEnd - {req_id:05}. Strike: {data_req.contract.right}{data_req.contract.strike}, from: {start}, to: {end}, send time: {send_time.strftime('%H:%M:%S')}, end time: {dt.datetime.now().strftime('%H:%M:%S')}, fetch time: {fetch_time:.3f}"
             logging.getLogger("IBLog").info(msg)
-            del self.req_id_to_contract[req_id]
-            self.open_requests -= 1
+            self.end_request(data_req)
         elif req_id == OPEN_SPOT_PRICE_REQ_ID:
             logging.getLogger("IBLog").info(f"HistoricalDataEnd. req_id: {req_id}, from {start} to {end}")
+            if self.option_chain_data.open_spot_price == -1:
+                self.fail_response(req_id, 162, "No open price received")
+            else:
+                self.resolve_response(req_id, self.option_chain_data.open_spot_price)
         else:
-            raise Exception("Unknown req_id!!!")
+            self.ignore_unknown_request(req_id)
+
+    def historicalDataBatch(self, req_id: int, bars: np.ndarray):
+        """
+        All the bars of a historical data message at once, with fast_decoding. Bars of data requests are encoded into
+        records of bar_dtype as a whole, and handed to the writer in a single call. Anything else, like the open spot
+        price, goes through historicalData bar by bar.
+        :param req_id: the id of the request
+        :param bars: array of HISTORICAL_BAR_DTYPE, see IBDecoder
+        """
+        if (tracked := self.requests.get(req_id)) is None:
+            for bar in to_bar_data(bars):
+                self.historicalData(req_id, bar)
+            return
+        tracked.state = RequestState.RECEIVING
+        if tracked.last_bar_date is not None:
+            bars = bars[bars['date'] > tracked.last_bar_date.encode()]
+        if len(bars):
+            tracked.last_bar_date = bars['date'][-1].decode()
+            tracked.data_request.day_job.writer.put_rows(self.encode_bars(tracked.data_request, bars))
+
+    def realtimeBar(self, req_id: int, bar_time: int, open_: float, high: float, low: float, close: float, volume: int,
+                    wap: float, count: int):
+        """
+        A real time bar of a live subscription, it's handed to the LiveSession of the subscription. Bars of a
+        subscription that was just cancelled may still arrive, they are dropped.
+        :param req_id: request id
+        :param bar_time: start time of the bar, in seconds since the epoch
+        """
+        super().realtimeBar(req_id, bar_time, open_, high, low, close, volume, wap, count)
+        if (session := self.live_requests.get(req_id)) is not None:
+            session.on_bar(req_id, bar_time, open_, high, low, close)
 
     def contractDetails(self, req_id: int, contract_details):
         """
@@ -134,6 +494,8 @@ class IBapi(EWrapper, EClient, ABC):
         super().contractDetails(req_id, contract_details)
         if req_id == ALL_OPTION_CONTRACTS_DETAILS_REQ_ID:
             self.option_chain_data.all_contracts[contract_details.contract.strike][contract_details.contract.right] = contract_details.contract
+        elif req_id == UNDERLINE_DETAILS_REQ_ID:
+            self.resolve_response(req_id, contract_details.contract.conId)
 
     def contractDetailsEnd(self, req_id: int):
         """
@@ -142,14 +504,47 @@ class IBapi(EWrapper, EClient, ABC):
         """
         super().contractDetailsEnd(req_id)
         if req_id == ALL_OPTION_CONTRACTS_DETAILS_REQ_ID:
-            self.option_chain_data.all_contracts_fetched = True
+            self.resolve_response(req_id, self.option_chain_data.all_contracts)
+        elif req_id == UNDERLINE_DETAILS_REQ_ID:
+            self.fail_response(req_id, 200, "No security definition has been found for the underline")
+
+    def securityDefinitionOptionParameter(self, req_id: int, exchange: str, underlying_con_id: int, trading_class: str,
+                                          multiplier: str, expirations: set, strikes: set):
+        """
+        The expiries and strikes of the options of an underline on a single exchange
+        """
+        super().securityDefinitionOptionParameter(req_id, exchange, underlying_con_id, trading_class, multiplier, expirations, strikes)
+        if req_id == LISTED_EXPIRIES_REQ_ID:
+            self.listed_expiries.update(expirations)
+
+    def securityDefinitionOptionParameterEnd(self, req_id: int):
+        super().securityDefinitionOptionParameterEnd(req_id)
+        if req_id == LISTED_EXPIRIES_REQ_ID:
+            self.resolve_response(req_id, set(self.listed_expiries))
+
+    def tickPrice(self, req_id: int, tick_type: int, price: float, attrib):
+        """
+        Market data answer, used to get the open spot price on live data requests, and to follow the underline price in
+        live mode
+        :param req_id: request id
+        :param tick_type: type of the price (last, bid, close, etc)
+        :param price: the price
+        :param attrib: tick attributes
+        """
+        super().tickPrice(req_id, tick_type, price, attrib)
+        if req_id == OPEN_SPOT_PRICE_REQ_ID and tick_type in (TickTypeEnum.LAST, TickTypeEnum.DELAYED_LAST) and price > 0:
+            self.option_chain_data.open_spot_price = price
+            self.resolve_response(req_id, price)
+        elif (session := self.live_requests.get(req_id)) is not None and tick_type in (TickTypeEnum.LAST, TickTypeEnum.DELAYED_LAST) and price > 0:
+            session.on_spot(price)
 
     def error(self, req_id, error_code: int, error_string: str):
         """
         Error message coming from IB servers.
         We ignore some messages when retrieving historical data, since they don't concern us (i.e. live data feed disconnection).
         When a certain option doesn't have data, like when close to expiry, we add it to the contracts_to_delete list, so we'd
-        know not to send further request for her.
+        know not to send further request for her, and to the no data registry, so it's not requested on the next days either.
+        Any other error ends the request: it is resent later if the error is retryable (pacing violation, etc), or given up on.
         All error codes: https://interactivebrokers.github.io/tws-api/message_codes.html
         :param req_id:
         :param error_code:
@@ -158,47 +553,139 @@ class IBapi(EWrapper, EClient, ABC):
         if self.mode == "historical" and error_code in [2103, 2104, 2108, 2157, 2158]:
             return
         logging.getLogger("IBLog").error(f"ERROR {dt.datetime.now().strftime('%H:%M:%S.%f')} {req_id:05} {error_code} {error_string}")
-        if req_id in self.req_id_to_contract.keys():
-            strike = self.req_id_to_contract[req_id]["data_request"].contract.strike
-            if error_code == 162 and error_string.split(':')[1] == "HMDS query returned no data":
-                self.contracts_to_delete[strike].append(self.req_id_to_contract[req_id]["data_request"].contract.right)
-                self.open_requests -= 1
-            if error_code == 165:
-                pass
+        if error_code in CONNECTION_ERROR_CODES:
+            # requests sent while the connection was down are not failed, they are sent again once it's restored
+            self.connection.on_error(error_code, error_string)
+            return
+        if req_id in self.pending_responses:
+            self.fail_response(req_id, error_code, error_string)
+        if (session := self.live_requests.get(req_id)) is not None and error_code not in INFORMATIVE_ERROR_CODES:
+            session.on_error(req_id, error_code, error_string)
+        if req_id in self.requests and error_code not in INFORMATIVE_ERROR_CODES:
+            if error_code == 162 and NO_DATA_MESSAGE in error_string:
+                if (tracked := self.requests.complete(req_id)) is not None:
+                    self.metrics.inc("ib_requests_no_data_total", sec_type=self.sec_type)
+                    data_request = tracked.data_request
+                    day_job, contract = data_request.day_job, data_request.contract
+                    day_job.contracts_to_delete[contract.strike].append(contract.right)
+                    if day_job.option_chain_data is not None:
+                        self.no_data_registry.add(day_job.base_asset, day_job.option_chain_data.expiry, contract.strike, contract.right, day_job.date)
+                    self.end_request(data_request)
+            else:
+                self.fail_request(req_id, f"{error_code} {error_string}", is_retryable_error(error_code, error_string))
 
-    def get_all_needed_contracts(self, asset, date, is_weekly, config: Config):
+    def get_all_needed_contracts(self, asset, date, is_weekly, config: Config, expiry: dt = None):
         """
         Currently only OPT needs an implementation of this function
         :param asset:
         :param date:
         :param is_weekly:
         :param config:
-        :return:
+        :param expiry:
+        :return: the option chain of the day, None if not relevant
+        """
+        return None
+
+    def start_day(self, day_job: DayJob):
+        """
+        Open the output of a day, before sending its requests. With shared_memory set, the bars of the day are also
+        published to a shared memory segment named by get_segment_name.
+        :param day_job: the day
+        """
+        publisher = None
+        if self.shared_memory is not None and self.output_type == "bin":
+            publisher = SharedBarPublisher(get_segment_name(self.sec_type, day_job.asset, day_job.date), self.bar_dtype,
+                                           self.sec_type, day_job.base_asset, day_job.date, *self.shared_memory)
+        day_job.open_output(self.output_type, self.bar_dtype, self.sec_type, self.metrics, self.shift_hours, publisher)
+
+    def end_day(self, day_job: DayJob):
+        """
+        All the requests of the day were sent. The day is closed once the last of them ends.
+        :param day_job: the day
         """
-        return
+        if day_job.all_sent():
+            self.close_day(day_job)
 
-    def write_to_file(self, input_line: str):
+    def close_day(self, day_job: DayJob):
         """
-        either write to txt file, or to binary file. If the latter selected, first convert it to numpy array so it can
-        be serialized.
-        :param input_line:
+        Closing the output sorts and fsyncs the file, so it is done in the background and never blocks the EReader
+        thread or the sending of the next day. A day with requests that were given up on is not marked as complete, so
+        the next run resumes it and sends them again
+        :param day_job: the day
+        """
+        if day_job.failed:
+            logging.getLogger("IBLog").warning(f"{day_job.file_name}: {day_job.failed} requests were given up on, the day is left incomplete")
+        self.day_closer.submit(day_job.close_output, self.output_type, not day_job.failed)
+        self.day_closer.submit(self.no_data_registry.save)
+
+    def end_request(self, data_request: DataRequest):
+        """
+        A request ended, either with all its data delivered or with no data. Journal it and free its pacing slot.
+        :param data_request: the request
+        """
+        day_job = data_request.day_job
+        day_job.journal_request(data_request)
+        if day_job.request_ended():
+            self.close_day(day_job)
+        self.pacing.release()
+
+    def receive_bar(self, tracked: TrackedRequest, bar):
+        """
+        A bar of a tracked request. A request that is sent again is answered from its start, the bars a previous attempt
+        already wrote are dropped.
+        :param tracked: the request
+        :param bar: the bar, with its date as sent by TWS
+        """
+        tracked.state = RequestState.RECEIVING
+        if tracked.last_bar_date is not None and bar.date <= tracked.last_bar_date:
+            return
+        tracked.last_bar_date = bar.date
+        self.write_bar(tracked.data_request, bar)
+
+    def write_bar(self, data_request: DataRequest, bar):
+        """
+        Queue a bar for writing. Binary output gets the bar encoded straight into a record of bar_dtype, text is only
+        formatted when writing a txt file.
+        :param data_request: the request the bar belongs to
+        :param bar: the bar, with its date as sent by TWS
         """
         if self.output_type == "bin":
-            if isinstance(self, OPT):
-                output = get_opt_arr_from_line(input_line)
-            else:
-                output = get_arr_from_line(input_line)
-            self.lock.acquire()
-            output.tofile(self.output_file)
-            self.lock.release()
+            data_request.day_job.writer.put(self.encode_bar(data_request, bar))
         elif self.output_type == "txt":
-            output = input_line
-            self.lock.acquire()
-            self.output_file.write(output)
-            self.lock.release()
+            bar.date = get_bar_time(bar.date, self.shift_hours)
+            data_request.day_job.writer.put(self.format_bar(data_request, bar))
         else:
             raise Exception("Unknown output file type")
 
+    @staticmethod
+    def encode_bar(data_request: DataRequest, bar) -> tuple:
+        """
+        :return: the bar as a record of BAR_DTYPE, with the time not parsed yet. Ask is represented as 1, Bid as 0 and
+        BID_ASK as 2
+        """
+        return bar.date, SIDE_CODES[data_request.bid_or_ask], bar.open, bar.high, bar.low, bar.close
+
+    def encode_bars(self, data_request: DataRequest, bars: np.ndarray) -> np.ndarray:
+        """
+        :param data_request: the request the bars belong to
+        :param bars: array of HISTORICAL_BAR_DTYPE
+        :return: the bars as records of bar_dtype, with their times parsed and shifted
+        """
+        rows = np.empty(len(bars), dtype=self.bar_dtype)
+        rows['time'] = parse_bar_times(bars['date'], self.shift_hours)
+        rows['side'] = SIDE_CODES[data_request.bid_or_ask]
+        for name in ('open', 'high', 'low', 'close'):
+            rows[name] = bars[name]
+        return rows
+
+    @staticmethod
+    def format_bar(data_request: DataRequest, bar) -> str:
+        """
+        :return: the bar as a line of the txt output
+        """
+        bid_or_ask = TXT_SIDES[data_request.bid_or_ask]
+        return f"{bar.date},{bid_or_ask},{bar.open:.3f},{bar.high:.3f},{bar.low:.3f},{bar.close:.3f}\n"
+
     def set_shift_hours(self, shift: int):
         """
         Time stamp of data depends of the AWS timezone.
@@ -207,16 +694,21 @@ class IBapi(EWrapper, EClient, ABC):
         """
         self.shift_hours = shift
 
-    def remove_contracts(self):
+    @staticmethod
+    def remove_contracts(day_job: DayJob):
         """
         Remove contracts that we received no data error for them
+        :param day_job: the day to remove the contracts from
         """
-        for strike in self.contracts_to_delete.keys():
-            if strike in self.option_chain_data.all_contracts.keys():
-                for side in self.contracts_to_delete[strike]:
-                    if side in self.option_chain_data.all_contracts[strike]:
-                        del self.option_chain_data.all_contracts[strike][side]
-        self.contracts_to_delete.clear()
+        if day_job.option_chain_data is None:
+            return
+        all_contracts = day_job.option_chain_data.all_contracts
+        for strike in list(day_job.contracts_to_delete.keys()):
+            if strike in all_contracts.keys():
+                for side in day_job.contracts_to_delete[strike]:
+                    if side in all_contracts[strike]:
+                        del all_contracts[strike][side]
+            del day_job.contracts_to_delete[strike]
 
     @staticmethod
     def get_asset_contract(symbol):
@@ -230,23 +722,11 @@ class IBapi(EWrapper, EClient, ABC):
 
 
 class OPT(IBapi):
+    bar_dtype = OPT_BAR_DTYPE
+
     def __init__(self, config: Config):
         super().__init__(config)
 
-    def send_historical_data_request(self, data_request: DataRequest):
-        """
-        Generate a new random request id and send a new request
-        :param data_request: request object with all needed data
-        :return:
-        """
-        super().send_historical_data_request(data_request)
-
-        data_request.req_id = get_req_id(self.req_id_to_contract.keys())
-
-        self.req_id_to_contract[data_request.req_id] = {"secType": "OPT", "data_request": data_request, "time": dt.datetime.now()}
-
-        self.reqHistoricalData(int(data_request.req_id), data_request.contract, f"{data_request.query_time.strftime('%Y%m%d %H:%M:%S')} EST", f"{data_request.interval_size * 60} S", "5 secs", data_request.bid_or_ask, 1, 1, False, [])
-
     def historicalData(self, req_id: int, bar):
         """
         Response from IB servers.
@@ -262,29 +742,50 @@ class OPT(IBapi):
             logging.getLogger("IBLog").info(f"Open price is: {str(bar.close)}")
             return
 
-        if req_id in self.req_id_to_contract.keys():
-            data_request = self.req_id_to_contract[req_id]["data_request"]
-            strike = data_request.contract.strike
-            call_or_put = data_request.contract.right
-            bid_or_ask = "S" if data_request.bid_or_ask == "ASK" else "B"
-            string = f"{bar.date},{strike},{call_or_put},{bid_or_ask},{format(bar.open, '.3f')},{format(bar.high, '.3f')},{format(bar.low, '.3f')},{format(bar.close, '.3f')}\n"
+        if (tracked := self.requests.get(req_id)) is not None:
+            self.receive_bar(tracked, bar)
         else:
-            raise Exception("Unknown req_id!!!")
-        self.write_to_file(string)
+            self.ignore_unknown_request(req_id)
 
-    def get_wanted_contracts(self, asset: str):
+    @staticmethod
+    def encode_bar(data_request: DataRequest, bar) -> tuple:
         """
-        Get a list of the contracts corresponding with the options
+        :return: the bar as a record of OPT_BAR_DTYPE, with the time not parsed yet. Call is represented as 1, Put as 0.
+        Ask is represented as 1, Bid as 0 and BID_ASK as 2
+        """
+        contract = data_request.contract
+        return bar.date, contract.strike, contract.right == "C", SIDE_CODES[data_request.bid_or_ask], bar.open, bar.high, bar.low, bar.close
+
+    def encode_bars(self, data_request: DataRequest, bars: np.ndarray) -> np.ndarray:
+        rows = super().encode_bars(data_request, bars)
+        rows['strike'] = data_request.contract.strike
+        rows['right'] = data_request.contract.right == "C"
+        return rows
+
+    @staticmethod
+    def format_bar(data_request: DataRequest, bar) -> str:
+        """
+        :return: the bar as a line of the txt output
+        """
+        bid_or_ask = TXT_SIDES[data_request.bid_or_ask]
+        return f"{bar.date},{data_request.contract.strike},{data_request.contract.right},{bid_or_ask},{bar.open:.3f},{bar.high:.3f},{bar.low:.3f},{bar.close:.3f}\n"
+
+    def get_wanted_contracts(self, day_job: DayJob):
+        """
+        Get a list of the contracts corresponding with the options. Contracts in the no data registry are skipped.
+        :param day_job: the requested day
         :return: list of all contracts
         """
         all_contracts = []
-        for strike in self.option_chain_data.all_contracts.values():
-            for side in strike:
-                all_contracts.append(strike[side])
+        expiry = day_job.option_chain_data.expiry
+        for strike, contracts in day_job.option_chain_data.all_contracts.items():
+            for side, contract in contracts.items():
+                if not self.no_data_registry.contains(day_job.base_asset, expiry, strike, side, day_job.date):
+                    all_contracts.append(contract)
 
         return all_contracts
 
-    def get_all_needed_contracts(self, asset: str, date: dt, is_weekly: bool, config: Config):
+    def get_all_needed_contracts(self, asset: str, date: dt, is_weekly: bool, config: Config, expiry: dt = None):
         """
         Each strike on each side is considered a different contract, So when requesting data on options we first need
         to decide with strikes on each side we want get.
@@ -292,23 +793,80 @@ class OPT(IBapi):
         :param date: requested date
         :param is_weekly: weekly options or monthly
         :param config: config params
+        :param expiry: expiry of the options, see get_expiries. Found by get_option_chain if None
+        """
+        self.get_option_chain(asset, date, is_weekly, config, expiry)
+        self.keep_close_strikes(config.pct_strikes_from_atm)
+
+        [logging.getLogger("IBLog").info(contract) for contract in self.option_chain_data.all_contracts.values()]
+        return self.option_chain_data
+
+    def get_option_chain(self, asset: str, date: dt, is_weekly: bool, config: Config, expiry: dt = None):
+        """
+        Get the open spot price and the entire option chain of the closest expiry
+        :param asset: the underline asset
+        :param date: requested date
+        :param is_weekly: weekly options or monthly
+        :param config: config params
+        :param expiry: expiry of the options, when it was found along the expiries of other days, see get_expiries
+        :return: the option chain, with all its strikes
         """
         self.option_chain_data = OptionChainData(asset)
-        self.contracts_to_delete.clear()
 
-        next_expiry = get_closest_expiry(date, os.getcwd(), is_weekly)  # get the closest expiry to this dates, depending if that's a monthly or weekly option
+        next_expiry = expiry
+        if next_expiry is None:
+            next_expiry = dt.datetime.combine(self.get_expiries(asset, [date], is_weekly)[0].astype(dt.date), dt.time())
+        self.option_chain_data.expiry = next_expiry
         logging.getLogger("IBLog").info(f"Expiry found for date {date.strftime('%d/%m/%Y')}: {next_expiry.strftime('%d/%m/%Y')}")
 
         self.get_underline_open_price(asset, date.replace(hour=config.start_time.hour, minute=config.start_time.minute))
 
-        # Get all contracts for the given expiry
-        self.reqContractDetails(ALL_OPTION_CONTRACTS_DETAILS_REQ_ID, self.get_ambiguous_option_contract(next_expiry, asset))
-        while not self.option_chain_data.all_contracts_fetched:
-            time.sleep(1)
+        # Get all contracts for the given expiry, the chain is only requested from TWS if it's not cached
+        if (cached_contracts := self.contract_cache.get(asset, next_expiry)) is not None:
+            self.option_chain_data.all_contracts.update(cached_contracts)
+        else:
+            self.connection.wait_connected()
+            contracts_fetched = self.expect_response(ALL_OPTION_CONTRACTS_DETAILS_REQ_ID)
+            self.reqContractDetails(ALL_OPTION_CONTRACTS_DETAILS_REQ_ID, self.get_ambiguous_option_contract(next_expiry, asset))
+            contracts_fetched.result(timeout=RESPONSE_TIMEOUT)
+            if self.option_chain_data.all_contracts:
+                self.contract_cache.put(asset, next_expiry, self.option_chain_data.all_contracts)
+        return self.option_chain_data
 
-        self.keep_close_strikes(config.pct_strikes_from_atm)
+    def get_expiries(self, asset: str, dates: list, is_weekly: bool) -> np.ndarray:
+        """
+        Find the closest expiry of every date at once, from the expiry calendar of the underline
+        :param asset: the underline asset
+        :param dates: requested dates
+        :param is_weekly: weekly options or monthly
+        :return: datetime64[D] array of the expiry of every date
+        """
+        expiries = self.expiry_calendar.get_closest_expiries(asset, dates, is_weekly)
+        if (expiries >= np.datetime64(dt.date.today(), 'D')).any() and self.expiry_calendar.is_listed_stale(asset):
+            # IB lists the series that didn't expire yet, they cover the exceptions of the derived expiries
+            self.request_listed_expiries(asset)
+            expiries = self.expiry_calendar.get_closest_expiries(asset, dates, is_weekly)
+        return expiries
 
-        [logging.getLogger("IBLog").info(contract) for contract in self.option_chain_data.all_contracts.values()]
+    def request_listed_expiries(self, asset: str):
+        """
+        Seed the expiry calendar with the expiries IB lists for the underline. The derived expiries are used if they
+        can't be fetched
+        :param asset: the underline asset
+        """
+        try:
+            self.connection.wait_connected()
+            details_received = self.expect_response(UNDERLINE_DETAILS_REQ_ID)
+            self.reqContractDetails(UNDERLINE_DETAILS_REQ_ID, self.get_asset_contract(asset))
+            con_id = details_received.result(timeout=RESPONSE_TIMEOUT)
+            self.listed_expiries = set()
+            expiries_received = self.expect_response(LISTED_EXPIRIES_REQ_ID)
+            self.reqSecDefOptParams(LISTED_EXPIRIES_REQ_ID, asset, "", "STK", con_id)
+            self.expiry_calendar.seed(asset, expiries_received.result(timeout=RESPONSE_TIMEOUT))
+        except Exception as e:
+            self.pending_responses.pop(UNDERLINE_DETAILS_REQ_ID, None)
+            self.pending_responses.pop(LISTED_EXPIRIES_REQ_ID, None)
+            logging.getLogger("IBLog").warning(f"Could not get the listed expiries of {asset}, using the derived ones: {e}")
 
     def keep_close_strikes(self, dist_from_atm: float):
         """
@@ -316,13 +874,21 @@ class OPT(IBapi):
         :param dist_from_atm: percentage from ATM. keep all strikes that are within this range
         """
         self.option_chain_data.all_contracts = OrderedDict(sorted(self.option_chain_data.all_contracts.items()))
-        atm_strike = take_closest(list(self.option_chain_data.all_contracts.keys()), self.option_chain_data.open_spot_price)
-        for strike in self.option_chain_data.all_contracts.keys():
-            if abs(strike - atm_strike) / atm_strike > dist_from_atm:
-                self.contracts_to_delete[strike] = []  # we are going to delete both Call and Put, so we don't specify
-        for strike in self.contracts_to_delete:
+        close_strikes = set(self.get_close_strikes(list(self.option_chain_data.all_contracts.keys()), self.option_chain_data.open_spot_price, dist_from_atm))
+        strikes_to_delete = [strike for strike in self.option_chain_data.all_contracts.keys() if strike not in close_strikes]
+        for strike in strikes_to_delete:
             del self.option_chain_data.all_contracts[strike]
-        self.contracts_to_delete.clear()
+
+    @staticmethod
+    def get_close_strikes(strikes: list, spot_price: float, dist_from_atm: float) -> list:
+        """
+        :param strikes: sorted strikes of the chain
+        :param spot_price: price of the underline
+        :param dist_from_atm: percentage from ATM
+        :return: the strikes within that range of the ATM strike, closest to it first
+        """
+        atm_strike = take_closest(strikes, spot_price)
+        return sorted((strike for strike in strikes if abs(strike - atm_strike) / atm_strike <= dist_from_atm), key=lambda strike: abs(strike - atm_strike))
 
     def get_underline_open_price(self, asset: str, date: dt):
         """
@@ -333,14 +899,21 @@ class OPT(IBapi):
         """
         underline_contract = self.get_asset_contract(asset)
         is_live_data_request = date.date() == dt.datetime.now().date()
+        self.connection.wait_connected()
+        open_price_received = self.expect_response(OPEN_SPOT_PRICE_REQ_ID)
         if not is_live_data_request:
+            with self.metrics.timer("ib_pacing_wait_seconds_total"):
+                self.pacing.acquire(cost=get_pacing_cost("BID_ASK"))  # historical request of the spot price counts for pacing as well
             self.reqHistoricalData(OPEN_SPOT_PRICE_REQ_ID, underline_contract, date.strftime("%Y%m%d %H:%M:%S") + " EST", "60 S", "1 min", "BID_ASK", 1, 1, False, [])
         else:
             self.reqMktData(OPEN_SPOT_PRICE_REQ_ID, underline_contract, "", False, False, [])
-        while self.option_chain_data.open_spot_price == -1:  # wait until spot price is initialized
-            time.sleep(1)
-        if is_live_data_request:
-            self.cancelMktData(OPEN_SPOT_PRICE_REQ_ID)
+        try:
+            open_price_received.result(timeout=RESPONSE_TIMEOUT)  # wait until spot price is initialized
+        finally:
+            if is_live_data_request:
+                self.cancelMktData(OPEN_SPOT_PRICE_REQ_ID)
+            else:
+                self.pacing.release()
 
     @staticmethod
     def get_ambiguous_option_contract(next_expiry: dt, underline_asset: str) -> Contract:
@@ -365,17 +938,6 @@ class STK(IBapi):
     def __init__(self, config: Config):
         super().__init__(config)
 
-    def send_historical_data_request(self, data_request: DataRequest):
-        """
-        Generate a new random request id and send a new request
-        :param data_request: request object with all needed data
-        """
-        super().send_historical_data_request(data_request)
-
-        data_request.req_id = get_req_id(self.req_id_to_contract.keys())
-        self.req_id_to_contract[data_request.req_id] = {"secType": "STK", "data_request": data_request, "time": dt.datetime.now()}
-        self.reqHistoricalData(data_request.req_id, data_request.contract,  f"{data_request.query_time.strftime('%Y%m%d %H:%M:%S')} EST", f"{data_request.interval_size * 60} S", "5 secs", data_request.bid_or_ask, 1, 1, False, [])
-
     def historicalData(self, req_id: int, bar):
         """
         Response from IB servers.
@@ -384,41 +946,23 @@ class STK(IBapi):
         :param bar: data
         """
         super().historicalData(req_id, bar)
-        if req_id in self.req_id_to_contract.keys():
-            data_request = self.req_id_to_contract[req_id]["data_request"]
-            bid_or_ask = "S" if data_request.bid_or_ask == "ASK" else "B"
-            string = f"{bar.date},{bid_or_ask},{format(bar.open, '.3f')},{format(bar.high, '.3f')},{format(bar.low, '.3f')},{format(bar.close, '.3f')}\n"
+        if (tracked := self.requests.get(req_id)) is not None:
+            self.receive_bar(tracked, bar)
         else:
-            raise Exception("Unknown req_id!!!")
-        self.write_to_file(string)
+            self.ignore_unknown_request(req_id)
 
-    def get_wanted_contracts(self, asset: str):
+    def get_wanted_contracts(self, day_job: DayJob):
         """
         STK only has single contract per asset
-        :param asset: requested asset
+        :param day_job: the requested day
         """
-        return [self.get_asset_contract(asset)]
+        return [self.get_asset_contract(day_job.asset)]
 
 
 class FX(IBapi):
     def __init__(self, config: Config):
         super().__init__(config)
 
-    def send_historical_data_request(self, data_request: DataRequest):
-        """
-        Generate a new random request id and send a new request
-        :param data_request: request object with all needed data
-        """
-        req_id = randint(10, 99999)
-        while req_id in self.req_id_to_contract.keys():
-            req_id = randint(10, 99999)
-        self.req_id_to_contract[req_id] = {"secType": "FX", "strike": 0, "bidOrAsk": data_request.bid_or_ask, "callOrPut": "F", "time": dt.datetime.now()}
-
-        self.reqHistoricalData(int(req_id), data_request.contract,  f"{data_request.query_time.strftime('%Y%m%d %H:%M:%S')} EST", f"{data_request.interval_size * 60} S", "5 secs", data_request.bid_or_ask, 1, 1, False, [])
-        self.sent_time_queue.append(dt.datetime.now())
-        self.open_requests += 1
-        time.sleep(0.1)
-
     def historicalData(self, req_id: int, bar):
         """
         Response from IB servers.
@@ -427,20 +971,17 @@ class FX(IBapi):
         :param bar: data
         """
         super().historicalData(req_id, bar)
-        if req_id in self.req_id_to_contract.keys():
-            data_request = self.req_id_to_contract[req_id]["data_request"]
-            bid_or_ask = "S" if data_request.bid_or_ask == "ASK" else "B"
-            string = f"{bar.date},{bid_or_ask},{format(bar.open, '.3f')},{format(bar.high, '.3f')},{format(bar.low, '.3f')},{format(bar.close, '.3f')}\n"
+        if (tracked := self.requests.get(req_id)) is not None:
+            self.receive_bar(tracked, bar)
         else:
-            raise Exception("Unknown req_id!!!")
-        self.write_to_file(string)
+            self.ignore_unknown_request(req_id)
 
-    def get_wanted_contracts(self, asset: str):
+    def get_wanted_contracts(self, day_job: DayJob):
         """
         STK only has single contract per asset
-        :param asset: requested asset
+        :param day_job: the requested day
         """
-        return [self.get_fx_contract(asset)]
+        return [self.get_fx_contract(day_job.asset)]
 
     @staticmethod
     def get_fx_contract(symbol):
@@ -0,0 +1,170 @@
+import os
+import pickle
+import logging
+import threading
+import datetime as dt
+from collections import OrderedDict
+
+CACHE_VERSION = 1
+DEFAULT_MEMORY_ENTRIES = 32
+
+
+class ContractCache:
+    """
+    On-disk cache of option chains, keyed by (underlying, expiry), with an in-memory LRU layer on top of it.
+    An entry is valid if it was fetched after the expiry passed (the chain can't change anymore), or if it is younger
+    than max_age_days, since strikes might still be added to a live chain.
+    """
+    def __init__(self, cache_dir: str, max_age_days: float, memory_entries: int = DEFAULT_MEMORY_ENTRIES):
+        """
+        :param cache_dir: directory of the cache files
+        :param max_age_days: age in days after which a chain of an expiry that didn't pass yet is fetched again
+        :param memory_entries: number of chains kept in memory
+        """
+        self.cache_dir = os.path.join(cache_dir, "chains")
+        self.max_age = dt.timedelta(days=max_age_days)
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, underline: str, expiry: dt) -> dict:
+        """
+        :param underline: the underline asset
+        :param expiry: expiry of the options
+        :return: copy of the cached chain as {strike: {right: Contract}}, or None if there is no valid entry
+        """
+        key = (underline, expiry.strftime('%Y%m%d'))
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+            else:
+                entry = self.load(key)
+                if entry is None:
+                    return None
+                self.remember(key, entry)
+            if not self.is_valid(entry, expiry):
+                self._drop(key)
+                return None
+            return {strike: dict(contracts) for strike, contracts in entry["contracts"].items()}
+
+    def put(self, underline: str, expiry: dt, contracts: dict):
+        """
+        Save a freshly fetched chain
+        :param underline: the underline asset
+        :param expiry: expiry of the options
+        :param contracts: the chain as {strike: {right: Contract}}
+        """
+        key = (underline, expiry.strftime('%Y%m%d'))
+        entry = {"version": CACHE_VERSION, "fetched": dt.datetime.now(),
+                 "contracts": {strike: dict(rights) for strike, rights in contracts.items()}}
+        with self.lock:
+            self.remember(key, entry)
+            tmp_path = self.get_path(key) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.get_path(key))
+
+    def invalidate(self, underline: str, expiry: dt):
+        """
+        Drop a chain from the cache, so the next get() fetches it again
+        """
+        with self.lock:
+            self._drop((underline, expiry.strftime('%Y%m%d')))
+
+    def _drop(self, key: tuple):
+        self.memory.pop(key, None)
+        if os.path.exists(path := self.get_path(key)):
+            os.remove(path)
+
+    def is_valid(self, entry: dict, expiry: dt) -> bool:
+        if entry.get("version") != CACHE_VERSION:
+            return False
+        if entry["fetched"].date() > expiry.date():
+            return True
+        return dt.datetime.now() - entry["fetched"] < self.max_age
+
+    def remember(self, key: tuple, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def load(self, key: tuple) -> dict:
+        if not os.path.exists(path := self.get_path(key)):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logging.getLogger("IBLog").warning(f"Ignoring corrupted cache file {path}: {e}")
+            return None
+
+    def get_path(self, key: tuple) -> str:
+        return os.path.join(self.cache_dir, f"{key[0]}-{key[1]}.pickle")
+
+
+class NoDataRegistry:
+    """
+    On-disk registry of the option contracts HMDS returned no data for, keyed by (underlying, expiry, strike, right),
+    with the dates they returned no data on. Deep strikes and strikes close to expiry rarely start trading again, so a
+    contract is skipped on that date and the max_age_days days that follow it, before any request is spent on it.
+    Earlier dates are still requested, since the contract might have traded before.
+    """
+    def __init__(self, cache_dir: str, max_age_days: float):
+        """
+        :param cache_dir: directory of the registry file
+        :param max_age_days: number of days after a no data date on which the contract is still skipped
+        """
+        self.path = os.path.join(cache_dir, "no_data.pickle")
+        self.max_age = dt.timedelta(days=max_age_days)
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load()
+
+    def add(self, underline: str, expiry: dt, strike: float, right: str, date: dt):
+        """
+        Record that a contract returned no data on a date
+        """
+        key = (underline, expiry.strftime('%Y%m%d'), strike, right)
+        with self.lock:
+            dates = self.entries.setdefault(key, set())
+            if date.date() not in dates:
+                dates.add(date.date())
+                self.dirty = True
+
+    def contains(self, underline: str, expiry: dt, strike: float, right: str, date: dt) -> bool:
+        """
+        :return: whether the contract should be skipped on the date
+        """
+        with self.lock:
+            dates = self.entries.get((underline, expiry.strftime('%Y%m%d'), strike, right))
+            return dates is not None and any(dt.timedelta(0) <= date.date() - no_data_date <= self.max_age for no_data_date in dates)
+
+    def save(self):
+        """
+        Write the registry if anything was added since the last save
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            entry = {"version": CACHE_VERSION, "entries": self.entries}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                entry = pickle.load(f)
+            if entry.get("version") == CACHE_VERSION:
+                self.entries = entry["entries"]
+        except Exception as e:
+            logging.getLogger("IBLog").warning(f"Ignoring corrupted no data registry {self.path}: {e}")
@@ -0,0 +1,327 @@
+"""
+Compressed storage of bars files, for archiving. Every run of rows of a contract and side is cut into blocks, and
+each block is encoded on its own:
+- prices are quantized to integer ticks: the fewest decimals that reproduce every float32 price of the block exactly,
+  divided by their common step (5 for a 0.05 grid). Blocks with prices off any decimal grid keep raw float32 prices
+- time and close are delta encoded along the run, open, high and low are stored relative to the close of their bar
+- each stream is bit-packed with the width of its range
+- the block is compressed with zlib
+The index at the end of the file holds the key and the byte range of every block, so a reader decodes only the blocks
+of the contract it asks for. Decoding gives back exactly the rows of the bars file.
+Usage: python IBCodec.py compress|decompress|verify|info <file> [<file> ...] [--remove]
+"""
+import os
+import json
+import zlib
+import struct
+import argparse
+import numpy as np
+import datetime as dt
+
+from IBFormat import BarFile, write_header, finalize, get_index_fields, get_index_dtype, RIGHT_CODES, SIDE_CODES
+
+MAGIC = b'IBBARSZ\0'
+VERSION = 1
+# magic, version, header length, number of rows, index offset, number of index entries
+PREAMBLE = struct.Struct('<8sIIQQQ')
+# rows, first time, decimals of the prices (RAW_PRICES if they are raw float32), step of the prices in ticks, first close
+BLOCK_HEADER = struct.Struct('<QqBQq')
+# reference (minimum) and width in bits of a packed stream
+STREAM_HEADER = struct.Struct('<qB')
+RAW_PRICES = 255
+MAX_DECIMALS = 9
+PRICE_FIELDS = ['open', 'high', 'low', 'close']
+DEFAULT_BLOCK_ROWS = 16 * 1024
+DEFAULT_LEVEL = 6
+EXTENSION = ".ibz"
+
+
+def get_codec_index_dtype(dtype: np.dtype) -> np.dtype:
+    return np.dtype([(name, dtype[name]) for name in get_index_fields(dtype)] +
+                    [('start', '<i8'), ('stop', '<i8'), ('offset', '<u8'), ('length', '<u8')])
+
+
+def get_compressed_path(path: str) -> str:
+    return os.path.splitext(path)[0] + EXTENSION
+
+
+def pack_bits(values: np.ndarray) -> bytes:
+    """
+    :param values: int64 array
+    :return: the stream header and the values as offsets from their minimum, in as many bits as the largest needs
+    """
+    if not len(values):
+        return STREAM_HEADER.pack(0, 0)
+    reference = int(values.min())
+    offsets = (values - reference).astype(np.uint64)
+    width = int(offsets.max()).bit_length()
+    if not width:
+        return STREAM_HEADER.pack(reference, 0)
+    bits = ((offsets[:, None] >> np.arange(width, dtype=np.uint64)) & 1).astype(np.uint8)
+    return STREAM_HEADER.pack(reference, width) + np.packbits(bits, bitorder='little').tobytes()
+
+
+def unpack_bits(buffer: bytes, position: int, count: int) -> (np.ndarray, int):
+    """
+    :param buffer: the decompressed block
+    :param position: offset of the stream header in the buffer
+    :param count: number of values in the stream
+    :return: the values as int64, and the position right after the stream
+    """
+    reference, width = STREAM_HEADER.unpack_from(buffer, position)
+    position += STREAM_HEADER.size
+    if not width:
+        return np.full(count, reference, dtype=np.int64), position
+    length = -(-count * width // 8)
+    bits = np.unpackbits(np.frombuffer(buffer, dtype=np.uint8, count=length, offset=position), count=count * width, bitorder='little')
+    values = (bits.reshape(count, width).astype(np.uint64) << np.arange(width, dtype=np.uint64)).sum(axis=1)
+    return values.astype(np.int64) + reference, position + length
+
+
+def quantize(prices: np.ndarray) -> (int, int, np.ndarray):
+    """
+    :param prices: (number of price fields, rows) float32 array
+    :return: decimals, step and the prices as integer multiples of step / 10 ** decimals, decoding them gives back the
+    same float32 prices. decimals is RAW_PRICES if there is no such grid
+    """
+    if not np.isfinite(prices).all():
+        return RAW_PRICES, 1, None
+    values = prices.astype(np.float64)
+    for decimals in range(MAX_DECIMALS + 1):
+        ticks = np.round(values * 10 ** decimals)
+        if np.abs(ticks).max(initial=0) >= 2 ** 53:
+            break
+        if ((ticks / 10 ** decimals).astype(np.float32) == prices).all():
+            ticks = ticks.astype(np.int64)
+            step = int(np.gcd.reduce(ticks.ravel())) or 1
+            return decimals, step, ticks // step
+    return RAW_PRICES, 1, None
+
+
+def encode_block(rows: np.ndarray) -> bytes:
+    """
+    :param rows: rows of a single contract and side, sorted by time
+    :return: the encoded block, before compression
+    """
+    times = rows['time'].astype(np.int64)
+    prices = np.stack([rows[name] for name in PRICE_FIELDS])
+    decimals, step, ticks = quantize(prices)
+    first_close = int(ticks[3][0]) if decimals != RAW_PRICES and len(rows) else 0
+    parts = [BLOCK_HEADER.pack(len(rows), int(times[0]) if len(rows) else 0, decimals, step, first_close), pack_bits(np.diff(times))]
+    if decimals == RAW_PRICES:
+        parts.append(prices.astype('<f4').tobytes())
+    else:
+        close = ticks[3]
+        parts.append(pack_bits(np.diff(close)))
+        parts += [pack_bits(ticks[field] - close) for field in range(3)]
+    return b''.join(parts)
+
+
+def decode_block(buffer: bytes, dtype: np.dtype, key: dict) -> np.ndarray:
+    """
+    :param buffer: the decompressed block
+    :param dtype: dtype of the rows
+    :param key: values of the index fields of the block
+    :return: the rows of the block
+    """
+    count, first_time, decimals, step, first_close = BLOCK_HEADER.unpack_from(buffer)
+    rows = np.empty(count, dtype=dtype)
+    for name, value in key.items():
+        rows[name] = value
+    if not count:
+        return rows
+    deltas, position = unpack_bits(buffer, BLOCK_HEADER.size, count - 1)
+    rows['time'] = (first_time + np.concatenate([[0], np.cumsum(deltas)])).astype('<M8[s]')
+    if decimals == RAW_PRICES:
+        prices = np.frombuffer(buffer, dtype='<f4', count=4 * count, offset=position).reshape(4, count)
+        for field, name in enumerate(PRICE_FIELDS):
+            rows[name] = prices[field]
+        return rows
+    deltas, position = unpack_bits(buffer, position, count - 1)
+    close = first_close + np.concatenate([[0], np.cumsum(deltas)])
+    for name in PRICE_FIELDS[:3]:
+        offsets, position = unpack_bits(buffer, position, count)
+        rows[name] = ((close + offsets) * step / 10 ** decimals).astype(np.float32)
+    rows['close'] = (close * step / 10 ** decimals).astype(np.float32)
+    return rows
+
+
+def compress(path: str, output_path: str = None, block_rows: int = DEFAULT_BLOCK_ROWS, level: int = DEFAULT_LEVEL) -> str:
+    """
+    :param path: path of a finalized bars file
+    :param output_path: path of the compressed file, the same name with the .ibz extension by default
+    :param block_rows: maximal number of rows in a block
+    :param level: zlib compression level
+    :return: path of the compressed file
+    """
+    bars_file = BarFile(path)
+    if not bars_file.is_finalized:
+        raise Exception(f"{path} must be finalized before it's compressed")
+    dtype, index_fields = bars_file.dtype, bars_file.index_fields
+    if dtype['time'].kind != 'M' or sorted(dtype.names) != sorted(index_fields + ['time'] + PRICE_FIELDS):
+        raise Exception(f"{path} has an unsupported layout of bars")
+    output_path = output_path if output_path is not None else get_compressed_path(path)
+    header = {name: value for name, value in bars_file.header.items() if name not in ("dtype", "version")}
+    header = json.dumps({**header, "dtype": dtype.descr, "block_rows": block_rows, "compression": "zlib"}).encode()
+    index = []
+    with open(output_path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header), 0, 0, 0))
+        f.write(header)
+        for entry in bars_file.get_contracts():
+            for start in range(int(entry['start']), int(entry['stop']), block_rows):
+                stop = min(start + block_rows, int(entry['stop']))
+                block = zlib.compress(encode_block(bars_file.data[start:stop]), level)
+                index.append(tuple(entry[name] for name in index_fields) + (start, stop, f.tell(), len(block)))
+                f.write(block)
+        index_offset = f.tell()
+        f.write(np.array(index, dtype=get_codec_index_dtype(dtype)).tobytes())
+        f.seek(0)
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header), len(bars_file), index_offset, len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+    return output_path
+
+
+class CompressedBarFile:
+    """
+    Reader of compressed bars files, with the interface of BarFile. Only the blocks of the requested contract and side
+    are read and decoded.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path of the compressed file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, header_len, self.n_rows, index_offset, n_index = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise Exception(f"{path} is not a compressed bars file")
+            if version > VERSION:
+                raise Exception(f"Unsupported compressed bars file version {version}")
+            self.header = json.loads(f.read(header_len))
+            self.dtype = np.dtype([tuple(field) for field in self.header["dtype"]])
+            self.index_fields = self.header["index_fields"]
+            f.seek(index_offset)
+            self.index = np.frombuffer(f.read(n_index * get_codec_index_dtype(self.dtype).itemsize), dtype=get_codec_index_dtype(self.dtype))
+
+    def __len__(self):
+        return self.n_rows
+
+    def read_blocks(self, entries: np.ndarray) -> np.ndarray:
+        """
+        :param entries: index entries of the blocks
+        :return: the rows of all the blocks, in order
+        """
+        blocks = []
+        with open(self.path, 'rb') as f:
+            for entry in entries:
+                f.seek(int(entry['offset']))
+                buffer = zlib.decompress(f.read(int(entry['length'])))
+                blocks.append(decode_block(buffer, self.dtype, {name: entry[name] for name in self.index_fields}))
+        return np.concatenate(blocks) if blocks else np.empty(0, dtype=self.dtype)
+
+    def read_all(self) -> np.ndarray:
+        """
+        :return: all the rows, as they are in the bars file
+        """
+        return self.read_blocks(self.index)
+
+    def get_bars(self, strike: float = None, right=None, side=None, start_time=None, end_time=None) -> np.ndarray:
+        """
+        Get the bars of a single contract and side, optionally limited to a time window. See BarFile.get_bars
+        :return: the rows, sorted by time
+        """
+        key = {"strike": strike, "right": RIGHT_CODES.get(right, right), "side": SIDE_CODES.get(side, side)}
+        key = {name: key[name] for name in self.index_fields}
+        if None in key.values():
+            raise Exception(f"Must specify {', '.join(self.index_fields)}")
+        match = np.ones(len(self.index), dtype=bool)
+        for name, value in key.items():
+            match &= self.index[name] == value
+        bars = self.read_blocks(self.index[match])
+        first = 0 if start_time is None else np.searchsorted(bars['time'], np.datetime64(start_time, 's'), side='left')
+        last = len(bars) if end_time is None else np.searchsorted(bars['time'], np.datetime64(end_time, 's'), side='left')
+        return bars[first:last]
+
+    def get_contracts(self) -> np.ndarray:
+        """
+        :return: the key fields and row range of every contract and side, as the index of BarFile
+        """
+        is_new = np.ones(len(self.index), dtype=bool)
+        is_new[1:] = False
+        for name in self.index_fields:
+            is_new[1:] |= self.index[name][1:] != self.index[name][:-1]
+        starts = np.flatnonzero(is_new)
+        contracts = np.empty(len(starts), dtype=get_index_dtype(self.dtype))
+        for name in self.index_fields:
+            contracts[name] = self.index[name][starts]
+        contracts['start'] = self.index['start'][starts]
+        contracts['stop'] = self.index['stop'][np.append(starts[1:], len(self.index)) - 1]
+        return contracts
+
+
+def decompress(path: str, output_path: str = None) -> str:
+    """
+    :param path: path of a compressed bars file
+    :param output_path: path of the bars file, the same name with the .bin extension by default
+    :return: path of the bars file
+    """
+    compressed = CompressedBarFile(path)
+    output_path = output_path if output_path is not None else os.path.splitext(path)[0] + ".bin"
+    header = compressed.header
+    expiry = dt.datetime.strptime(header["expiry"], '%Y%m%d') if header.get("expiry") else None
+    with open(output_path, 'wb') as f:
+        write_header(f, compressed.dtype, header["sec_type"], header["asset"], dt.datetime.strptime(header["date"], '%Y%m%d'), expiry)
+        compressed.read_all().tofile(f)
+    finalize(output_path)
+    return output_path
+
+
+def verify(path: str) -> (int, int):
+    """
+    Compress a bars file to a temporary file and check that decoding it gives back exactly the same rows, as a whole
+    and contract by contract
+    :param path: path of a finalized bars file
+    :return: the sizes of the bars file and of the compressed file
+    """
+    temp_path = compress(path, f"{path}.verify{EXTENSION}")
+    try:
+        bars_file, compressed = BarFile(path), CompressedBarFile(temp_path)
+        if bars_file.data.tobytes() != compressed.read_all().tobytes():
+            raise Exception(f"{path}: decoded rows differ from the bars file")
+        for entry in bars_file.get_contracts():
+            key = {name: entry[name] for name in bars_file.index_fields}
+            if bars_file.get_bars(**key).tobytes() != compressed.get_bars(**key).tobytes():
+                raise Exception(f"{path}: decoded rows of {key} differ from the bars file")
+        return os.path.getsize(path), os.path.getsize(temp_path)
+    finally:
+        os.remove(temp_path)
+
+
+def main(args):
+    for path in args.paths:
+        if args.command == "compress":
+            output_path = compress(path)
+            print(f"{path}: {os.path.getsize(path)} -> {os.path.getsize(output_path)} bytes, {os.path.getsize(path) / os.path.getsize(output_path):.1f}x")
+            if args.remove:
+                os.remove(path)
+        elif args.command == "decompress":
+            output_path = decompress(path)
+            print(f"{path} -> {output_path}")
+            if args.remove:
+                os.remove(path)
+        elif args.command == "verify":
+            size, compressed_size = verify(path)
+            print(f"{path}: OK, {size} -> {compressed_size} bytes, {size / compressed_size:.1f}x")
+        elif args.command == "info":
+            compressed = CompressedBarFile(path)
+            print(f"{path}: {compressed.header['sec_type']} {compressed.header['asset']} {compressed.header['date']}, "
+                  f"{len(compressed)} bars, {len(compressed.get_contracts())} contracts and sides in {len(compressed.index)} blocks")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compressed storage of bars files")
+    parser.add_argument("command", choices=["compress", "decompress", "verify", "info"])
+    parser.add_argument("paths", nargs="+", help="bars files, or compressed files to decompress or describe")
+    parser.add_argument("--remove", action="store_true", help="remove the input files once they were converted")
+    main(parser.parse_args())
@@ -0,0 +1,214 @@
+"""
+End of day compaction of a day file into a columnar file. Bid and ask come from separate requests, so every bar of a
+contract is written as a row per side, in arrival order. Compaction joins the sides of each (strike, right, time) into a
+single row with an OHLC set per side, sorts the rows by strike, right and time, and stores every field as a contiguous
+column, so spreads and mid prices are plain arithmetic on two aligned columns:
+    day = ColumnFile(path)
+    calls = day.get_contract(strike=380, right='C')
+    mid = (calls['bid_close'] + calls['ask_close']) / 2
+A side a contract has no bar for at some time is NaN. Bars files (finalized or not), headerless legacy bin files and txt
+files of OPT, STK and FX are all accepted.
+Usage: python IBCompact.py <file> [<file> ...] [--sec-type OPT|STK|FX]
+"""
+import os
+import json
+import struct
+import argparse
+import numpy as np
+import datetime as dt
+
+from IBFormat import BarFile, is_bars_file, read_legacy, read_txt, upgrade_rows, RIGHT_CODES, SIDE_CODES
+from IBUtils import parse_output_file_name
+
+MAGIC = b'IBCOLS\0\0'
+VERSION = 1
+# magic, version, header length, data offset, number of rows
+PREAMBLE = struct.Struct('<8sIIQQ')
+DATA_ALIGNMENT = 64
+EXTENSION = ".col"
+PRICE_FIELDS = ['open', 'high', 'low', 'close']
+SIDE_PREFIXES = {SIDE_CODES['BID']: 'bid', SIDE_CODES['ASK']: 'ask', SIDE_CODES['BID_ASK']: 'bid_ask'}
+ROW_DTYPE = np.dtype([('time', '<M8[s]'), ('strike', '<f4'), ('right', '<f4'), ('side', '<f4'),
+                      ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+
+
+def get_compact_path(path: str) -> str:
+    return os.path.splitext(path)[0] + EXTENSION
+
+
+def read_rows(path: str, sec_type: str = None) -> (dict, np.ndarray, list):
+    """
+    :param path: path of a day file: a bars file, a legacy bin file or a txt file
+    :param sec_type: sec type of files without a header, inferred from their name and directory by default
+    :return: the header of the day (sec_type, asset, date, expiry), its bars as ROW_DTYPE and the key fields of a
+    contract, [] if the file is not options
+    """
+    if path.endswith(".txt") or not is_bars_file(path):
+        asset, name_sec_type, date = parse_output_file_name(path)
+        sec_type = sec_type or name_sec_type
+        header = {"sec_type": sec_type, "asset": asset, "date": date.strftime('%Y%m%d'), "expiry": None}
+        source = read_txt(path, sec_type, date) if path.endswith(".txt") else upgrade_rows(read_legacy(path, sec_type), date)
+    else:
+        bars_file = BarFile(path)
+        header = {name: bars_file.header[name] for name in ("sec_type", "asset", "date", "expiry")}
+        source = bars_file.data
+        if source.dtype['time'].kind != 'M':
+            source = upgrade_rows(source, dt.datetime.strptime(header["date"], '%Y%m%d'))
+    rows = np.zeros(len(source), dtype=ROW_DTYPE)
+    for name in ROW_DTYPE.names:
+        if name in source.dtype.names:
+            rows[name] = source[name]
+    key_fields = ['strike', 'right'] if 'strike' in source.dtype.names else []
+    return header, rows, key_fields
+
+
+def join_sides(rows: np.ndarray, key_fields: list) -> (dict, np.ndarray):
+    """
+    Join the rows of all the sides of the same contract and time into one row
+    :param rows: bars as ROW_DTYPE, in any order
+    :param key_fields: key fields of a contract, [] if there's a single contract
+    :return: the columns, by name: time, the key fields, and <side>_open ... <side>_close for every side in rows, and
+    the start of the rows of each contract
+    """
+    # sorted by contract, time and side, the last of the rows of the same contract, time and side is kept as finalize does
+    rows = rows[np.lexsort([rows['side'], rows['time']] + [rows[name] for name in reversed(key_fields)])]
+    is_last = np.ones(len(rows), dtype=bool)
+    if len(rows):
+        is_duplicate = np.ones(len(rows) - 1, dtype=bool)
+        for name in key_fields + ['time', 'side']:
+            is_duplicate &= rows[name][1:] == rows[name][:-1]
+        is_last[:-1] = ~is_duplicate
+    rows = rows[is_last]
+
+    is_new_time = np.ones(len(rows), dtype=bool)
+    is_new_time[1:] = False
+    for name in key_fields + ['time']:
+        is_new_time[1:] |= rows[name][1:] != rows[name][:-1]
+    is_new_contract = np.ones(len(rows), dtype=bool)
+    is_new_contract[1:] = False
+    for name in key_fields:
+        is_new_contract[1:] |= rows[name][1:] != rows[name][:-1]
+    positions = np.cumsum(is_new_time) - 1
+    firsts = np.flatnonzero(is_new_time)
+
+    columns = {name: rows[name][firsts] for name in ['time'] + key_fields}
+    for side in np.unique(rows['side']):
+        is_side = rows['side'] == side
+        for name in PRICE_FIELDS:
+            column = np.full(len(firsts), np.nan, dtype=rows.dtype[name])
+            column[positions[is_side]] = rows[name][is_side]
+            columns[f"{SIDE_PREFIXES.get(int(side), f'side{int(side)}')}_{name}"] = column
+    return columns, positions[is_new_contract]
+
+
+def write_columns(path: str, header: dict, columns: dict, contract_starts: np.ndarray, key_fields: list):
+    """
+    Write a columnar file: the preamble, a JSON header with the offset of every column, and the columns one after the
+    other, each aligned to DATA_ALIGNMENT
+    """
+    n_rows = len(columns['time'])
+    offsets, offset = {}, 0
+    for name, column in columns.items():
+        offsets[name] = offset
+        offset += -(-column.nbytes // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    stops = np.append(contract_starts[1:], n_rows) if n_rows else contract_starts
+    contracts = [[columns[name][start].item() for name in key_fields] + [int(start), int(stop)]
+                 for start, stop in zip(contract_starts, stops)]
+    header = json.dumps({**header, "key_fields": key_fields, "contracts": contracts,
+                         "columns": [[name, column.dtype.str, offsets[name]] for name, column in columns.items()]}).encode()
+    data_offset = -(-(PREAMBLE.size + len(header)) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    with open(path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header), data_offset, n_rows))
+        f.write(header.ljust(data_offset - PREAMBLE.size, b' '))
+        for name, column in columns.items():
+            f.seek(data_offset + offsets[name])
+            f.write(np.ascontiguousarray(column).tobytes())
+        f.truncate(data_offset + offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compact(path: str, output_path: str = None, sec_type: str = None) -> str:
+    """
+    :param path: path of a day file: a bars file, a legacy bin file or a txt file
+    :param output_path: path of the columnar file, the same name with the .col extension by default
+    :param sec_type: sec type of files without a header, inferred from their name and directory by default
+    :return: path of the columnar file
+    """
+    header, rows, key_fields = read_rows(path, sec_type)
+    columns, contract_starts = join_sides(rows, key_fields)
+    output_path = output_path if output_path is not None else get_compact_path(path)
+    write_columns(output_path, header, columns, contract_starts, key_fields)
+    return output_path
+
+
+class ColumnFile:
+    """
+    Reader of columnar files. Columns are memory mapped, selecting a contract returns views of them.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path of the columnar file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, header_len, data_offset, self.n_rows = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise Exception(f"{path} is not a columnar file")
+            if version > VERSION:
+                raise Exception(f"Unsupported columnar file version {version}")
+            self.header = json.loads(f.read(header_len))
+        self.key_fields = self.header["key_fields"]
+        self.columns = {name: np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=data_offset + offset, shape=(self.n_rows,))
+                        if self.n_rows else np.empty(0, dtype=np.dtype(dtype)) for name, dtype, offset in self.header["columns"]}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def get_contracts(self) -> list:
+        """
+        :return: list of the key fields and row range of every contract, as [strike, right, start, stop] (OPT) or
+        [start, stop]
+        """
+        return self.header["contracts"]
+
+    def get_contract(self, strike: float = None, right=None, start_time=None, end_time=None) -> dict:
+        """
+        Get the rows of a single contract, optionally limited to a time window
+        :param strike: strike of the option, OPT files only
+        :param right: 'C', 'P' or their codes, OPT files only
+        :param start_time: first time to include, datetime or datetime64
+        :param end_time: first time to exclude, datetime or datetime64
+        :return: views of all the columns, by name. Empty if the contract is not in the file
+        """
+        key = {"strike": strike, "right": RIGHT_CODES.get(right, right)}
+        key = [key[name] for name in self.key_fields]
+        if None in key:
+            raise Exception(f"Must specify {', '.join(self.key_fields)}")
+        start, stop = 0, 0
+        for *contract_key, contract_start, contract_stop in self.get_contracts():
+            if np.array_equal(np.float32(contract_key), np.float32(key)):
+                start, stop = contract_start, contract_stop
+                break
+        times = self.columns['time'][start:stop]
+        first = 0 if start_time is None else np.searchsorted(times, np.datetime64(start_time, 's'), side='left')
+        last = len(times) if end_time is None else np.searchsorted(times, np.datetime64(end_time, 's'), side='left')
+        return {name: column[start + first:start + last] for name, column in self.columns.items()}
+
+
+def main(args):
+    for path in args.paths:
+        output_path = compact(path, sec_type=args.sec_type)
+        column_file = ColumnFile(output_path)
+        print(f"{path} -> {output_path}: {len(column_file)} rows, {len(column_file.get_contracts())} contracts, "
+              f"columns {', '.join(column_file.columns)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact day files into columnar files, with the sides of each bar joined")
+    parser.add_argument("paths", nargs="+", help="bars files, legacy bin files or txt files")
+    parser.add_argument("--sec-type", default=None, help="sec type of files without a header, inferred from their name and directory by default")
+    main(parser.parse_args())
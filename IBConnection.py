@@ -0,0 +1,172 @@
+"""
+Management of the connection with TWS. Connecting waits for nextValidId, which TWS sends once the API is ready, instead
+of sleeping a fixed time. A monitor thread then watches the connection: once the socket is closed, the EReader or the
+message loop exit, or TWS reports it's not connected, it reconnects with an exponential backoff. Requests are never sent
+while the connection is down, senders block until it's back.
+When TWS loses its own connection to IB (1100) the socket stays open, sending is only paused until it's restored.
+"""
+import time
+import logging
+import threading
+from random import randint
+
+DEFAULT_CONNECT_TIMEOUT = 30
+RECONNECT_BACKOFF = 1
+MAX_RECONNECT_BACKOFF = 60
+HEALTH_CHECK_INTERVAL = 1
+
+# https://interactivebrokers.github.io/tws-api/message_codes.html
+CONNECT_FAILED = 502
+NOT_CONNECTED = 504
+CLIENT_ID_IN_USE = 326
+IB_CONNECTION_LOST = 1100
+IB_CONNECTION_RESTORED_DATA_LOST = 1101
+IB_CONNECTION_RESTORED_DATA_KEPT = 1102
+SOCKET_PORT_RESET = 1300
+CONNECTION_ERROR_CODES = [CONNECT_FAILED, NOT_CONNECTED, CLIENT_ID_IN_USE, IB_CONNECTION_LOST,
+                          IB_CONNECTION_RESTORED_DATA_LOST, IB_CONNECTION_RESTORED_DATA_KEPT, SOCKET_PORT_RESET]
+
+
+class ConnectionManager:
+    """
+    Keeps the app connected to TWS. Every time the connection is restored, after a reconnect or after TWS got its
+    connection to IB back, on_restored is called before anything can be sent again: whatever was in flight was lost.
+    """
+    def __init__(self, app, host: str, port: int, client_id: int, on_restored, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+        """
+        :param app: the IBapi object, its callbacks forward nextValidId, connectionClosed and the errors of
+        CONNECTION_ERROR_CODES to this object
+        :param host: host of TWS
+        :param port: API port of TWS
+        :param client_id: client id of the first connection, a new one is drawn if it's already in use
+        :param on_restored: called with True if live subscriptions were lost as well, False if TWS kept them
+        :param connect_timeout: seconds to wait for nextValidId on each connection attempt
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.on_restored = on_restored
+        self.connect_timeout = connect_timeout
+        self.connected = threading.Event()  # set while requests may be sent
+        self.ready = threading.Event()  # nextValidId of the current connection arrived
+        self.lost = threading.Event()  # the current connection is broken
+        self.closed = False
+        self.generation = 0  # number of times the connection was established or restored
+        self.next_order_id = None
+        self.message_loop = None
+        self.monitor = threading.Thread(target=self.run, daemon=True)
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connected.is_set()
+
+    def connect(self):
+        """
+        Connect and keep the connection from now on. Blocks until the first connection is ready.
+        """
+        self.monitor.start()
+        if not self.connected.wait(self.connect_timeout):
+            self.close()
+            raise Exception(f"Could not connect to TWS at {self.host}:{self.port} within {self.connect_timeout} seconds")
+
+    def wait_connected(self, timeout: float = None) -> bool:
+        """
+        Block until requests may be sent
+        :param timeout: maximal time to wait in seconds, None to wait forever
+        :return: True if connected
+        """
+        return self.connected.wait(timeout)
+
+    def close(self):
+        """
+        Disconnect for good, the connection is not restored anymore
+        """
+        self.closed = True
+        self.connected.clear()
+        self.lost.set()
+        self.app.disconnect()
+        if self.message_loop is not None and self.message_loop is not threading.current_thread():
+            self.message_loop.join()
+
+    def run(self):
+        backoff = RECONNECT_BACKOFF
+        while not self.closed:
+            if self.open_connection():
+                backoff = RECONNECT_BACKOFF
+                while not self.lost.wait(HEALTH_CHECK_INTERVAL) and self.is_healthy():
+                    continue
+                if self.closed:
+                    break
+                logging.getLogger("IBLog").warning("Connection with TWS lost, reconnecting")
+                self.app.metrics.inc("ib_disconnects_total")
+                self.drop_connection()
+            else:
+                logging.getLogger("IBLog").warning(f"Could not connect to TWS at {self.host}:{self.port}, retrying in {backoff} seconds")
+                self.drop_connection()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
+
+    def open_connection(self) -> bool:
+        """
+        Connect and wait for nextValidId. The message loop runs on its own thread, for as long as the connection lasts.
+        :return: True if the connection is ready
+        """
+        self.lost.clear()
+        self.ready.clear()
+        self.app.connect(self.host, self.port, self.client_id)
+        if not self.app.isConnected():
+            return False
+        self.message_loop = threading.Thread(target=self.app.run, daemon=True)
+        self.message_loop.start()
+        if not self.ready.wait(self.connect_timeout) or self.lost.is_set():
+            return False
+        if self.generation > 0:
+            self.app.metrics.inc("ib_reconnects_total")
+            self.on_restored(True)
+        self.generation += 1
+        logging.getLogger("IBLog").info(f"Connected to TWS at {self.host}:{self.port}, client id {self.client_id}, server version {self.app.serverVersion()}")
+        self.connected.set()
+        return True
+
+    def drop_connection(self):
+        """
+        Close what's left of a broken connection, and wait for its message loop to decode what it already received
+        """
+        self.connected.clear()
+        self.app.disconnect()
+        if self.message_loop is not None:
+            self.message_loop.join()
+            self.message_loop = None
+
+    def is_healthy(self) -> bool:
+        """
+        :return: False if the socket was closed or the EReader or the message loop exited
+        """
+        reader = self.app.reader
+        return self.app.isConnected() and reader is not None and reader.is_alive() and self.message_loop.is_alive()
+
+    def on_next_valid_id(self, order_id: int):
+        self.next_order_id = order_id
+        self.ready.set()
+
+    def on_connection_closed(self):
+        self.connected.clear()
+        self.lost.set()
+
+    def on_error(self, error_code: int, error_string: str):
+        """
+        An error of CONNECTION_ERROR_CODES, called on the message loop thread
+        """
+        if error_code == CLIENT_ID_IN_USE:
+            self.client_id = randint(100, 999)
+        elif error_code == NOT_CONNECTED and self.connected.is_set() and not self.app.isConnected():
+            # a request was sent on a connection that is gone, and it wasn't noticed yet
+            self.on_connection_closed()
+        elif error_code == IB_CONNECTION_LOST:
+            logging.getLogger("IBLog").warning("TWS lost its connection to IB, sending is paused until it's restored")
+            self.connected.clear()
+        elif error_code in [IB_CONNECTION_RESTORED_DATA_LOST, IB_CONNECTION_RESTORED_DATA_KEPT] and self.ready.is_set():
+            self.generation += 1
+            self.on_restored(error_code == IB_CONNECTION_RESTORED_DATA_LOST)
+            self.connected.set()
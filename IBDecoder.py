@@ -0,0 +1,68 @@
+"""
+Batch decoding of HISTORICAL_DATA messages. ibapi builds a BarData object and calls historicalData for every bar of a
+message, a 3600 seconds request of 5 secs bars is 720 callbacks. BatchDecoder decodes all the bars of a message into a
+single numpy structured array instead, a column at a time, and hands it to historicalDataBatch in one call.
+"""
+import numpy as np
+
+from ibapi.common import BarData
+from ibapi.decoder import Decoder, HandleInfo
+from ibapi.message import IN
+from ibapi.server_versions import MIN_SERVER_VER_SYNT_REALTIME_BARS
+from IBWriter import TIME_LENGTH
+
+# a bar as TWS sends it, date is kept as the bytes TWS sent
+HISTORICAL_BAR_DTYPE = np.dtype([('date', f'S{TIME_LENGTH}'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                                 ('close', '<f8'), ('volume', '<i8'), ('average', '<f8'), ('bar_count', '<i8')])
+
+
+def decode_historical_bars(fields: tuple, server_version: int) -> (int, str, str, np.ndarray):
+    """
+    :param fields: fields of a HISTORICAL_DATA message, as read from the socket
+    :param server_version: version of TWS, older versions send the message version and a hasGaps field per bar
+    :return: req_id, start and end of the request, and its bars as an array of HISTORICAL_BAR_DTYPE
+    """
+    first = 1 if server_version >= MIN_SERVER_VER_SYNT_REALTIME_BARS else 2
+    req_id = int(fields[first])
+    start, end = fields[first + 1].decode(), fields[first + 2].decode()
+    count = int(fields[first + 3])
+    items = fields[first + 4:]
+    # date, open, high, low, close, volume, average, [hasGaps], bar count
+    positions = [0, 1, 2, 3, 4, 5, 6, 7] if server_version >= MIN_SERVER_VER_SYNT_REALTIME_BARS else [0, 1, 2, 3, 4, 5, 6, 8]
+    step = positions[-1] + 1
+    bars = np.empty(count, dtype=HISTORICAL_BAR_DTYPE)
+    for name, position in zip(HISTORICAL_BAR_DTYPE.names, positions):
+        bars[name] = np.array(items[position:count * step:step], dtype=HISTORICAL_BAR_DTYPE[name])
+    return req_id, start, end, bars
+
+
+def to_bar_data(bars: np.ndarray) -> list:
+    """
+    :param bars: array of HISTORICAL_BAR_DTYPE
+    :return: the bars as ibapi BarData objects, for the callbacks that need them one by one
+    """
+    result = []
+    for date, bar_open, high, low, close, volume, average, bar_count in bars.tolist():
+        bar = BarData()
+        bar.date, bar.open, bar.high, bar.low, bar.close = date.decode(), bar_open, high, low, close
+        bar.volume, bar.average, bar.barCount = volume, average, bar_count
+        result.append(bar)
+    return result
+
+
+class BatchDecoder(Decoder):
+    """
+    ibapi Decoder that decodes HISTORICAL_DATA messages whole. The wrapper must implement
+    historicalDataBatch(req_id, bars), historicalDataEnd is called after it as usual. Any other message is decoded by
+    ibapi.
+    """
+    def __init__(self, wrapper, server_version: int):
+        super().__init__(wrapper, server_version)
+        # the handlers table is shared by all decoders, this one gets its own copy
+        self.msgId2handleInfo = dict(Decoder.msgId2handleInfo)
+        self.msgId2handleInfo[IN.HISTORICAL_DATA] = HandleInfo(proc=BatchDecoder.processHistoricalDataMsg)
+
+    def processHistoricalDataMsg(self, fields):
+        req_id, start, end, bars = decode_historical_bars(tuple(fields), self.serverVersion)
+        self.wrapper.historicalDataBatch(req_id, bars)
+        self.wrapper.historicalDataEnd(req_id, start, end)
@@ -0,0 +1,209 @@
+import os
+import pickle
+import logging
+import threading
+import numpy as np
+import datetime as dt
+
+from IBCache import CACHE_VERSION
+
+MONDAY, THURSDAY, FRIDAY = 0, 3, 4
+
+
+def get_weekdays(days: np.ndarray) -> np.ndarray:
+    """
+    :param days: datetime64[D] array
+    :return: the weekday of every day, Monday is 0. The epoch was a Thursday
+    """
+    return (days.astype(np.int64) + THURSDAY) % 7
+
+
+def is_third_week(days: np.ndarray) -> np.ndarray:
+    """
+    :return: True for the days whose week's Friday is the third Friday of its month
+    """
+    fridays = days + (FRIDAY - get_weekdays(days)).astype('m8[D]')
+    day_of_month = (fridays - fridays.astype('M8[M]').astype('M8[D]')).astype(np.int64) + 1
+    return (day_of_month >= 15) & (day_of_month <= 21)
+
+
+def get_nth_weekday(year: int, month: int, weekday: int, n: int) -> dt.date:
+    """
+    :param n: 1 for the first weekday of the month, -1 for the last one
+    """
+    if n > 0:
+        first = dt.date(year, month, 1)
+        return first + dt.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = dt.date(year + month // 12, month % 12 + 1, 1) - dt.timedelta(days=1)
+    return last - dt.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def get_easter(year: int) -> dt.date:
+    """
+    Gregorian Easter Sunday, by the anonymous Gregorian algorithm
+    """
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    return dt.date(year, month, (h + l - 7 * m + 33 * month + 19) % 32)
+
+
+def get_observed(holiday: dt.date) -> dt.date:
+    """
+    A holiday on Saturday is observed on Friday, a holiday on Sunday on Monday
+    """
+    if holiday.weekday() == 5:
+        return holiday - dt.timedelta(days=1)
+    if holiday.weekday() == 6:
+        return holiday + dt.timedelta(days=1)
+    return holiday
+
+
+def get_market_holidays(first_year: int, last_year: int) -> np.ndarray:
+    """
+    Full day holidays of the US equity markets by their rules. Unscheduled closures, like national days of mourning,
+    can't be derived, listed expiries cover them.
+    :return: sorted datetime64[D] array of the holidays from first_year to last_year, both included
+    """
+    holidays = []
+    for year in range(first_year, last_year + 1):
+        new_year = dt.date(year, 1, 1)
+        # New Year's Day on Saturday is not observed on the Friday before it
+        if new_year.weekday() != 5:
+            holidays.append(get_observed(new_year))
+        holidays += [get_nth_weekday(year, 1, MONDAY, 3), get_nth_weekday(year, 2, MONDAY, 3),
+                     get_easter(year) - dt.timedelta(days=2), get_nth_weekday(year, 5, MONDAY, -1),
+                     get_observed(dt.date(year, 7, 4)), get_nth_weekday(year, 9, MONDAY, 1),
+                     get_nth_weekday(year, 11, THURSDAY, 4), get_observed(dt.date(year, 12, 25))]
+        if year >= 2022:
+            holidays.append(get_observed(dt.date(year, 6, 19)))
+    return np.array(sorted(holidays), dtype='M8[D]')
+
+
+def derive_expiries(first_year: int, last_year: int, is_weekly: bool) -> np.ndarray:
+    """
+    Expiries by the rules of equity options: monthly options expire on the third Friday of the month, weekly options
+    on every Friday, and an expiry on a holiday moves to the business day before it
+    :return: sorted datetime64[D] array of the expiries from first_year to last_year, both included
+    """
+    days = np.arange(np.datetime64(f'{first_year}-01-01'), np.datetime64(f'{last_year + 1}-01-01'), dtype='M8[D]')
+    fridays = days[get_weekdays(days) == FRIDAY]
+    if not is_weekly:
+        fridays = fridays[is_third_week(fridays)]
+    return np.busday_offset(fridays, 0, roll='backward', holidays=get_market_holidays(first_year, last_year))
+
+
+def merge_listed(derived: np.ndarray, listed: np.ndarray, is_weekly: bool) -> np.ndarray:
+    """
+    Listed expiries replace the derived expiry of their week. Only the last listed expiry of a week is part of the weekly
+    or monthly series, and only if it's on Thursday or Friday: the daily series of some underlyings are not.
+    :param derived: derived expiries, see derive_expiries
+    :param listed: expiries listed by IB
+    :return: sorted datetime64[D] array of the expiries
+    """
+    listed = np.unique(listed)
+    listed_weeks = listed - get_weekdays(listed).astype('m8[D]')
+    is_last = np.append(listed_weeks[1:] != listed_weeks[:-1], True)
+    listed, listed_weeks = listed[is_last], listed_weeks[is_last]
+    is_series = np.isin(get_weekdays(listed), [THURSDAY, FRIDAY])
+    if not is_weekly:
+        is_series &= is_third_week(listed)
+    listed, listed_weeks = listed[is_series], listed_weeks[is_series]
+    derived_weeks = derived - get_weekdays(derived).astype('m8[D]')
+    return np.unique(np.concatenate([derived[~np.isin(derived_weeks, listed_weeks)], listed]))
+
+
+class ExpiryCalendar:
+    """
+    Expiries of the weekly and monthly options of every underlying, so the expiry of a date is found without any I/O.
+    A calendar is derived once per underlying and series, see derive_expiries, merged with the expiries IB listed for
+    the underlying if they were cached, and kept as a sorted array. It's extended when dates out of its years are
+    looked up.
+    IB only lists the expiries of series that didn't expire yet, so the listed expiries are an on-disk cache, fetched
+    again once they're older than max_age_days.
+    """
+    def __init__(self, cache_dir: str, max_age_days: float):
+        """
+        :param cache_dir: directory of the cache files
+        :param max_age_days: age in days after which the listed expiries of an underlying are fetched again
+        """
+        self.cache_dir = os.path.join(cache_dir, "expiries")
+        self.max_age = dt.timedelta(days=max_age_days)
+        self.calendars = {}  # (underline, is_weekly) -> (first year, last year, expiries)
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_expiries(self, underline: str, is_weekly: bool, first_year: int, last_year: int) -> np.ndarray:
+        """
+        :return: sorted datetime64[D] array of the expiries of the underlying, from first_year to last_year at least
+        """
+        key = (underline, is_weekly)
+        with self.lock:
+            if (calendar := self.calendars.get(key)) is not None:
+                if calendar[0] <= first_year and last_year <= calendar[1]:
+                    return calendar[2]
+                first_year, last_year = min(first_year, calendar[0]), max(last_year, calendar[1])
+            expiries = derive_expiries(first_year, last_year, is_weekly)
+            entry = self.load(underline)
+            if entry is not None:
+                expiries = merge_listed(expiries, np.array(entry["expirations"], dtype='M8[D]'), is_weekly)
+            self.calendars[key] = (first_year, last_year, expiries)
+            return expiries
+
+    def get_closest_expiries(self, underline: str, dates: list, is_weekly: bool) -> np.ndarray:
+        """
+        :param underline: the underline asset
+        :param dates: dates to look up, datetime or datetime64
+        :param is_weekly: weekly options or monthly
+        :return: datetime64[D] array of the closest expiry on or after every date
+        """
+        days = np.array([np.datetime64(date, 'D') for date in dates], dtype='M8[D]')
+        if not len(days):
+            return days
+        years = days.astype('M8[Y]').astype(np.int64) + 1970
+        # the expiry of the last days of a year might be in the next one
+        expiries = self.get_expiries(underline, is_weekly, int(years.min()), int(years.max()) + 1)
+        return expiries[np.searchsorted(expiries, days, side='left')]
+
+    def seed(self, underline: str, expirations):
+        """
+        Save the expiries IB listed for an underlying, as returned by reqSecDefOptParams
+        :param underline: the underline asset
+        :param expirations: the expiries, as YYYYMMDD
+        """
+        entry = {"version": CACHE_VERSION, "fetched": dt.datetime.now(),
+                 "expirations": sorted(dt.datetime.strptime(expiration, '%Y%m%d').strftime('%Y-%m-%d') for expiration in expirations)}
+        with self.lock:
+            tmp_path = self.get_path(underline) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.get_path(underline))
+            for key in [key for key in self.calendars if key[0] == underline]:
+                del self.calendars[key]
+
+    def is_listed_stale(self, underline: str) -> bool:
+        """
+        :return: True if the listed expiries of the underlying were never fetched, or are older than max_age_days
+        """
+        with self.lock:
+            entry = self.load(underline)
+        return entry is None or dt.datetime.now() - entry["fetched"] >= self.max_age
+
+    def load(self, underline: str) -> dict:
+        if not os.path.exists(path := self.get_path(underline)):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            return entry if entry.get("version") == CACHE_VERSION else None
+        except Exception as e:
+            logging.getLogger("IBLog").warning(f"Ignoring corrupted expiries file {path}: {e}")
+            return None
+
+    def get_path(self, underline: str) -> str:
+        return os.path.join(self.cache_dir, f"{underline}.pickle")
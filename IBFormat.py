@@ -0,0 +1,286 @@
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b'IBBARS\0\0'
+VERSION = 2  # 1: time is HHMMSS as float32, 2: time is datetime64[s]
+# magic, version, header length, data offset, number of rows, index offset, number of index entries
+PREAMBLE = struct.Struct('<8sIIQQQQ')
+DATA_ALIGNMENT = 64
+
+RIGHT_CODES = {'C': 1, 'P': 0}
+SIDE_CODES = {'ASK': 1, 'S': 1, 'BID': 0, 'B': 0, 'BID_ASK': 2, 'BA': 2}
+
+
+def get_index_fields(dtype: np.dtype) -> list:
+    """
+    Rows are grouped by these fields, and the index holds a row range for every distinct combination of them.
+    OPT files are indexed by (strike, right, side), STK and FX files only by side.
+    """
+    return [name for name in ('strike', 'right', 'side') if name in dtype.names]
+
+
+def get_index_dtype(dtype: np.dtype) -> np.dtype:
+    return np.dtype([(name, dtype[name]) for name in get_index_fields(dtype)] + [('start', '<i8'), ('stop', '<i8')])
+
+
+def write_header(output_file, dtype: np.dtype, sec_type: str, asset: str, date, expiry=None):
+    """
+    Write the header of a new bars file. Rows are appended right after it, and finalize() adds the index once the
+    file is complete.
+    :param output_file: file object opened for binary writing, positioned at its beginning
+    :param dtype: dtype of the rows
+    :param sec_type: OPT, STK or FX
+    :param asset: the asset of the data
+    :param date: date of the data
+    :param expiry: expiry of the options, if relevant
+    """
+    header = json.dumps({"sec_type": sec_type, "asset": asset, "date": date.strftime('%Y%m%d'),
+                         "expiry": expiry.strftime('%Y%m%d') if expiry is not None else None,
+                         "dtype": dtype.descr, "index_fields": get_index_fields(dtype)}).encode()
+    data_offset = -(-(PREAMBLE.size + len(header)) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    output_file.write(PREAMBLE.pack(MAGIC, VERSION, len(header), data_offset, 0, 0, 0))
+    output_file.write(header.ljust(data_offset - PREAMBLE.size, b' '))
+
+
+def read_preamble(input_file) -> (dict, int, int, int, int):
+    """
+    :param input_file: file object opened for binary reading
+    :return: header, data offset, number of rows, index offset and number of index entries
+    """
+    input_file.seek(0)
+    magic, version, header_len, data_offset, n_rows, index_offset, n_index = PREAMBLE.unpack(input_file.read(PREAMBLE.size))
+    if magic != MAGIC:
+        raise Exception("Not a bars file")
+    if version > VERSION:
+        raise Exception(f"Unsupported bars file version {version}")
+    header = json.loads(input_file.read(header_len))
+    header["dtype"] = np.dtype([tuple(field) for field in header["dtype"]])
+    header["version"] = version
+    return header, data_offset, n_rows, index_offset, n_index
+
+
+def get_file_dtype(path: str) -> np.dtype:
+    """
+    :return: dtype of the rows of a bars file, None if it's not a bars file or its header is incomplete
+    """
+    try:
+        with open(path, 'rb') as f:
+            return read_preamble(f)[0]["dtype"]
+    except Exception:
+        return None
+
+
+def is_bars_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def finalize(path: str):
+    """
+    Rows are written in arrival order, interleaved between contracts. Sort them by contract, side and time, and write
+    the index of row ranges after them, so readers can map only the rows they need.
+    Rows of the same contract, side and time appear twice when a resumed run fetched a request again, only the last
+    one of them is kept.
+    :param path: path of the bars file
+    """
+    with open(path, 'r+b') as f:
+        header, data_offset, n_rows, index_offset, n_index = read_preamble(f)
+        dtype = header["dtype"]
+        data_end = index_offset if index_offset else os.path.getsize(path)
+        n_rows = (data_end - data_offset) // dtype.itemsize
+        index_fields = header["index_fields"]
+        if n_rows:
+            data = np.memmap(f, dtype=dtype, mode='r+', offset=data_offset, shape=(n_rows,))
+            rows = data[np.lexsort([data['time']] + [data[name] for name in reversed(index_fields)])]
+            is_duplicate = np.ones(n_rows - 1, dtype=bool)
+            for name in index_fields + ['time']:
+                is_duplicate &= rows[name][1:] == rows[name][:-1]
+            if is_duplicate.any():
+                rows = rows[np.append(~is_duplicate, True)]
+            n_rows = len(rows)
+            data[:n_rows] = rows
+            del rows
+            data.flush()
+            data = data[:n_rows]
+            is_new_run = np.zeros(n_rows, dtype=bool)
+            is_new_run[0] = True
+            for name in index_fields:
+                is_new_run[1:] |= data[name][1:] != data[name][:-1]
+            starts = np.flatnonzero(is_new_run)
+            index = np.empty(len(starts), dtype=get_index_dtype(dtype))
+            for name in index_fields:
+                index[name] = data[name][starts]
+            del data
+            index['start'] = starts
+            index['stop'] = np.append(starts[1:], n_rows)
+        else:
+            index = np.empty(0, dtype=get_index_dtype(dtype))
+        index_offset = data_offset + n_rows * dtype.itemsize
+        f.truncate(index_offset)
+        f.seek(index_offset)
+        f.write(index.tobytes())
+        update_preamble(f, n_rows, index_offset, len(index))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def prepare_append(output_file):
+    """
+    Reopen a bars file for appending more rows: drop the index if the file was finalized, or the partially written
+    last row if it wasn't, and position the file at the end of the rows.
+    :param output_file: file object of an existing bars file, opened for binary reading and writing
+    """
+    header, data_offset, n_rows, index_offset, n_index = read_preamble(output_file)
+    data_end = index_offset if index_offset else output_file.seek(0, os.SEEK_END)
+    data_end -= (data_end - data_offset) % header["dtype"].itemsize
+    output_file.truncate(data_end)
+    update_preamble(output_file, 0, 0, 0)
+    output_file.seek(data_end)
+
+
+def update_preamble(output_file, n_rows: int, index_offset: int, n_index: int):
+    """
+    Update the rows count and index location of a bars file
+    """
+    output_file.seek(0)
+    magic, version, header_len, data_offset = PREAMBLE.unpack(output_file.read(PREAMBLE.size))[:4]
+    output_file.seek(0)
+    output_file.write(PREAMBLE.pack(magic, version, header_len, data_offset, n_rows, index_offset, n_index))
+
+
+class BarFile:
+    """
+    Reader of bars files. Rows are memory mapped, so selecting a contract, side and time window returns a view of the
+    file without reading anything else.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path of the bars file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, data_offset, n_rows, index_offset, n_index = read_preamble(f)
+        self.dtype = self.header["dtype"]
+        self.index_fields = self.header["index_fields"]
+        self.is_finalized = index_offset != 0
+        if not self.is_finalized:
+            # the file was not closed properly, take all the rows that were completely written
+            n_rows = (os.path.getsize(path) - data_offset) // self.dtype.itemsize
+        self.data = np.memmap(path, dtype=self.dtype, mode='r', offset=data_offset, shape=(n_rows,)) if n_rows else np.empty(0, dtype=self.dtype)
+        self.index = np.memmap(path, dtype=get_index_dtype(self.dtype), mode='r', offset=index_offset, shape=(n_index,)) if n_index else np.empty(0, dtype=get_index_dtype(self.dtype))
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_bars(self, strike: float = None, right=None, side=None, start_time=None, end_time=None) -> np.ndarray:
+        """
+        Get the bars of a single contract and side, optionally limited to a time window.
+        :param strike: strike of the option, OPT files only
+        :param right: 'C', 'P' or their codes, OPT files only
+        :param side: 'ASK', 'BID', 'BID_ASK' or their codes
+        :param start_time: first time to include, datetime or datetime64 (HHMMSS on version 1 files)
+        :param end_time: first time to exclude, datetime or datetime64 (HHMMSS on version 1 files)
+        :return: zero-copy view of the rows, sorted by time. On files that were not finalized a filtered copy is returned
+        """
+        key = {"strike": strike, "right": RIGHT_CODES.get(right, right), "side": SIDE_CODES.get(side, side)}
+        key = {name: key[name] for name in self.index_fields}
+        if None in key.values():
+            raise Exception(f"Must specify {', '.join(self.index_fields)}")
+        if not self.is_finalized:
+            mask = np.ones(len(self.data), dtype=bool)
+            for name, value in key.items():
+                mask &= self.data[name] == value
+            bars = self.data[mask]
+            bars = bars[np.argsort(bars['time'], kind='stable')]
+        else:
+            match = np.ones(len(self.index), dtype=bool)
+            for name, value in key.items():
+                match &= self.index[name] == value
+            if not match.any():
+                return self.data[:0]
+            entry = self.index[np.flatnonzero(match)[0]]
+            bars = self.data[entry['start']:entry['stop']]
+        times = bars['time']
+        if times.dtype.kind == 'M':
+            start_time = None if start_time is None else np.datetime64(start_time, 's')
+            end_time = None if end_time is None else np.datetime64(end_time, 's')
+        first = 0 if start_time is None else np.searchsorted(times, start_time, side='left')
+        last = len(bars) if end_time is None else np.searchsorted(times, end_time, side='left')
+        return bars[first:last]
+
+    def get_contracts(self) -> np.ndarray:
+        """
+        :return: the index, with the key fields and row range of every contract and side in the file
+        """
+        return self.index
+
+
+def read_legacy(path: str, sec_type: str) -> np.ndarray:
+    """
+    Read a headerless bin file written before the bars file format existed
+    :param path: path of the file
+    :param sec_type: OPT, STK or FX, decides the number of columns
+    :return: all the rows of the file
+    """
+    from IBWriter import LEGACY_OPT_BAR_DTYPE, LEGACY_BAR_DTYPE
+    return np.fromfile(path, dtype=LEGACY_OPT_BAR_DTYPE if sec_type == 'OPT' else LEGACY_BAR_DTYPE)
+
+
+def hhmmss_to_time(date, hhmmss: np.ndarray) -> np.ndarray:
+    """
+    :param date: date of the bars
+    :param hhmmss: times of the bars as HHMMSS numbers, as in txt and legacy files
+    :return: the times as datetime64[s]
+    """
+    hhmmss = np.round(hhmmss.astype(np.float64)).astype(np.int64)
+    seconds = hhmmss // 10000 * 3600 + hhmmss // 100 % 100 * 60 + hhmmss % 100
+    return np.datetime64(date.strftime('%Y-%m-%d'), 's') + seconds.astype('m8[s]')
+
+
+def upgrade_rows(rows: np.ndarray, date) -> np.ndarray:
+    """
+    :param rows: rows of a legacy layout, with time as HHMMSS
+    :param date: date of the rows
+    :return: the rows in the current layout, OPT_BAR_DTYPE or BAR_DTYPE
+    """
+    from IBWriter import OPT_BAR_DTYPE, BAR_DTYPE
+    upgraded = np.empty(len(rows), dtype=OPT_BAR_DTYPE if 'strike' in rows.dtype.names else BAR_DTYPE)
+    upgraded['time'] = hhmmss_to_time(date, rows['time'])
+    for name in upgraded.dtype.names[1:]:
+        upgraded[name] = rows[name]
+    return upgraded
+
+
+def read_txt(path: str, sec_type: str, date) -> np.ndarray:
+    """
+    Read a txt output file without going over it line by line: the whole file is split into fields at once, and each
+    column is converted by numpy
+    :param path: path of the file
+    :param sec_type: OPT, STK or FX, decides the number of columns
+    :param date: date of the bars, lines only hold their time as HHMMSS
+    :return: all the rows of the file, as OPT_BAR_DTYPE or BAR_DTYPE
+    """
+    from IBWriter import OPT_BAR_DTYPE, BAR_DTYPE
+    dtype = OPT_BAR_DTYPE if sec_type == 'OPT' else BAR_DTYPE
+    with open(path, 'rb') as f:
+        content = f.read().replace(b'\r', b'').strip()
+    fields = content.replace(b'\n', b',').split(b',') if content else []
+    if len(fields) % len(dtype.names):
+        raise Exception(f"{path} doesn't have {len(dtype.names)} fields in every line, is it {sec_type}?")
+    columns = np.array(fields, dtype=bytes).reshape(-1, len(dtype.names))
+    rows = np.empty(len(columns), dtype=dtype)
+    rows['time'] = hhmmss_to_time(date, columns[:, 0])
+    for position, name in enumerate(dtype.names[1:], 1):
+        if name in ('right', 'side'):
+            codes = RIGHT_CODES if name == 'right' else SIDE_CODES
+            rows[name] = np.nan
+            for text, code in codes.items():
+                rows[name][columns[:, position] == text.encode()] = code
+            if np.isnan(rows[name]).any():
+                raise Exception(f"{path} has unknown {name} values")
+        else:
+            # through float64, as np.float32(str) does
+            rows[name] = columns[:, position].astype(np.float64).astype(np.float32)
+    return rows
@@ -0,0 +1,179 @@
+"""
+Verification of the bars files of a day: every contract and side should have exactly one bar in each slot of the
+session. Duplicates are dropped in place, and the missing slots are fetched again with as few requests as possible.
+Usage: python IBGaps.py <file.bin> [--start-time 0930] [--end-time 1600] [--shift-hours 0] [--sides ASK,BID]
+"""
+import os
+import logging
+import argparse
+import numpy as np
+import datetime as dt
+
+from IBApp import DataRequest, DayJob
+from IBFormat import BarFile, finalize, SIDE_CODES, RIGHT_CODES
+from IBPlanner import BAR_SIZE, MAX_DURATIONS
+from IBUtils import Config
+
+SIDE_NAMES = {code: side for side, code in SIDE_CODES.items() if len(side) > 2}
+RIGHT_NAMES = {code: right for right, code in RIGHT_CODES.items()}
+
+
+def get_session_slots(date: dt, start_time: dt, end_time: dt, shift_hours: int = 0, bar_size: int = BAR_SIZE) -> np.ndarray:
+    """
+    :return: the start times of all the bars of the session, as they are written to the bars file
+    """
+    start = np.datetime64(date.replace(hour=start_time.hour, minute=start_time.minute, second=0), 's') - np.timedelta64(shift_hours, 'h')
+    end = np.datetime64(date.replace(hour=end_time.hour, minute=end_time.minute, second=0), 's') - np.timedelta64(shift_hours, 'h')
+    return np.arange(start, end, np.timedelta64(bar_size, 's'))
+
+
+def get_gap_ranges(missing: np.ndarray, bar_size: int = BAR_SIZE) -> list:
+    """
+    :param missing: sorted start times of the missing bars
+    :return: list of (start, end) of each run of consecutive missing bars
+    """
+    if not len(missing):
+        return []
+    breaks = np.flatnonzero(np.diff(missing) != np.timedelta64(bar_size, 's')) + 1
+    starts = np.append(0, breaks)
+    stops = np.append(breaks, len(missing))
+    return [(missing[start], missing[stop - 1] + np.timedelta64(bar_size, 's')) for start, stop in zip(starts, stops)]
+
+
+def get_expected_keys(contracts: np.ndarray, index_fields: list, sides: list) -> list:
+    """
+    Every contract in the file is expected with all the sides of what_to_show, even if one of them has no bars at all.
+    Contracts without any bar are not in the file, so they can't be verified.
+    :param contracts: the index of the bars file
+    :param index_fields: key fields of the index
+    :param sides: codes of the expected sides
+    :return: list of the key of every expected contract and side, as dicts
+    """
+    contract_fields = [name for name in index_fields if name != 'side']
+    keys = {tuple(entry[name].item() for name in contract_fields) for entry in contracts}
+    return [dict(zip(contract_fields, key), side=side) for key in sorted(keys) for side in sides]
+
+
+def has_duplicates(bars_file: BarFile) -> bool:
+    """
+    :return: True if any contract and side has two bars of the same time. Rows of finalized files are sorted by
+    contract, side and time, so duplicates are adjacent
+    """
+    data = bars_file.data
+    is_duplicate = np.ones(max(len(data) - 1, 0), dtype=bool)
+    for name in bars_file.index_fields + ['time']:
+        is_duplicate &= data[name][1:] == data[name][:-1]
+    return bool(is_duplicate.any())
+
+
+def scan_day(path: str, slots: np.ndarray, sides: list) -> (int, list):
+    """
+    Find the duplicate and the missing bars of a bars file. Duplicates are dropped in place: finalizing the file keeps a
+    single bar per contract, side and time.
+    :param path: path of the bars file
+    :param slots: start times of all the bars of the session, see get_session_slots
+    :param sides: codes of the sides of what_to_show
+    :return: number of duplicate bars that were dropped, and a list of (key, gap ranges) of every contract and side
+    that has missing bars
+    """
+    bars_file = BarFile(path)
+    rows = len(bars_file)
+    if not bars_file.is_finalized or has_duplicates(bars_file):
+        del bars_file
+        finalize(path)
+        bars_file = BarFile(path)
+    duplicates = rows - len(bars_file)
+    gaps = []
+    for key in get_expected_keys(bars_file.get_contracts(), bars_file.index_fields, sides):
+        times = bars_file.get_bars(**key)['time']
+        missing = slots[~np.isin(slots, times)]
+        if len(missing):
+            gaps.append((key, get_gap_ranges(missing)))
+    return duplicates, gaps
+
+
+def plan_refetch(gap_ranges: list, bar_size: int = BAR_SIZE) -> list:
+    """
+    Cover the gaps of a single contract and side with the fewest request windows: a window starts at the first missing
+    bar that is not covered yet, takes every gap that starts within the longest duration IB allows, and ends with the
+    last of them. Windows are aligned to whole minutes, bars that are fetched twice are dropped when the file is
+    finalized.
+    :param gap_ranges: sorted (start, end) of the gaps, see get_gap_ranges
+    :return: list of (end time, duration in minutes) of the windows
+    """
+    max_duration = np.timedelta64(MAX_DURATIONS[bar_size] // 60 * 60, 's')
+    minute = np.timedelta64(60, 's')
+    windows = []  # [start, end] of each window
+    for start, end in gap_ranges:
+        while start < end:
+            if not windows or start >= windows[-1][0] + max_duration:
+                windows.append([start.astype('M8[m]').astype('M8[s]'), start])
+            windows[-1][1] = min(end, windows[-1][0] + max_duration)
+            start = windows[-1][1]
+    windows = [(start, (end + minute - np.timedelta64(1, 's')).astype('M8[m]').astype('M8[s]')) for start, end in windows]
+    return [(end.astype(dt.datetime), int((end - start) // minute)) for start, end in windows]
+
+
+def verify_day(app, config: Config, day_job: DayJob, pool=None) -> DayJob:
+    """
+    The verification stage of a day that was collected: drop its duplicate bars, and send the requests of its missing
+    bars. The file of the day is reopened for appending, and finalized again once these requests end.
+    :param app: the IBapi object, connected
+    :param config: config params
+    :param day_job: the day, after it was closed
+    :param pool: the IBPool the requests are spread over, None to send them through app
+    :return: the DayJob of the requests that fill the gaps, done once they end. None if nothing is missing
+    """
+    if config.output_type != "bin" or not os.path.exists(day_job.file_name):
+        return None
+    sides = [SIDE_CODES[what_to_show] for what_to_show in config.what_to_show]
+    slots = get_session_slots(day_job.date, config.start_time, config.end_time, config.shift_hours)
+    duplicates, gaps = scan_day(day_job.file_name, slots, sides)
+    missing = sum(int((end - start) // np.timedelta64(BAR_SIZE, 's')) for _, gap_ranges in gaps for start, end in gap_ranges)
+    logging.getLogger("IBLog").info(f"{day_job.file_name}: {duplicates} duplicate bars dropped, {missing} bars missing in {len(gaps)} contracts and sides")
+    app.metrics.inc("ib_duplicate_bars_total", duplicates)
+    app.metrics.inc("ib_missing_bars_total", missing)
+    if not gaps:
+        return None
+
+    # the keys of the file hold the strike as float32 and the right as its code
+    if day_job.option_chain_data is not None:
+        contracts = {(float(np.float32(strike)), RIGHT_CODES[right]): contract
+                     for strike, rights in day_job.option_chain_data.all_contracts.items() for right, contract in rights.items()}
+    else:
+        contracts = {(): app.get_wanted_contracts(day_job)[0]}
+    refetch_job = DayJob(day_job.asset, day_job.date, day_job.file_name)
+    refetch_job.option_chain_data = day_job.option_chain_data
+    app.start_day(refetch_job)
+    shift = dt.timedelta(hours=config.shift_hours)
+    for key, gap_ranges in gaps:
+        if (contract := contracts.get(tuple(value for name, value in key.items() if name != 'side'))) is None:
+            continue
+        for query_time, minutes in plan_refetch(gap_ranges):
+            (pool or app).send_historical_data_request(DataRequest(contract, query_time + shift, minutes, SIDE_NAMES[key["side"]], refetch_job))
+    app.end_day(refetch_job)
+    return refetch_job
+
+
+def main(args):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    bars_file = BarFile(args.path)
+    date = dt.datetime.strptime(bars_file.header["date"], '%Y%m%d')
+    del bars_file
+    slots = get_session_slots(date, dt.datetime.strptime(args.start_time, '%H%M'), dt.datetime.strptime(args.end_time, '%H%M'), args.shift_hours)
+    duplicates, gaps = scan_day(args.path, slots, [SIDE_CODES[side.strip().upper()] for side in args.sides.split(',')])
+    print(f"{duplicates} duplicate bars dropped")
+    for key, gap_ranges in gaps:
+        windows = plan_refetch(gap_ranges)
+        print(f"{key}: {len(gap_ranges)} gaps, {sum(int((end - start) // np.timedelta64(BAR_SIZE, 's')) for start, end in gap_ranges)} bars missing, "
+              f"{len(windows)} requests: " + ', '.join(f"{end.strftime('%H:%M')}/{minutes}m" for end, minutes in windows))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find duplicate and missing bars in a bars file")
+    parser.add_argument("path", help="path of the bars file")
+    parser.add_argument("--start-time", default="0930")
+    parser.add_argument("--end-time", default="1600")
+    parser.add_argument("--shift-hours", type=int, default=0)
+    parser.add_argument("--sides", default="ASK,BID")
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+import os
+import threading
+
+DAY_COMPLETE = "DAY_COMPLETE"
+DAY_INCOMPLETE = "DAY_INCOMPLETE"
+
+
+def get_journal_key(data_request) -> str:
+    """
+    :return: a line identifying the request: asset, date, expiry, strike, right, query time, interval and side
+    """
+    contract = data_request.contract
+    return f"{contract.symbol},{data_request.query_time.strftime('%Y%m%d')},{contract.lastTradeDateOrContractMonth}," \
+           f"{contract.strike},{contract.right},{data_request.query_time.strftime('%H:%M:%S')}," \
+           f"{data_request.interval_size},{data_request.bid_or_ask}"
+
+
+def is_day_complete(path: str) -> bool:
+    """
+    :param path: path of a journal file
+    :return: True if the journal marks its day as complete
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        f.seek(max(f.seek(0, os.SEEK_END) - len(DAY_COMPLETE) - 1, 0))
+        return f.read() == f"{DAY_COMPLETE}\n".encode()
+
+
+class RequestJournal:
+    """
+    Append-only journal of the requests that completed for a single output file, kept beside it.
+    A request is journaled only after all its bars were written to the output file, so when a run dies we can resume
+    it by sending only the requests that are missing from the journal.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path of the journal file. Completed requests of a previous run are loaded from it if it exists
+        """
+        self.path = path
+        self.completed = set()
+        self.is_day_complete = False
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                lines = f.read().split(b'\n')
+                # the last line is either empty or partially written by a run that died, drop it from the file
+                f.truncate(f.tell() - len(lines[-1]))
+            for line in (line.decode() for line in lines[:-1]):
+                if line in (DAY_COMPLETE, DAY_INCOMPLETE):
+                    self.is_day_complete = line == DAY_COMPLETE
+                else:
+                    self.completed.add(line)
+        self.journal_file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.completed)
+
+    def is_done(self, data_request) -> bool:
+        return get_journal_key(data_request) in self.completed
+
+    def record(self, data_request):
+        """
+        Mark a request as completed
+        :param data_request: the completed request
+        """
+        self.append(get_journal_key(data_request))
+
+    def record_day_complete(self):
+        """
+        Mark that all the requests of the day completed, and the output file was closed
+        """
+        self.append(DAY_COMPLETE)
+        self.is_day_complete = True
+
+    def record_day_incomplete(self):
+        """
+        Revoke the mark of a complete day, when requests that were sent to it later were given up on
+        """
+        self.append(DAY_INCOMPLETE)
+        self.is_day_complete = False
+
+    def append(self, line: str):
+        with self.lock:
+            if line not in (DAY_COMPLETE, DAY_INCOMPLETE):
+                self.completed.add(line)
+            self.journal_file.write(f"{line}\n")
+            self.journal_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.journal_file.close()
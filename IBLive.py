@@ -0,0 +1,260 @@
+import time
+import logging
+import threading
+import numpy as np
+import datetime as dt
+
+from ibapi.common import BarData
+from IBApp import DataRequest, OPT
+from IBUtils import get_req_id, Config
+from IBRequests import is_retryable_error
+from IBWriter import DEFAULT_FLUSH_INTERVAL
+from Utils import take_closest
+
+DEFAULT_RING_SIZE = 64 * 1024
+RESUBSCRIBE_DELAY = 60  # seconds before a subscription that failed on a retryable error is sent again
+LIVE_SIDES = {"ASK": ["ASK"], "BID": ["BID"], "BID_ASK": ["BID", "ASK"]}  # real time bars have no BID_ASK
+
+
+class RingBuffer:
+    """
+    Preallocated ring of the latest bars, as records of the bars dtype. A single writer puts records, and any number of
+    readers follow it by the sequence number of the next record they want. Putting a record allocates nothing, so the
+    EReader thread is never delayed by it.
+    """
+    def __init__(self, dtype: np.dtype, capacity: int = DEFAULT_RING_SIZE):
+        """
+        :param dtype: dtype of a record
+        :param capacity: number of records kept
+        """
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def put(self, record: tuple):
+        """
+        :param record: tuple matching the dtype
+        """
+        with self.lock:
+            self.buffer[self.seq % self.capacity] = record
+            self.seq += 1
+
+    def read(self, since: int) -> (np.ndarray, int, int):
+        """
+        :param since: sequence number of the first record wanted
+        :return: copy of the records from since up to the last one put, the sequence number to read from next time, and
+        the number of records that were overwritten before they were read
+        """
+        with self.lock:
+            lost = max(self.seq - self.capacity - since, 0)
+            return self.buffer.take(np.arange(since + lost, self.seq), mode='wrap'), self.seq, lost
+
+    def get_latest(self, count: int) -> np.ndarray:
+        """
+        :return: copy of the last count records, oldest first
+        """
+        with self.lock:
+            return self.buffer.take(np.arange(max(self.seq - min(count, self.capacity), 0), self.seq), mode='wrap')
+
+
+class LiveSession:
+    """
+    Collects a single asset live, until the end time of the day. Real time bars of the contracts get_wanted_contracts
+    produces are put into a ring buffer on the EReader thread, and a persister thread writes them to the file of the
+    day, in the same binary format as historical data.
+    For options the underline price is streamed, and once it moves to another ATM strike the subscriptions are diffed
+    against the strikes around the new ATM: only contracts that left the range are cancelled, and only contracts that
+    entered it are subscribed, closest to ATM first. At most max_live_lines subscriptions are open at the same time.
+    Bar times are the local time of this machine, as the times of historical bars are the local time of TWS.
+    """
+    def __init__(self, app, config: Config, day_job):
+        """
+        :param app: the IBapi object, connected
+        :param config: config params
+        :param day_job: the DayJob of the asset today. Options must have their entire chain resolved, see get_option_chain
+        """
+        self.app = app
+        self.day_job = day_job
+        self.dist_from_atm = config.pct_strikes_from_atm
+        self.max_lines = config.max_live_lines
+        self.end_time = day_job.date.replace(hour=config.end_time.hour, minute=config.end_time.minute)
+        self.what_to_show = [side for what_to_show in config.what_to_show for side in LIVE_SIDES[what_to_show]]
+        self.ring = RingBuffer(app.bar_dtype, config.live_buffer_size)
+        self.subscriptions = {}  # key of the contract and side -> the DataRequest of its subscription
+        self.by_req_id = {}
+        self.rejected = {}  # key -> time it may be subscribed again
+        self.chain = day_job.option_chain_data
+        self.strikes = sorted(self.chain.all_contracts.keys()) if self.chain is not None else []
+        self.spot_price = self.chain.open_spot_price if self.chain is not None else None
+        self.atm_strike = None
+        self.spot_req_id = None
+        self.subscriptions_lost = False
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        self.persister = threading.Thread(target=self.persist, daemon=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.complete = False
+        app.metrics.set_gauge("ib_live_subscriptions", lambda: len(self.subscriptions), asset=day_job.asset)
+        app.metrics.set_gauge("ib_live_bars_received", lambda: self.ring.seq, asset=day_job.asset)
+
+    def start(self):
+        self.app.start_day(self.day_job)
+        self.persister.start()
+        if self.chain is not None:
+            self.spot_req_id = get_req_id(self.app.live_requests.keys())
+            self.app.live_requests[self.spot_req_id] = self
+            self.app.reqMktData(self.spot_req_id, self.app.get_asset_contract(self.day_job.base_asset), "", False, False, [])
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def stop(self):
+        """
+        Stop before the end time of the day. The day is not marked as complete, so it's resumed by the next run
+        """
+        self.stopped.set()
+        self.changed.set()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set() and dt.datetime.now() < self.end_time:
+                if self.subscriptions_lost:
+                    self.restore_subscriptions()
+                if not self.update_subscriptions():
+                    self.changed.wait(1)
+                    self.changed.clear()
+            self.complete = not self.stopped.is_set()
+        except Exception:
+            logging.getLogger("IBLog").exception(f"Live session of {self.day_job.asset} failed")
+        finally:
+            self.close()
+
+    def close(self):
+        for key in list(self.subscriptions):
+            self.unsubscribe(key)
+        if self.spot_req_id is not None:
+            self.app.cancelMktData(self.spot_req_id)
+            self.app.live_requests.pop(self.spot_req_id, None)
+        self.stopped.set()
+        self.persister.join()
+        self.day_job.close_output(self.app.output_type, self.complete)
+        logging.getLogger("IBLog").info(f"Live session of {self.day_job.asset} ended, {self.ring.seq} bars received")
+
+    def resubscribe(self):
+        """
+        The subscriptions were lost with the connection, the session thread subscribes to all of them again
+        """
+        self.subscriptions_lost = True
+        self.changed.set()
+
+    def restore_subscriptions(self):
+        self.subscriptions_lost = False
+        for data_request in self.subscriptions.values():
+            self.app.live_requests.pop(data_request.req_id, None)
+        self.subscriptions.clear()
+        self.by_req_id.clear()
+        if self.spot_req_id is not None:
+            self.app.connection.wait_connected()
+            self.app.reqMktData(self.spot_req_id, self.app.get_asset_contract(self.day_job.base_asset), "", False, False, [])
+        logging.getLogger("IBLog").info(f"Subscribing to the live data of {self.day_job.asset} again")
+
+    def get_wanted_requests(self) -> list:
+        """
+        :return: DataRequest of each contract and side that should be subscribed now, most important first. Options
+        are selected as get_wanted_contracts selects them, around the current ATM strike
+        """
+        if self.chain is None:
+            contracts = self.app.get_wanted_contracts(self.day_job)
+        else:
+            self.atm_strike = take_closest(self.strikes, self.spot_price)
+            all_contracts = self.chain.all_contracts
+            registry, day_job = self.app.no_data_registry, self.day_job
+            contracts = [all_contracts[strike][right] for strike in OPT.get_close_strikes(self.strikes, self.spot_price, self.dist_from_atm)
+                         for right in sorted(all_contracts[strike])
+                         if not registry.contains(day_job.base_asset, self.chain.expiry, strike, right, day_job.date)]
+        requests = [DataRequest(contract, None, None, side, self.day_job) for contract in contracts for side in self.what_to_show]
+        return requests[:self.max_lines]
+
+    def update_subscriptions(self) -> bool:
+        """
+        Cancel the subscriptions that are not wanted anymore, and subscribe to a single missing one. Subscribing may
+        block on pacing, so the wanted set is computed again after each of them.
+        :return: True if a subscription was sent
+        """
+        wanted = self.get_wanted_requests()
+        wanted_keys = {data_request.get_pacing_key() for data_request in wanted}
+        for key in [key for key in self.subscriptions if key not in wanted_keys]:
+            self.unsubscribe(key)
+        now = time.monotonic()
+        for data_request in wanted:
+            key = data_request.get_pacing_key()
+            if key not in self.subscriptions and self.rejected.get(key, 0) <= now:
+                self.subscribe(key, data_request)
+                return True
+        return False
+
+    def subscribe(self, key: tuple, data_request):
+        data_request.req_id = get_req_id(self.app.live_requests.keys())
+        self.subscriptions[key] = data_request
+        self.by_req_id[data_request.req_id] = data_request
+        self.app.live_requests[data_request.req_id] = self
+        self.app.send_live_data_request(data_request)
+
+    def unsubscribe(self, key: tuple):
+        if (data_request := self.subscriptions.pop(key, None)) is None:
+            return
+        self.app.cancelRealTimeBars(data_request.req_id)
+        self.by_req_id.pop(data_request.req_id, None)
+        self.app.live_requests.pop(data_request.req_id, None)
+
+    def on_bar(self, req_id: int, bar_time: int, bar_open: float, high: float, low: float, close: float):
+        """
+        Called on the EReader thread with each real time bar
+        """
+        if (data_request := self.by_req_id.get(req_id)) is None:
+            return
+        bar = BarData()
+        bar.date = bar_time + time.localtime(bar_time).tm_gmtoff - self.app.shift_hours * 3600
+        bar.open, bar.high, bar.low, bar.close = bar_open, high, low, close
+        self.ring.put(self.app.encode_bar(data_request, bar))
+
+    def on_spot(self, price: float):
+        """
+        Called on the EReader thread with each price of the underline. Subscriptions are updated only when the ATM
+        strike changes.
+        """
+        self.spot_price = price
+        if take_closest(self.strikes, price) != self.atm_strike:
+            self.changed.set()
+
+    def on_error(self, req_id: int, error_code: int, error_string: str):
+        """
+        A subscription failed. It's subscribed again after a delay if the error is retryable, and never again otherwise
+        """
+        if (data_request := self.by_req_id.pop(req_id, None)) is None:
+            return
+        key = data_request.get_pacing_key()
+        self.subscriptions.pop(key, None)
+        self.app.live_requests.pop(req_id, None)
+        self.rejected[key] = time.monotonic() + RESUBSCRIBE_DELAY if is_retryable_error(error_code, error_string) else float('inf')
+        self.changed.set()
+
+    def persist(self):
+        """
+        Write the bars of the ring to the file every flush interval, until the session stops
+        """
+        seq = 0
+        while not self.stopped.wait(DEFAULT_FLUSH_INTERVAL):
+            seq = self.write_new_bars(seq)
+        self.write_new_bars(seq)
+
+    def write_new_bars(self, seq: int) -> int:
+        rows, seq, lost = self.ring.read(seq)
+        if lost:
+            logging.getLogger("IBLog").warning(f"{lost} live bars of {self.day_job.asset} were overwritten before they were written")
+            self.app.metrics.inc("ib_live_bars_lost_total", lost)
+        if len(rows):
+            self.day_job.writer.put_rows(rows)
+        return seq
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import queue
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+DEFAULT_METRICS_INTERVAL = 10
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+def get_key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def format_labels(labels: tuple) -> str:
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as in Prometheus
+    """
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self) -> list:
+        cumulative, total = [], 0
+        for bucket_count in self.counts:
+            total += bucket_count
+            cumulative.append(total)
+        return cumulative
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of a collection run, and the wall time of each of its phases.
+    Updates are cheap but take a lock, so the hot paths update them per request or per flushed buffer, never per bar.
+    Time spent blocked is accumulated in counters named *_seconds_total, so a run can be broken down to time waiting
+    for pacing, for TWS, for decoding and for the disk.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.phases = OrderedDict()
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value, **labels):
+        """
+        :param value: the value, or a function returning it when the metrics are collected
+        """
+        with self.lock:
+            self.gauges[get_key(name, labels)] = value
+
+    def remove_gauge(self, name: str, **labels):
+        with self.lock:
+            self.gauges.pop(get_key(name, labels), None)
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, **labels) -> float:
+        """
+        :return: value of a counter. Without labels, the sum of all the counters of that name
+        """
+        with self.lock:
+            if labels:
+                return self.counters.get(get_key(name, labels), 0)
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def get_histogram_sum(self, name: str) -> float:
+        with self.lock:
+            return sum(histogram.sum for (histogram_name, _), histogram in self.histograms.items() if histogram_name == name)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Add the time spent in the block to the counter name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Record the wall time of a phase of the run
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def collect(self) -> (dict, dict, dict):
+        """
+        :return: copies of the counters, gauges (with their functions evaluated) and histograms
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: (histogram.buckets, histogram.get_cumulative_counts(), histogram.sum, histogram.count)
+                          for key, histogram in self.histograms.items()}
+        gauges = {key: value() if callable(value) else value for key, value in gauges.items()}
+        return counters, gauges, histograms
+
+    def to_dict(self) -> dict:
+        counters, gauges, histograms = self.collect()
+        result = {"time": time.time(), "uptime": time.time() - self.start_time, "counters": {}, "gauges": {},
+                  "histograms": {}, "phases": dict(self.phases)}
+        for kind, values in (("counters", counters), ("gauges", gauges)):
+            for (name, labels), value in sorted(values.items()):
+                result[kind].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            result["histograms"].setdefault(name, []).append(
+                {"labels": dict(labels), "buckets": dict(zip(map(str, buckets), counts)), "sum": total, "count": count})
+        return result
+
+    def to_prometheus(self) -> str:
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {kind}")
+                lines += [f"{name}{format_labels(labels)} {value}" for (key_name, labels), value in sorted(values.items()) if key_name == name]
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (key_name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                for bucket, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf' if bucket == float('inf') else bucket),))} {bucket_count}")
+                lines += [f"{name}_sum{format_labels(labels)} {total}", f"{name}_count{format_labels(labels)} {count}"]
+        lines.append("# TYPE ib_phase_seconds gauge")
+        lines += [f'ib_phase_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in self.phases.items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """
+        Write all the metrics to a file, atomically. A .json path gets JSON, any other path Prometheus text format
+        :param path: path of the file
+        """
+        content = json.dumps(self.to_dict(), indent=1) if path.endswith(".json") else self.to_prometheus()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def get_summary(self) -> str:
+        """
+        :return: human readable breakdown of the run: wall time of each phase, where the time was spent, and the
+        request counts
+        """
+        lines = ["Phases:"] + [f"  {phase:<22}{seconds:>10.2f} s" for phase, seconds in self.phases.items()]
+        lines += ["Time spent:",
+                  f"  {'blocked on pacing':<22}{self.get_counter('ib_pacing_wait_seconds_total'):>10.2f} s",
+                  f"  {'resolving contracts':<22}{self.get_counter('ib_resolve_seconds_total'):>10.2f} s",
+                  f"  {'waiting on TWS':<22}{self.get_histogram_sum('ib_request_latency_seconds'):>10.2f} s (summed over requests)",
+                  f"  {'decoding':<22}{self.get_counter('ib_decode_seconds_total'):>10.2f} s",
+                  f"  {'disk':<22}{self.get_counter('ib_disk_seconds_total'):>10.2f} s"]
+        lines += ["Requests:"] + [f"  {state:<22}{self.get_counter(f'ib_requests_{state}_total'):>10.0f}"
+                                  for state in ("sent", "completed", "no_data", "retried", "timed_out", "failed")]
+        lines.append(f"  {'bars written':<22}{self.get_counter('ib_bars_written_total'):>10.0f}")
+        return '\n'.join(lines)
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Writes the metrics to a file every interval seconds, and once more when stopped
+    """
+    def __init__(self, metrics: Metrics, path: str, interval: float = DEFAULT_METRICS_INTERVAL):
+        """
+        :param metrics: the metrics of the run
+        :param path: path of the metrics file, .json for JSON and anything else for Prometheus text format
+        :param interval: seconds between two writes
+        """
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.last_bars = (time.monotonic(), 0)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+    def report(self):
+        now, bars = time.monotonic(), self.metrics.get_counter("ib_bars_written_total")
+        self.metrics.set_gauge("ib_bars_per_second", (bars - self.last_bars[1]) / max(now - self.last_bars[0], 1e-9))
+        self.last_bars = (now, bars)
+        try:
+            self.metrics.write(self.path)
+        except OSError as e:
+            logging.getLogger("IBLog").warning(f"Failed writing metrics to {self.path}: {e}")
+
+
+class TimedQueue(queue.Queue):
+    """
+    The message queue between the EReader thread and the decoding thread. The time the decoding thread spends between
+    two get() calls is the time it spent decoding and handling a message.
+    """
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+        self.last_get = None
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        if self.last_get is not None:
+            self.metrics.inc("ib_decode_seconds_total", start - self.last_get)
+        try:
+            return super().get(block, timeout)
+        finally:
+            self.last_get = time.perf_counter()
@@ -0,0 +1,145 @@
+"""
+Migration of an output_dir tree to bars files, the format the collector writes now. txt files and headerless bin files
+written before it (the files get_opt_arr_from_line and get_arr_from_line read line by line) are converted into
+finalized bars files, in parallel on all the cores:
+- the sec type, asset and date of each file come from its name and directory, see parse_output_file_name
+- txt files are split into fields at once and converted a column at a time, see IBFormat.read_txt
+- every bars file is written to a temporary file and moved into place once it's finalized, and headerless bin files are
+  kept as .legacy beside it. A migration that was interrupted picks up where it stopped: files that were converted
+  already are skipped
+- no journal is written: a legacy file doesn't tell whether the run that wrote it collected the whole day, so the
+  collector asks before it overwrites a migrated day, as it does for any file without a journal. With --mark-complete
+  a journal that marks the day as complete is written beside every bars file, so the collector skips these days
+Usage: python IBMigrate.py <output_dir> [--workers 8] [--remove] [--mark-complete]
+"""
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from IBFormat import write_header, finalize, is_bars_file, read_legacy, read_txt, upgrade_rows
+from IBJournal import RequestJournal
+from IBUtils import parse_output_file_name
+
+LEGACY_EXTENSION = ".legacy"
+
+logging.getLogger("IBLog")
+
+
+def get_target_path(path: str) -> str:
+    """
+    :param path: path of a file to migrate
+    :return: path of its bars file
+    """
+    if path.endswith(LEGACY_EXTENSION):
+        path = path[:-len(LEGACY_EXTENSION)]
+    return os.path.splitext(path)[0] + ".bin"
+
+
+def is_migrated(target_path: str) -> bool:
+    """
+    :return: True if the bars file exists. Bars files are moved into place only once they're finalized, one that isn't
+    is being written by the collector
+    """
+    return os.path.exists(target_path) and is_bars_file(target_path)
+
+
+def find_legacy_files(output_dir: str) -> list:
+    """
+    :param output_dir: root of the tree, searched recursively
+    :return: paths of the files that were not migrated yet: txt files, headerless bin files, and headerless bin files
+    that were moved aside by a migration that was interrupted before their bars file was moved into place
+    """
+    paths = []
+    for directory, _, names in sorted(os.walk(output_dir)):
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if not name.startswith("RawData-"):
+                continue
+            if name.endswith(".txt") or name.endswith(".bin" + LEGACY_EXTENSION):
+                if not is_migrated(get_target_path(path)):
+                    paths.append(path)
+            elif name.endswith(".bin") and os.path.getsize(path) and not is_bars_file(path):
+                paths.append(path)
+    return paths
+
+
+def migrate_file(path: str, remove: bool = False, mark_complete: bool = False) -> (str, int, int):
+    """
+    Convert a single file into a finalized bars file
+    :param path: path of a txt file or of a headerless bin file
+    :param remove: remove the source file once it was converted, instead of keeping it
+    :param mark_complete: mark the day as complete in a journal beside the bars file, unless it has a journal already
+    :return: path of the bars file, number of rows and size of the source file in bytes
+    """
+    asset, sec_type, date = parse_output_file_name(path[:-len(LEGACY_EXTENSION)] if path.endswith(LEGACY_EXTENSION) else path)
+    size = os.path.getsize(path)
+    rows = read_txt(path, sec_type, date) if path.endswith(".txt") else upgrade_rows(read_legacy(path, sec_type), date)
+    target_path = get_target_path(path)
+    temp_path = f"{target_path}.migrating"
+    with open(temp_path, 'wb') as f:
+        write_header(f, rows.dtype, sec_type, asset, date)
+        rows.tofile(f)
+    finalize(temp_path)
+    if path == target_path:
+        # the bin file is replaced by its bars file, it's kept aside until the bars file is in place
+        path = f"{path}{LEGACY_EXTENSION}"
+        os.replace(target_path, path)
+    os.replace(temp_path, target_path)
+    if remove:
+        os.remove(path)
+    journal_path = f"{target_path}.journal"
+    if mark_complete and not os.path.exists(journal_path):
+        journal = RequestJournal(journal_path)
+        journal.record_day_complete()
+        journal.close()
+    return target_path, len(rows), size
+
+
+def migrate(output_dir: str, workers: int = None, remove: bool = False, mark_complete: bool = False):
+    """
+    Migrate all the files of a tree that were not migrated yet, a file per process at a time
+    :param output_dir: root of the tree
+    :param workers: number of processes, the number of CPUs by default
+    :param remove: remove the source files once they were converted
+    :param mark_complete: mark the migrated days as complete, see migrate_file
+    :return: generator of (path of the source file, its result as migrate_file returns it or the exception that failed
+    it), in the order of the files
+    """
+    paths = find_legacy_files(output_dir)
+    logging.getLogger("IBLog").info(f"{len(paths)} files to migrate in {output_dir}")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(migrate_file, path, remove, mark_complete) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, e
+
+
+def main(args):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    start = time.time()
+    files, failed, rows, size = 0, 0, 0, 0
+    for path, result in migrate(args.output_dir, args.workers, args.remove, args.mark_complete):
+        if isinstance(result, Exception):
+            failed += 1
+            logging.getLogger("IBLog").error(f"{path}: {result}")
+            continue
+        files, rows, size = files + 1, rows + result[1], size + result[2]
+        elapsed = max(time.time() - start, 1e-9)
+        logging.getLogger("IBLog").info(f"{path} -> {os.path.basename(result[0])}: {result[1]} rows. "
+                                        f"{files} files, {rows / elapsed:.0f} rows/s, {size / elapsed / 2 ** 20:.1f} MB/s")
+    elapsed = time.time() - start
+    logging.getLogger("IBLog").info(f"Migrated {files} files, {failed} failed, {rows} rows, {size / 2 ** 20:.1f} MB in {elapsed:.1f} seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the txt and headerless bin files of an output_dir tree into bars files")
+    parser.add_argument("output_dir", help="root of the tree")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, the number of CPUs by default")
+    parser.add_argument("--remove", action="store_true", help="remove the source files once they were converted")
+    parser.add_argument("--mark-complete", action="store_true", help="mark the migrated days as complete, so the collector skips them. "
+                        "Only if the runs that wrote the legacy files are known to have collected whole days")
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import deque
+
+MAX_REQUESTS_PER_PERIOD = 60
+PACING_PERIOD = 10 * 60
+MAX_IN_FLIGHT = 50
+IDENTICAL_REQUEST_PERIOD = 15
+
+
+class PacingScheduler:
+    """
+    Models the pacing limitations IB enforces on historical data requests:
+    - no more than 60 requests in any 10 minutes period, BID_ASK requests count as two
+    - no more than 50 requests open at the same time
+    - no identical request within 15 seconds
+    Callers block in acquire() exactly until a slot is free, and release() wakes them up as soon as a request ends.
+    """
+    def __init__(self, max_requests: int = MAX_REQUESTS_PER_PERIOD, period: float = PACING_PERIOD,
+                 max_in_flight: int = MAX_IN_FLIGHT, identical_period: float = IDENTICAL_REQUEST_PERIOD,
+                 safety_margin: float = 1.0):
+        """
+        :param max_requests: number of requests allowed in each period
+        :param period: length of the period in seconds
+        :param max_in_flight: number of requests allowed to be open at the same time
+        :param identical_period: minimal time in seconds between two identical requests
+        :param safety_margin: seconds added to each time limit, since IB measures them on its own clock
+        """
+        self.max_requests = max_requests
+        self.period = period + safety_margin
+        self.max_in_flight = max_in_flight
+        self.identical_period = identical_period + safety_margin
+        self.sent_times = deque()
+        self.identical_sent_times = deque()
+        self.last_sent_time = {}
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, key=None, cost: int = 1):
+        """
+        Block until a new request can be sent without violating any limitation, and account for it as sent.
+        :param key: hashable identifying the request, used to detect identical requests. None to skip that check
+        :param cost: number of requests it counts as in the period limitation
+        """
+        with self.condition:
+            while (wait_time := self._get_wait_time(time.monotonic(), key, cost)) > 0:
+                self.condition.wait(None if wait_time == float('inf') else wait_time)
+            now = time.monotonic()
+            self.sent_times.extend([now] * cost)
+            self.in_flight += 1
+            if key is not None:
+                self.last_sent_time[key] = now
+                self.identical_sent_times.append((now, key))
+
+    def release(self):
+        """
+        A request has ended (either all the data was delivered or it failed), free its in flight slot
+        """
+        with self.condition:
+            if self.in_flight > 0:
+                self.in_flight -= 1
+            self.condition.notify_all()
+
+    def get_wait_time(self, key=None, cost: int = 1) -> float:
+        """
+        :param key: hashable identifying the request, None to skip the identical requests check
+        :param cost: number of requests it counts as in the period limitation
+        :return: seconds until the request could be sent, 0 if it can be sent now, inf if we depend on a request to end
+        """
+        with self.condition:
+            return self._get_wait_time(time.monotonic(), key, cost)
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """
+        Block until all open requests have ended
+        :param timeout: maximal time to wait in seconds, None to wait forever
+        :return: True if there are no open requests
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_flight == 0, timeout)
+
+    def _get_wait_time(self, now: float, key, cost: int = 1) -> float:
+        """
+        Must be called while holding the condition.
+        :return: seconds to wait before a new request can be sent, 0 if it can be sent now, inf if we depend on a
+        request to end
+        """
+        while self.sent_times and now - self.sent_times[0] >= self.period:
+            self.sent_times.popleft()
+        while self.identical_sent_times and now - self.identical_sent_times[0][0] >= self.identical_period:
+            sent_time, old_key = self.identical_sent_times.popleft()
+            if self.last_sent_time.get(old_key) == sent_time:
+                del self.last_sent_time[old_key]
+
+        if self.in_flight >= self.max_in_flight:
+            return float('inf')
+        wait_time = 0
+        if len(self.sent_times) + cost > self.max_requests:
+            wait_time = self.sent_times[len(self.sent_times) + cost - 1 - self.max_requests] + self.period - now
+        if key is not None and key in self.last_sent_time:
+            wait_time = max(wait_time, self.last_sent_time[key] + self.identical_period - now)
+        return wait_time
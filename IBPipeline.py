@@ -0,0 +1,60 @@
+import queue
+import logging
+import threading
+
+from IBUtils import Config
+
+DEFAULT_LOOKAHEAD = 1
+
+_END = object()
+
+
+class JobPipeline:
+    """
+    Resolves the contracts of the upcoming days on a background thread, while the requests of the current day are still
+    being sent and received. Iterating over the pipeline yields the days in order, each with its option chain ready.
+    """
+    def __init__(self, app, config: Config, day_jobs: list, lookahead: int = DEFAULT_LOOKAHEAD):
+        """
+        :param app: the IBapi object
+        :param config: config params
+        :param day_jobs: the days to collect, in order
+        :param lookahead: number of days resolved ahead of the day being sent
+        """
+        self.app = app
+        self.config = config
+        self.day_jobs = day_jobs
+        self.ready_jobs = queue.Queue(maxsize=lookahead)
+        self.resolver = threading.Thread(target=self.resolve_all, daemon=True)
+        self.resolver.start()
+
+    def __iter__(self):
+        while (day_job := self.ready_jobs.get()) is not _END:
+            if isinstance(day_job, Exception):
+                raise day_job
+            yield day_job
+
+    def resolve_all(self):
+        try:
+            for day_job in self.day_jobs:
+                logging.getLogger("IBLog").info(f"Resolving contracts of {day_job.asset} - {day_job.date.strftime('%Y%m%d')}")
+                with self.app.metrics.timer("ib_resolve_seconds_total"):
+                    day_job.option_chain_data = self.resolve(day_job)
+                self.ready_jobs.put(day_job)
+            self.ready_jobs.put(_END)
+        except Exception as e:
+            logging.getLogger("IBLog").exception("Failed resolving contracts")
+            self.ready_jobs.put(e)
+
+    def resolve(self, day_job):
+        """
+        :return: the option chain of the day. It's resolved again if the connection was lost meanwhile
+        """
+        while True:
+            generation = self.app.connection.generation
+            try:
+                return self.app.get_all_needed_contracts(day_job.base_asset, day_job.date, day_job.is_weekly, self.config, day_job.expiry)
+            except Exception:
+                if self.app.connection.generation == generation:
+                    raise
+                logging.getLogger("IBLog").warning(f"Connection lost while resolving {day_job.asset} - {day_job.date.strftime('%Y%m%d')}, resolving again")
@@ -0,0 +1,102 @@
+import math
+import datetime as dt
+from datetime import timedelta
+
+from IBPacing import MAX_REQUESTS_PER_PERIOD, PACING_PERIOD
+from IBUtils import Config
+
+BAR_SIZE = 5
+BAR_SIZE_NAMES = {1: "1 secs", 5: "5 secs", 10: "10 secs", 15: "15 secs", 30: "30 secs", 60: "1 min"}
+# https://interactivebrokers.github.io/tws-api/historical_limitations.html - longest duration in seconds per bar size
+MAX_DURATIONS = {1: 1800, 5: 3600, 10: 14400, 15: 14400, 30: 28800, 60: 86400}
+# BID_ASK requests count twice for pacing
+PACING_COSTS = {"BID_ASK": 2}
+DEFAULT_LATENCY = 5  # typical seconds until a request of a full window is answered
+
+
+def get_pacing_cost(what_to_show: str) -> int:
+    return PACING_COSTS.get(what_to_show, 1)
+
+
+def predict_wall_time(pacing_cost: int, latency: float = DEFAULT_LATENCY, sessions: int = 1) -> float:
+    """
+    Under pacing limitations, the first 60 requests are sent at once and each next 60 only a period later
+    :param pacing_cost: number of requests, BID_ASK requests counted twice
+    :param latency: seconds until the last request is answered
+    :param sessions: number of gateways the requests are spread over, each has its own pacing limitations
+    :return: predicted wall time in seconds
+    """
+    if pacing_cost <= 0:
+        return 0
+    pacing_cost = math.ceil(pacing_cost / sessions)
+    return (math.ceil(pacing_cost / MAX_REQUESTS_PER_PERIOD) - 1) * PACING_PERIOD + latency
+
+
+def format_duration(seconds: float) -> str:
+    hours, seconds = divmod(int(seconds), 3600)
+    return f"{hours}:{seconds // 60:02}:{seconds % 60:02}"
+
+
+class RequestPlanner:
+    """
+    Plans the historical data requests of a day: the trading hours are covered with the fewest windows IB allows for
+    the bar size, the last windows are full and the first one takes the remainder. Each contract is requested once per
+    window for each of what_to_show: ASK and BID, or a single BID_ASK request that costs twice for pacing but takes a
+    single in flight slot. Note a BID_ASK bar is not the same as the two sides: its open and close are the time average
+    bid and ask, its high and low are the highest ask and the lowest bid.
+    """
+    def __init__(self, config: Config, bar_size: int = BAR_SIZE):
+        """
+        :param config: config params, with the trading hours, request_interval, what_to_show and gateways
+        :param bar_size: length of a bar in seconds
+        """
+        self.sessions = max(len(config.gateways), 1)
+        self.start_time = config.start_time
+        self.end_time = config.end_time
+        self.what_to_show = config.what_to_show
+        self.bar_size = bar_size
+        self.window = MAX_DURATIONS[bar_size]
+        if config.request_interval:
+            self.window = min(config.request_interval * 60, self.window)
+
+    def get_windows(self, date: dt) -> list:
+        """
+        :param date: the requested date
+        :return: list of (end time, duration in minutes) of the requests windows of the day, in order
+        """
+        start_time = date.replace(hour=self.start_time.hour, minute=self.start_time.minute)
+        query_time = date.replace(hour=self.end_time.hour, minute=self.end_time.minute)
+        windows = []
+        while query_time > start_time:
+            duration = min(self.window, int((query_time - start_time).total_seconds()))
+            windows.append((query_time, duration // 60))
+            query_time -= timedelta(seconds=duration)
+        return windows[::-1]
+
+    def get_pacing_cost(self, date: dt, contracts: int = 1) -> int:
+        """
+        :param date: the requested date
+        :param contracts: number of contracts requested on that date
+        :return: number of requests of the day, counted as IB pacing counts them
+        """
+        return len(self.get_windows(date)) * contracts * sum(get_pacing_cost(what_to_show) for what_to_show in self.what_to_show)
+
+    def describe(self, dates: list, contracts_per_day: int = None) -> str:
+        """
+        :param dates: dates of all the days to collect
+        :param contracts_per_day: number of contracts of each day, None if it's not known before their chain is
+        resolved
+        :return: description of the plan, with the predicted wall time under pacing limitations
+        """
+        if not dates:
+            return "Plan: nothing to collect"
+        windows = self.get_windows(dates[0])
+        per_contract = self.get_pacing_cost(dates[0])
+        description = f"Plan: {len(dates)} days, {len(windows)} windows of up to {self.window // 60} minutes of " \
+                      f"{BAR_SIZE_NAMES[self.bar_size]} bars, {'/'.join(self.what_to_show)}: {per_contract} pacing " \
+                      f"units per contract per day"
+        if contracts_per_day is None:
+            return description + ". Wall time is predicted once the first option chain is resolved"
+        pacing_cost = sum(self.get_pacing_cost(date, contracts_per_day) for date in dates)
+        sessions = f" over {self.sessions} gateways" if self.sessions > 1 else ""
+        return description + f". {pacing_cost} pacing units in total, predicted wall time{sessions} {format_duration(predict_wall_time(pacing_cost, sessions=self.sessions))}"
@@ -0,0 +1,96 @@
+"""
+Spreading the historical data requests over several gateways. IB enforces pacing per session, so each gateway listed in
+the gateways config option adds a budget of its own: 60 requests per 10 minutes and 50 in flight.
+"""
+import copy
+import logging
+
+from IBApp import IBFactory, DataRequest
+from IBMetrics import TimedQueue
+from IBUtils import init_app_listener, Config
+
+POLL_INTERVAL = 1  # seconds between two checks while no gateway is connected
+
+
+class IBPool:
+    """
+    The primary app resolves the contracts and manages the days: their output files, journals and closing. The other
+    apps only send requests and receive their bars. Bars are routed to their day through their DataRequest as usual, so
+    a day has a single writer and a single journal, whichever gateways its requests went through.
+    Each request is sent through the gateway that can send it soonest under its own pacing, and its retries stay on that
+    gateway. A gateway that is down is skipped until it reconnects.
+    """
+    def __init__(self, app, config: Config):
+        """
+        :param app: the primary IBapi object, connected to the first gateway. Its metrics, no data registry, contract
+        cache and day closing are shared by all the gateways
+        :param config: config params, with the gateways
+        """
+        self.primary = app
+        self.apps = [app]
+        self.names = [f"{config.host}:{config.port}"]
+        # the pacing of all the gateways shares a single condition, so a request ending on any of them wakes the sender
+        self.condition = app.pacing.condition
+        for host, port, client_id in config.gateways[1:]:
+            gateway_config = copy.copy(config)
+            gateway_config.host, gateway_config.port, gateway_config.client_id = host, port, client_id
+            worker = IBFactory.createIBapi(gateway_config)
+            worker.metrics = app.metrics
+            worker.msg_queue = TimedQueue(app.metrics)
+            worker.no_data_registry = app.no_data_registry
+            worker.contract_cache = app.contract_cache
+            worker.day_closer = app.day_closer
+            worker.pacing.condition = self.condition
+            self.apps.append(worker)
+            self.names.append(f"{host}:{port}")
+        app.metrics.set_gauge("ib_requests_in_flight", lambda: sum(app.pacing.in_flight for app in self.apps))
+        app.metrics.set_gauge("ib_requests_tracked", lambda: sum(len(app.requests) for app in self.apps))
+        for name, gateway_app in zip(self.names, self.apps):
+            app.metrics.set_gauge("ib_gateway_requests_in_flight", lambda gateway_app=gateway_app: gateway_app.pacing.in_flight, gateway=name)
+            app.metrics.set_gauge("ib_gateway_connected", lambda gateway_app=gateway_app: int(gateway_app.connection.is_connected), gateway=name)
+
+    def __len__(self):
+        return len(self.apps)
+
+    def connect(self):
+        """
+        Connect to all the gateways. Only the primary is required, gateways that can't be reached are left out of the run
+        """
+        init_app_listener(self.primary)
+        for name, gateway_app in list(zip(self.names, self.apps))[1:]:
+            try:
+                init_app_listener(gateway_app)
+            except Exception:
+                logging.getLogger("IBLog").exception(f"Gateway {name} is left out")
+                self.names.remove(name)
+                self.apps.remove(gateway_app)
+        logging.getLogger("IBLog").info(f"Requests are spread over {len(self.apps)} gateways: {', '.join(self.names)}")
+
+    def send_historical_data_request(self, data_request: DataRequest):
+        """
+        Block until any of the gateways can send the request without violating its pacing limitations, and send it
+        through the one that can send it first
+        :param data_request: the new request
+        """
+        key, cost = data_request.get_pacing_key(), data_request.get_pacing_cost()
+        with self.primary.metrics.timer("ib_pacing_wait_seconds_total"):
+            with self.condition:
+                while True:
+                    wait_time, _, index = min((app.pacing.get_wait_time(key, cost) if app.connection.is_connected else float('inf'), app.pacing.in_flight, index)
+                                              for index, app in enumerate(self.apps))
+                    if wait_time <= 0:
+                        break
+                    self.condition.wait(min(wait_time, POLL_INTERVAL))
+        self.primary.metrics.inc("ib_gateway_requests_sent_total", gateway=self.names[index])
+        self.apps[index].send_historical_data_request(data_request)
+
+    def wait_until_idle(self):
+        """
+        Block until the open requests of all the gateways have ended
+        """
+        for app in self.apps:
+            app.pacing.wait_until_idle()
+
+    def close(self):
+        for app in self.apps:
+            app.connection.close()
@@ -0,0 +1,172 @@
+import time
+import heapq
+import logging
+import threading
+from enum import Enum
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_REQUEST_TIMEOUT = 180
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 15  # IB doesn't accept an identical request within 15 seconds anyway
+MAX_RETRY_BACKOFF = 10 * 60
+
+# https://interactivebrokers.github.io/tws-api/message_codes.html
+NO_DATA_MESSAGE = "HMDS query returned no data"
+RETRYABLE_ERROR_CODES = [162, 322, 366]  # 162 other than no data: pacing violation, query cancelled, etc
+INFORMATIVE_ERROR_CODES = [165]
+
+
+class RequestState(Enum):
+    QUEUED = 0
+    SENT = 1
+    RECEIVING = 2
+    DONE = 3
+    FAILED = 4
+    RETRYING = 5
+
+
+class TrackedRequest:
+    """
+    A data request along its life: it may be sent several times, each time with a new req_id
+    """
+    __slots__ = ['data_request', 'state', 'attempts', 'send_time', 'deadline', 'last_error', 'last_bar_date']
+
+    def __init__(self, data_request):
+        """
+        :param data_request: the request
+        """
+        self.data_request = data_request
+        self.state = RequestState.QUEUED
+        self.attempts = 0
+        self.send_time = None
+        self.deadline = None
+        self.last_error = None
+        self.last_bar_date = None  # date of the last bar written, bars up to it are dropped when the request is sent again
+
+
+def is_retryable_error(error_code: int, error_string: str) -> bool:
+    if error_code == 162 and NO_DATA_MESSAGE in error_string:
+        return False
+    return error_code in RETRYABLE_ERROR_CODES
+
+
+class RequestTracker:
+    """
+    Table of all the open data requests, by req_id. Each request has a deadline, requests that pass it or fail on a
+    retryable error are resent after an exponential backoff, until they run out of attempts.
+    A watchdog thread wakes exactly at the next deadline or retry time.
+    """
+    def __init__(self, on_timeout, on_retry, timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """
+        :param on_timeout: called with the req_id and the TrackedRequest of a request that passed its deadline
+        :param on_retry: called with a TrackedRequest that should be sent again. Runs on a dedicated thread, so it may
+        block on pacing
+        :param timeout: seconds from sending a request until it's considered lost
+        :param max_attempts: number of times a request is sent before giving up on it
+        """
+        self.on_timeout = on_timeout
+        self.on_retry = on_retry
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.requests = {}
+        self.retries = []
+        self.retry_counter = count()
+        self.condition = threading.Condition()
+        self.resender = ThreadPoolExecutor(max_workers=1)
+        self.watchdog = threading.Thread(target=self.watch, daemon=True)
+        self.watchdog.start()
+
+    def __contains__(self, req_id: int) -> bool:
+        return req_id in self.requests
+
+    def __len__(self):
+        return len(self.requests)
+
+    def keys(self):
+        return self.requests.keys()
+
+    def get(self, req_id: int) -> TrackedRequest:
+        return self.requests.get(req_id)
+
+    def sent(self, req_id: int, tracked: TrackedRequest):
+        """
+        Start tracking a request that was just sent
+        :param req_id: the id it was sent with
+        :param tracked: the request
+        """
+        with self.condition:
+            tracked.attempts += 1
+            tracked.state = RequestState.SENT
+            tracked.send_time = time.time()
+            tracked.deadline = time.monotonic() + self.timeout
+            self.requests[req_id] = tracked
+            self.condition.notify()
+
+    def complete(self, req_id: int) -> TrackedRequest:
+        """
+        All the data of the request was delivered, or there is no data for it
+        :return: the request, None if it's not tracked
+        """
+        with self.condition:
+            if (tracked := self.requests.pop(req_id, None)) is not None:
+                tracked.state = RequestState.DONE
+            return tracked
+
+    def fail(self, req_id: int, error: str, retryable: bool) -> TrackedRequest:
+        """
+        The request failed. It is scheduled for a retry if the error allows it and it has attempts left.
+        :param req_id: the request id
+        :param error: description of the failure
+        :param retryable: False if sending the request again is pointless
+        :return: the request, with state RETRYING or FAILED. None if it's not tracked
+        """
+        with self.condition:
+            if (tracked := self.requests.pop(req_id, None)) is None:
+                return None
+            tracked.last_error = error
+            if retryable and tracked.attempts < self.max_attempts:
+                tracked.state = RequestState.RETRYING
+                backoff = min(RETRY_BACKOFF * 2 ** (tracked.attempts - 1), MAX_RETRY_BACKOFF)
+                heapq.heappush(self.retries, (time.monotonic() + backoff, next(self.retry_counter), tracked))
+                logging.getLogger("IBLog").warning(f"Request {req_id} failed ({error}), retrying in {backoff} seconds")
+                self.condition.notify()
+            else:
+                tracked.state = RequestState.FAILED
+                logging.getLogger("IBLog").error(f"Request {req_id} failed ({error}) after {tracked.attempts} attempts, giving up")
+            return tracked
+
+    def resend_all(self) -> list:
+        """
+        The connection with TWS was lost, and every open request with it. They are all sent again, the lost attempt
+        doesn't count.
+        :return: list of the req_id and the TrackedRequest of each of them
+        """
+        with self.condition:
+            lost = list(self.requests.items())
+            self.requests.clear()
+            for _, tracked in lost:
+                tracked.attempts -= 1
+                tracked.state = RequestState.RETRYING
+                self.resender.submit(self.on_retry, tracked)
+            self.condition.notify()
+            return lost
+
+    def watch(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for req_id, tracked in [(req_id, tracked) for req_id, tracked in self.requests.items() if tracked.deadline <= now]:
+                    self.condition.release()
+                    try:
+                        self.on_timeout(req_id, tracked)
+                    except Exception:
+                        logging.getLogger("IBLog").exception(f"Failed handling timeout of request {req_id}")
+                    finally:
+                        self.condition.acquire()
+                    self.requests.pop(req_id, None)  # never watch the same deadline twice
+                while self.retries and self.retries[0][0] <= now:
+                    self.resender.submit(self.on_retry, heapq.heappop(self.retries)[2])
+                next_wakeup = min([tracked.deadline for tracked in self.requests.values()] + [retry[0] for retry in self.retries[:1]], default=None)
+                self.condition.wait(None if next_wakeup is None else max(next_wakeup - time.monotonic(), 0))
@@ -0,0 +1,187 @@
+"""
+Resampling of the 5 secs bars of stored day files into longer bars: 1 minute, 5 minutes, daily or any other interval.
+Files are never loaded whole. Each contract and side is read on its own, through the index of the file, in chunks of at
+most chunk_rows bars that end on an interval boundary, and every chunk is reduced with numpy. Days are independent, so
+they're spread over a pool of processes, and memory stays bounded by workers * chunk_rows whatever the number of days.
+The bars of each interval are written beside the day file as a bars file of the same layout, with the interval in its
+name: RawData-SPY-OPTION-2021-01-11.bin -> RawData-SPY-OPTION-2021-01-11.1min.bin
+Usage: python IBResample.py <file or directory> [...] [--intervals 1min,5min,1d] [--workers 4] [--force]
+"""
+import os
+import re
+import logging
+import argparse
+import numpy as np
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+from IBFormat import BarFile, write_header, finalize, is_bars_file
+from IBCodec import CompressedBarFile, EXTENSION as COMPRESSED_EXTENSION
+
+DEFAULT_INTERVALS = ['1min', '5min', '1d']
+DEFAULT_CHUNK_ROWS = 64 * 1024
+INTERVAL_UNITS = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400}
+INTERVAL_PATTERN = r'(\d+)(s|min|h|d)'
+# resampled files are named after their interval, and are not resampled again
+RESAMPLED_NAME_PATTERN = re.compile(rf'.*\.{INTERVAL_PATTERN}\.bin')
+
+logging.getLogger("IBLog")
+
+
+def parse_interval(interval: str) -> int:
+    """
+    :param interval: number and unit, like 30s, 1min, 5min, 1h or 1d
+    :return: the interval in seconds
+    """
+    match = re.fullmatch(INTERVAL_PATTERN, interval.strip())
+    if match is None or not int(match.group(1)):
+        raise Exception(f"Unknown interval {interval}, expected a number and one of {', '.join(INTERVAL_UNITS)}")
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def get_resampled_path(path: str, interval: str) -> str:
+    return f"{os.path.splitext(path)[0]}.{interval}.bin"
+
+
+def resample_bars(bars: np.ndarray, seconds: int) -> np.ndarray:
+    """
+    Aggregate bars of a single contract and side into bars of a longer interval. Intervals are aligned to the epoch, a
+    daily bar covers a calendar day of the times in the file.
+    :param bars: rows of a bars file, sorted by time
+    :param seconds: length of the interval
+    :return: a row per interval that has any bar, with the same dtype: the time of its start, the open of its first
+    bar, the highest high, the lowest low and the close of its last bar
+    """
+    times = bars['time'].astype(np.int64)
+    buckets = times // seconds
+    starts = np.flatnonzero(np.append(True, buckets[1:] != buckets[:-1])) if len(bars) else np.empty(0, dtype=np.int64)
+    result = np.empty(len(starts), dtype=bars.dtype)
+    if not len(starts):
+        return result
+    for name in bars.dtype.names:
+        result[name] = bars[name][starts]
+    result['time'] = (buckets[starts] * seconds).astype(bars.dtype['time'])
+    result['high'] = np.maximum.reduceat(bars['high'], starts)
+    result['low'] = np.minimum.reduceat(bars['low'], starts)
+    result['close'] = bars['close'][np.append(starts[1:], len(bars)) - 1]
+    return result
+
+
+def iter_chunks(times: np.ndarray, seconds: int, chunk_rows: int):
+    """
+    Cut sorted times into chunks of at most chunk_rows that end on an interval boundary, so no interval is split
+    between two chunks. An interval longer than chunk_rows is a chunk of its own.
+    :return: generator of (start, stop) of the chunks
+    """
+    start = 0
+    while start < len(times):
+        stop = min(start + chunk_rows, len(times))
+        if stop < len(times):
+            boundary = (int(times[stop].astype(np.int64)) // seconds) * seconds
+            cut = start + int(np.searchsorted(times[start:stop].astype(np.int64), boundary, side='left'))
+            if cut == start:
+                # a single interval fills the chunk, take it whole
+                cut = start + int(np.searchsorted(times[start:].astype(np.int64), boundary + seconds, side='left'))
+            stop = cut
+        yield start, stop
+        start = stop
+
+
+def open_bars_file(path: str):
+    """
+    :return: a BarFile, or a CompressedBarFile for compressed files
+    """
+    return CompressedBarFile(path) if path.endswith(COMPRESSED_EXTENSION) else BarFile(path)
+
+
+def resample_file(path: str, intervals: list = None, chunk_rows: int = DEFAULT_CHUNK_ROWS, force: bool = False) -> list:
+    """
+    Resample a day file into a bars file per interval, written beside it
+    :param path: path of a finalized bars file or of a compressed one
+    :param intervals: list of intervals, like 1min, see parse_interval
+    :param chunk_rows: maximal number of bars reduced at once
+    :param force: resample again even if the resampled file is newer than the day file
+    :return: paths of the resampled files
+    """
+    intervals = intervals or DEFAULT_INTERVALS
+    bars_file = open_bars_file(path)
+    if isinstance(bars_file, BarFile) and not bars_file.is_finalized:
+        raise Exception(f"{path} must be finalized before it's resampled")
+    if bars_file.dtype['time'].kind != 'M':
+        raise Exception(f"{path} was written before times were datetime64, it can't be resampled")
+    header = bars_file.header
+    date = dt.datetime.strptime(header["date"], '%Y%m%d')
+    expiry = dt.datetime.strptime(header["expiry"], '%Y%m%d') if header.get("expiry") else None
+    output_paths = []
+    for interval in intervals:
+        seconds = parse_interval(interval)
+        output_path = get_resampled_path(path, interval)
+        output_paths.append(output_path)
+        if not force and os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(path):
+            continue
+        temp_path = f"{output_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            write_header(f, bars_file.dtype, header["sec_type"], header["asset"], date, expiry)
+            for entry in bars_file.get_contracts():
+                bars = bars_file.get_bars(**{name: entry[name] for name in bars_file.index_fields})
+                for start, stop in iter_chunks(bars['time'], seconds, chunk_rows):
+                    resample_bars(bars[start:stop], seconds).tofile(f)
+        finalize(temp_path)
+        os.replace(temp_path, output_path)
+    return output_paths
+
+
+def find_day_files(paths: list) -> list:
+    """
+    :param paths: day files or directories to search for them, recursively
+    :return: paths of all the bars files and compressed files, without resampled files
+    """
+    day_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                day_files += find_day_files([os.path.join(directory, name) for name in sorted(names)])
+        elif path.endswith(COMPRESSED_EXTENSION) or (path.endswith(".bin") and not RESAMPLED_NAME_PATTERN.fullmatch(path) and is_bars_file(path)):
+            day_files.append(path)
+    return day_files
+
+
+def resample_files(paths: list, intervals: list = None, workers: int = None, chunk_rows: int = DEFAULT_CHUNK_ROWS, force: bool = False):
+    """
+    Resample day files in parallel, a day per process at a time
+    :param paths: day files or directories of them
+    :param workers: number of processes, the number of CPUs by default
+    :return: generator of (path of the day file, paths of its resampled files, or the exception that failed it), in
+    the order of the days
+    """
+    day_files = find_day_files(paths)
+    intervals = intervals or DEFAULT_INTERVALS
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(resample_file, path, intervals, chunk_rows, force) for path in day_files]
+        for path, future in zip(day_files, futures):
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, e
+
+
+def main(args):
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    intervals = [interval.strip() for interval in args.intervals.split(',') if interval.strip()]
+    for interval in intervals:
+        parse_interval(interval)
+    for path, result in resample_files(args.paths, intervals, args.workers, args.chunk_rows, args.force):
+        if isinstance(result, Exception):
+            logging.getLogger("IBLog").error(f"{path}: {result}")
+        else:
+            logging.getLogger("IBLog").info(f"{path} -> {', '.join(os.path.basename(output_path) for output_path in result)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resample the 5 secs bars of day files into longer bars")
+    parser.add_argument("paths", nargs="+", help="bars files, compressed files, or directories of them")
+    parser.add_argument("--intervals", default=','.join(DEFAULT_INTERVALS), help="comma separated, like 30s, 1min, 1h or 1d")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, the number of CPUs by default")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="maximal number of bars reduced at once")
+    parser.add_argument("--force", action="store_true", help="resample days whose resampled files are up to date as well")
+    main(parser.parse_args())
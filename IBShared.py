@@ -0,0 +1,252 @@
+"""
+Publication of collected bars in shared memory, for local consumer processes.
+A segment holds the bars of a single asset on a single date, as a ring of records of the bars dtype per contract and
+side. Sequence counters tell consumers what is new, so they read the bars zero-copy, without any file or socket I/O.
+Usage: python IBShared.py <segment name> [--interval 1]
+"""
+import json
+import time
+import struct
+import logging
+import argparse
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from IBFormat import get_index_fields, RIGHT_CODES, SIDE_CODES
+
+MAGIC = b'IBSHM\0\0\0'
+VERSION = 1
+# magic, version, header length, number of slots, records per slot, offset of the counters, the slots and the records
+PREAMBLE = struct.Struct('<8sIIQQQQQ')
+DATA_ALIGNMENT = 64
+DEFAULT_SLOTS = 256
+DEFAULT_SLOT_CAPACITY = 8192
+POLL_INTERVAL = 0.0002
+
+
+def get_segment_name(sec_type: str, asset: str, date) -> str:
+    """
+    :return: name of the shared memory segment of an asset on a date
+    """
+    return f"ib_{sec_type}_{asset}_{date.strftime('%Y%m%d')}"
+
+
+def get_slot_dtype(dtype: np.dtype) -> np.dtype:
+    """
+    A slot is the ring of a single contract and side: its key fields, as in the index of bars files, and the number of
+    records ever published to it
+    """
+    return np.dtype([(name, dtype[name]) for name in get_index_fields(dtype)] + [('seq', '<u8')])
+
+
+def align(offset: int) -> int:
+    return -(-offset // DATA_ALIGNMENT) * DATA_ALIGNMENT
+
+
+class SharedBars:
+    """
+    Layout of a segment: a preamble and a JSON header as in bars files, two counters (records ever published, number of
+    slots in use), the slots table and the rings of records of all the slots. Record i of a slot is at i % capacity in
+    its ring.
+    The publisher writes the records first, then the sequence of their slot, then the global sequence, so a reader that
+    saw a sequence sees all the records before it.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        magic, version, header_len, self.n_slots, self.capacity, counters_offset, slots_offset, data_offset = PREAMBLE.unpack_from(shm.buf)
+        if magic != MAGIC:
+            raise Exception(f"{shm.name} is not a shared bars segment")
+        if version > VERSION:
+            raise Exception(f"Unsupported shared bars version {version}")
+        self.header = json.loads(bytes(shm.buf[PREAMBLE.size:PREAMBLE.size + header_len]))
+        self.dtype = np.dtype([tuple(field) for field in self.header["dtype"]])
+        self.index_fields = get_index_fields(self.dtype)
+        self.counters = np.ndarray(2, dtype='<u8', buffer=shm.buf, offset=counters_offset)
+        self.slots = np.ndarray(self.n_slots, dtype=get_slot_dtype(self.dtype), buffer=shm.buf, offset=slots_offset)
+        self.data = np.ndarray((self.n_slots, self.capacity), dtype=self.dtype, buffer=shm.buf, offset=data_offset)
+
+    @staticmethod
+    def get_size(dtype: np.dtype, header_len: int, n_slots: int, capacity: int) -> (int, int, int, int):
+        """
+        :return: offsets of the counters, the slots and the records, and the size of the segment
+        """
+        counters_offset = align(PREAMBLE.size + header_len)
+        slots_offset = align(counters_offset + 16)
+        data_offset = align(slots_offset + n_slots * get_slot_dtype(dtype).itemsize)
+        return counters_offset, slots_offset, data_offset, data_offset + n_slots * capacity * dtype.itemsize
+
+    @property
+    def seq(self) -> int:
+        return int(self.counters[0])
+
+    def release(self):
+        """
+        Drop the numpy views of the segment, it can't be closed while they exist
+        """
+        self.counters = self.slots = self.data = None
+        self.shm.close()
+
+
+class SharedBarPublisher(SharedBars):
+    """
+    Creates the segment of a day and publishes rows into it. Called from the writer thread only.
+    """
+    def __init__(self, name: str, dtype: np.dtype, sec_type: str, asset: str, date,
+                 n_slots: int = DEFAULT_SLOTS, capacity: int = DEFAULT_SLOT_CAPACITY):
+        """
+        :param name: name of the segment, see get_segment_name
+        :param dtype: dtype of the rows, as written to the bars file
+        :param sec_type: OPT, STK or FX
+        :param asset: the asset of the data
+        :param date: date of the data
+        :param n_slots: number of contracts and sides the segment has room for
+        :param capacity: number of records kept per contract and side
+        """
+        header = json.dumps({"sec_type": sec_type, "asset": asset, "date": date.strftime('%Y%m%d'),
+                             "dtype": dtype.descr, "index_fields": get_index_fields(dtype)}).encode()
+        counters_offset, slots_offset, data_offset, size = self.get_size(dtype, len(header), n_slots, capacity)
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a run that didn't end properly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        shm.buf[:PREAMBLE.size] = PREAMBLE.pack(MAGIC, VERSION, len(header), n_slots, capacity, counters_offset, slots_offset, data_offset)
+        shm.buf[PREAMBLE.size:PREAMBLE.size + len(header)] = header
+        super().__init__(shm)
+        self.counters[:] = 0
+        self.slot_ids = {}
+        self.is_full = False
+
+    def publish(self, rows: np.ndarray):
+        """
+        Append rows to the rings of their contracts and sides
+        :param rows: array of the dtype of the segment, with parsed times
+        """
+        if not len(rows):
+            return
+        keys, inverse = np.unique(rows[self.index_fields], return_inverse=True)
+        inverse = inverse.ravel()
+        rows = rows[np.argsort(inverse, kind='stable')]  # grouped by contract and side, in the order they came
+        stops = np.cumsum(np.bincount(inverse, minlength=len(keys)))
+        for key, start, stop in zip(keys.tolist(), np.append(0, stops[:-1]), stops):
+            if (slot_id := self.get_slot_id(key)) is None:
+                continue
+            seq = int(self.slots['seq'][slot_id])
+            self.data[slot_id, (seq + np.arange(stop - start)) % self.capacity] = rows[start:stop]
+            self.slots['seq'][slot_id] = seq + stop - start
+        self.counters[0] += len(rows)
+
+    def get_slot_id(self, key: tuple) -> int:
+        """
+        :return: the slot of a contract and side, a new one is taken on its first rows. None if the segment is full
+        """
+        if (slot_id := self.slot_ids.get(key)) is not None:
+            return slot_id
+        if len(self.slot_ids) >= self.n_slots:
+            if not self.is_full:
+                self.is_full = True
+                logging.getLogger("IBLog").warning(f"Shared memory segment {self.shm.name} is full, bars of new contracts are not published")
+            return None
+        slot_id = self.slot_ids[key] = len(self.slot_ids)
+        for name, value in zip(self.index_fields, key):
+            self.slots[name][slot_id] = value
+        self.counters[1] = len(self.slot_ids)
+        return slot_id
+
+    def close(self):
+        """
+        Remove the segment. Consumers that are attached to it keep their mapping until they close it.
+        """
+        self.release()
+        self.shm.unlink()
+
+
+class SharedBarReader(SharedBars):
+    """
+    Attaches to the segment of a day from another process. Readers never write to the segment.
+    """
+    def __init__(self, name: str):
+        """
+        :param name: name of the segment, see get_segment_name
+        """
+        shm = shared_memory.SharedMemory(name)
+        # the resource tracker would remove the segment when this process exits, it belongs to the publisher
+        resource_tracker.unregister(shm._name, "shared_memory")
+        super().__init__(shm)
+
+    def get_contracts(self) -> np.ndarray:
+        """
+        :return: copy of the slots in use, with the key fields and the sequence of every contract and side
+        """
+        return self.slots[:int(self.counters[1])].copy()
+
+    def get_slot_id(self, strike: float = None, right=None, side=None) -> int:
+        """
+        :return: the slot of a contract and side, None if nothing was published for it yet
+        """
+        key = {"strike": strike, "right": RIGHT_CODES.get(right, right), "side": SIDE_CODES.get(side, side)}
+        slots = self.slots[:int(self.counters[1])]
+        match = np.ones(len(slots), dtype=bool)
+        for name in self.index_fields:
+            if key[name] is None:
+                raise Exception(f"Must specify {', '.join(self.index_fields)}")
+            match &= slots[name] == key[name]
+        return int(np.flatnonzero(match)[0]) if match.any() else None
+
+    def get_ring(self, slot_id: int) -> (np.ndarray, int):
+        """
+        :return: zero-copy view of the ring of a slot, and its sequence. Record i is at i % capacity, records older
+        than sequence - capacity were overwritten
+        """
+        return self.data[slot_id], int(self.slots['seq'][slot_id])
+
+    def read(self, slot_id: int, since: int = 0) -> (np.ndarray, int):
+        """
+        :param slot_id: the slot of a contract and side
+        :param since: sequence of the first record wanted
+        :return: copy of the records of the slot from since, in the order they were published, and the sequence to read
+        from next time. Records that were overwritten before they were read are skipped.
+        """
+        seq = int(self.slots['seq'][slot_id])
+        since = max(since, seq - self.capacity)
+        rows = self.data[slot_id].take(np.arange(since, seq), mode='wrap')
+        # records are overwritten only by a publisher that got a whole ring ahead meanwhile
+        overwritten = int(self.slots['seq'][slot_id]) - self.capacity - since
+        return (rows[overwritten:] if overwritten > 0 else rows), seq
+
+    def wait(self, seq: int, timeout: float = None) -> int:
+        """
+        Block until anything is published after seq
+        :param seq: the global sequence last seen
+        :param timeout: maximal time to wait in seconds, None to wait forever
+        :return: the current global sequence
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (current := self.seq) == seq and (deadline is None or time.monotonic() < deadline):
+            time.sleep(POLL_INTERVAL)
+        return current
+
+
+def main(args):
+    reader = SharedBarReader(args.name)
+    print(f"{args.name}: {reader.header['sec_type']} {reader.header['asset']} {reader.header['date']}, "
+          f"{reader.n_slots} slots of {reader.capacity} bars")
+    seq = reader.seq
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = reader.seq
+            print(f"{len(reader.get_contracts())} contracts, {current} bars, {(current - seq) / args.interval:.0f} bars/s")
+            seq = current
+    except KeyboardInterrupt:
+        reader.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow a shared memory segment of bars")
+    parser.add_argument("name", help="name of the segment, ib_<sec type>_<asset>_<YYYYMMDD>")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two reports")
+    main(parser.parse_args())
@@ -0,0 +1,557 @@
+"""
+Local stand-in for TWS, speaking the IB API wire protocol well enough for connect, reqContractDetails,
+reqSecDefOptParams, reqHistoricalData, reqRealTimeBars and reqMktData. It serves synthetic option chains and bars, with configurable latency,
+pacing errors and contracts without data, so the whole collection flow can be run and measured without a live TWS.
+In live mode the underline price oscillates around its spot price, so the ATM strike moves during the day.
+Connections can be dropped periodically, as TWS drops them when it restarts.
+Usage: python IBSimulator.py [--port 7497] [--latency 0.2] [--pacing-error-rate 0.01] [--no-data-rate 0.05]
+       [--realtime-interval 5] [--disconnect-interval 300]
+"""
+import time
+import zlib
+import heapq
+import random
+import socket
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+import numpy as np
+import datetime as dt
+from itertools import count
+
+from ibapi.message import IN, OUT
+from ibapi.ticktype import TickTypeEnum
+from IBPlanner import MAX_DURATIONS, get_pacing_cost
+
+SERVER_VERSION = 157
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7497
+ACCOUNT = "DU0000000"
+
+# https://interactivebrokers.github.io/tws-api/historical_limitations.html
+BAR_SIZES = {"1 secs": 1, "5 secs": 5, "10 secs": 10, "15 secs": 15, "30 secs": 30, "1 min": 60, "2 mins": 120,
+             "5 mins": 300, "15 mins": 900, "30 mins": 1800, "1 hour": 3600}
+PACING_VIOLATION = "Historical Market Data Service error message:Historical data request pacing violation"
+NO_DATA = "Historical Market Data Service error message:HMDS query returned no data"
+
+
+def get_seed(*key) -> int:
+    return zlib.crc32('|'.join(str(part) for part in key).encode())
+
+
+class SimulatedMarket:
+    """
+    Deterministic synthetic market: the same contract and window always gets the same bars, so a request that is
+    resent returns exactly what it returned the first time.
+    """
+    def __init__(self, strike_step: float = 1.0, strikes_range: float = 0.2, no_data_rate: float = 0.0,
+                 live_amplitude: float = 0.02, live_period: float = 3600):
+        """
+        :param strike_step: distance between strikes of an option chain
+        :param strikes_range: strikes are listed up to this fraction away from the spot price
+        :param no_data_rate: fraction of the option contracts that have no data at all
+        :param live_amplitude: live prices oscillate up to this fraction away from the spot price
+        :param live_period: seconds of a full oscillation of live prices
+        """
+        self.strike_step = strike_step
+        self.strikes_range = strikes_range
+        self.no_data_rate = no_data_rate
+        self.live_amplitude = live_amplitude
+        self.live_period = live_period
+
+    @staticmethod
+    def get_spot_price(symbol: str, sec_type: str) -> float:
+        if sec_type == "CASH":
+            return round(0.5 + get_seed(symbol) % 1000 / 1000, 4)
+        return float(50 + get_seed(symbol) % 400)
+
+    def get_live_spot_price(self, symbol: str, sec_type: str, timestamp: float) -> float:
+        """
+        :param timestamp: seconds since the epoch
+        """
+        return self.get_spot_price(symbol, sec_type) * (1 + self.live_amplitude * np.sin(2 * np.pi * timestamp / self.live_period))
+
+    def get_chain(self, symbol: str, expiry: str) -> list:
+        """
+        :return: list of (strike, right) of all the options of an underline on an expiry
+        """
+        spot = self.get_spot_price(symbol, "STK")
+        first = np.ceil(spot * (1 - self.strikes_range) / self.strike_step) * self.strike_step
+        strikes = np.arange(first, spot * (1 + self.strikes_range), self.strike_step)
+        return [(round(float(strike), 2), right) for strike in strikes for right in ('C', 'P')]
+
+    def has_data(self, contract: dict) -> bool:
+        if contract["sec_type"] != "OPT":
+            return True
+        return get_seed(contract["symbol"], contract["expiry"], contract["strike"], contract["right"]) % 10000 >= self.no_data_rate * 10000
+
+    def get_base_price(self, contract: dict, spot: float = None) -> float:
+        if spot is None:
+            spot = self.get_spot_price(contract["symbol"], contract["sec_type"])
+        if contract["sec_type"] != "OPT":
+            return spot
+        intrinsic = spot - contract["strike"] if contract["right"] == 'C' else contract["strike"] - spot
+        return max(intrinsic, 0) + 0.02 * spot
+
+    def get_bars(self, contract: dict, end: dt.datetime, duration: int, bar_size: int, what_to_show: str,
+                 spot: float = None) -> np.ndarray:
+        """
+        :param contract: the requested contract
+        :param end: end time of the requested window
+        :param duration: length of the window in seconds
+        :param bar_size: length of a bar in seconds
+        :param what_to_show: ASK, BID, TRADES, MIDPOINT or BID_ASK
+        :param spot: price of the underline, its fixed spot price if None
+        :return: array of n rows of (seconds from midnight, open, high, low, close)
+        """
+        end_second = end.hour * 3600 + end.minute * 60 + end.second
+        times = np.arange(end_second - duration, end_second, bar_size)
+        times = times[times >= 0]
+        rng = np.random.default_rng(get_seed(*contract.values(), end.date(), end_second, duration, bar_size))
+        base = self.get_base_price(contract, spot)
+        tick = 0.0001 if contract["sec_type"] == "CASH" else 0.01
+        closes = base * np.exp(np.cumsum(rng.normal(0, 0.0005, len(times))))
+        opens = np.append(base, closes[:-1])
+        highs = np.maximum(opens, closes) * (1 + np.abs(rng.normal(0, 0.0002, len(times))))
+        lows = np.minimum(opens, closes) * (1 - np.abs(rng.normal(0, 0.0002, len(times))))
+        prices = np.stack([opens, highs, lows, closes], axis=1)
+        spread = max(tick, base * 0.001)
+        if what_to_show == "ASK":
+            prices += spread / 2
+        elif what_to_show == "BID":
+            prices = np.maximum(prices - spread / 2, tick)
+        elif what_to_show == "BID_ASK":
+            # time average bid, highest ask, lowest bid, time average ask
+            prices += np.array([-1, 1, -1, 1]) * spread / 2
+            prices = np.maximum(prices, tick)
+        prices = np.round(prices / tick) * tick
+        return np.column_stack([times, prices])
+
+
+class Connection(socketserver.StreamRequestHandler):
+    """
+    A single API client. Requests are read on the handler thread, and answered by a responder thread once their latency
+    passed.
+    """
+    def setup(self):
+        super().setup()
+        self.simulator = self.server.simulator
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.scheduled = []
+        self.scheduled_counter = count()
+        self.cancelled = set()
+        self.streams = {}
+        self.running = True
+        self.responder = threading.Thread(target=self.respond, daemon=True)
+        self.responder.start()
+        with self.simulator.lock:
+            self.simulator.connections.add(self)
+
+    def handle(self):
+        if self.rfile.read(4) != b"API\0":
+            return
+        versions = self.read_frame().decode().split(' ')[0]  # "v100..157", the handshake is not null terminated
+        max_version = int(versions[1:].split('..')[-1])
+        if max_version < SERVER_VERSION:
+            logging.getLogger("IBLog").error(f"Simulator: client versions {versions} are older than {SERVER_VERSION}")
+            return
+        self.send(SERVER_VERSION, dt.datetime.now().strftime('%Y%m%d %H:%M:%S EST'))
+        handlers = {OUT.START_API: self.start_api, OUT.REQ_HISTORICAL_DATA: self.req_historical_data,
+                    OUT.CANCEL_HISTORICAL_DATA: self.cancel, OUT.REQ_CONTRACT_DATA: self.req_contract_details,
+                    OUT.REQ_MKT_DATA: self.req_mkt_data, OUT.CANCEL_MKT_DATA: self.cancel,
+                    OUT.REQ_REAL_TIME_BARS: self.req_real_time_bars, OUT.CANCEL_REAL_TIME_BARS: self.cancel,
+                    OUT.REQ_SEC_DEF_OPT_PARAMS: self.req_sec_def_opt_params}
+        while (fields := self.read_message()) is not None:
+            if (handler := handlers.get(int(fields[0]))) is not None:
+                handler(fields)
+
+    def finish(self):
+        with self.simulator.lock:
+            self.simulator.connections.discard(self)
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        super().finish()
+
+    def drop(self):
+        """
+        Close the connection, everything in flight is lost
+        """
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def read_frame(self) -> bytes:
+        """
+        :return: payload of the next length prefixed frame, None if the client disconnected
+        """
+        try:
+            if len(size := self.rfile.read(4)) < 4:
+                return None
+            return self.rfile.read(struct.unpack("!I", size)[0])
+        except OSError:
+            return None  # the connection was reset
+
+    def read_message(self) -> list:
+        """
+        :return: fields of the next message, None if the client disconnected
+        """
+        if (payload := self.read_frame()) is None:
+            return None
+        return payload.decode().split('\0')[:-1]
+
+    def send(self, *fields):
+        payload = ''.join(f"{field}\0" for field in fields).encode()
+        with self.send_lock:
+            try:
+                self.wfile.write(struct.pack("!I", len(payload)) + payload)
+            except OSError:
+                pass  # the client disconnected
+
+    def send_error(self, req_id: int, error_code: int, error_string: str):
+        self.send(IN.ERR_MSG, 2, req_id, error_code, error_string)
+
+    def schedule(self, req_id: int, callback, delay: float = None):
+        """
+        Answer a request after the simulated latency, unless it's cancelled before that
+        :param delay: seconds until the answer, instead of the latency
+        """
+        latency = max(random.gauss(self.simulator.latency, self.simulator.latency_jitter), 0) if delay is None else delay
+        with self.condition:
+            heapq.heappush(self.scheduled, (time.monotonic() + latency, next(self.scheduled_counter), req_id, callback))
+            self.condition.notify()
+
+    def respond(self):
+        with self.condition:
+            while self.running:
+                if self.scheduled and self.scheduled[0][0] <= time.monotonic():
+                    req_id, callback = heapq.heappop(self.scheduled)[2:]
+                    if req_id in self.cancelled:
+                        self.cancelled.discard(req_id)
+                        continue
+                    self.condition.release()
+                    try:
+                        callback()
+                    except Exception:
+                        logging.getLogger("IBLog").exception(f"Simulator failed answering request {req_id}")
+                    finally:
+                        self.condition.acquire()
+                else:
+                    self.condition.wait(self.scheduled[0][0] - time.monotonic() if self.scheduled else None)
+
+    @staticmethod
+    def read_contract(fields: list, first: int) -> dict:
+        """
+        :param fields: fields of a request
+        :param first: position of the symbol, it's followed by secType, lastTradeDate, strike and right
+        """
+        return {"symbol": fields[first], "sec_type": fields[first + 1], "expiry": fields[first + 2],
+                "strike": round(float(fields[first + 3] or 0), 2), "right": fields[first + 4][:1].upper()}
+
+    def start_api(self, fields: list):
+        self.send(IN.NEXT_VALID_ID, 1, 1)
+        self.send(IN.MANAGED_ACCTS, 1, ACCOUNT)
+        self.send_error(-1, 2104, "Market data farm connection is OK:usfarm")
+        self.send_error(-1, 2158, "Sec-def data farm connection is OK:secdefnj")
+
+    def cancel(self, fields: list):
+        with self.condition:
+            self.cancelled.add(int(fields[2]))
+            self.streams.pop(int(fields[2]), None)
+
+    def stream(self, req_id: int, callback):
+        """
+        Call callback every realtime interval, until the request is cancelled
+        """
+        token = object()
+        with self.condition:
+            self.streams[req_id] = token
+
+        def send_next():
+            if self.streams.get(req_id) is token:
+                callback()
+                self.schedule(req_id, send_next, self.simulator.realtime_interval)
+        self.schedule(req_id, send_next)
+
+    def req_historical_data(self, fields: list):
+        # reqId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange, primaryExchange, currency,
+        # localSymbol, tradingClass, includeExpired, endDateTime, barSize, duration, useRTH, whatToShow, formatDate
+        req_id = int(fields[1])
+        contract = self.read_contract(fields, 3)
+        end = dt.datetime.strptime(' '.join(fields[15].split()[:2]), '%Y%m%d %H:%M:%S')
+        bar_size = BAR_SIZES.get(fields[16])
+        amount, unit = fields[17].split()
+        duration = int(amount) * {"S": 1, "D": 86400}.get(unit, 0)
+        what_to_show = fields[19]
+        with self.condition:
+            self.cancelled.discard(req_id)
+        if (error := self.simulator.check_request(contract, fields[15:20], bar_size, duration, what_to_show)) is not None:
+            self.schedule(req_id, lambda: self.send_error(req_id, 162, error))
+        elif random.random() >= self.simulator.drop_rate:
+            self.schedule(req_id, lambda: self.send_historical_data(req_id, contract, end, duration, bar_size, what_to_show))
+
+    def send_historical_data(self, req_id: int, contract: dict, end: dt.datetime, duration: int, bar_size: int, what_to_show: str):
+        bars = self.simulator.market.get_bars(contract, end, duration, bar_size, what_to_show)
+        date = end.strftime('%Y%m%d')
+        digits = 4 if contract["sec_type"] == "CASH" else 2
+        fields = [IN.HISTORICAL_DATA, req_id, (end - dt.timedelta(seconds=duration)).strftime('%Y%m%d  %H:%M:%S'),
+                  end.strftime('%Y%m%d  %H:%M:%S'), len(bars)]
+        for second, bar_open, high, low, close in bars.tolist():
+            second = int(second)
+            fields += [f"{date}  {second // 3600:02}:{second // 60 % 60:02}:{second % 60:02}", f"{bar_open:.{digits}f}",
+                       f"{high:.{digits}f}", f"{low:.{digits}f}", f"{close:.{digits}f}", -1, -1, -1]
+        self.send(*fields)
+        self.simulator.count_bars(len(bars))
+
+    def req_contract_details(self, fields: list):
+        # version, reqId, conId, symbol, secType, lastTradeDate, strike, right, ...
+        req_id = int(fields[2])
+        contract = self.read_contract(fields, 4)
+        self.simulator.count_request()
+        self.schedule(req_id, lambda: self.send_contract_details(req_id, contract))
+
+    def send_contract_details(self, req_id: int, contract: dict):
+        if not contract["symbol"]:
+            self.send_error(req_id, 200, "No security definition has been found for the request")
+            return
+        if contract["sec_type"] == "OPT":
+            chain = self.simulator.market.get_chain(contract["symbol"], contract["expiry"])
+            chain = [(strike, right) for strike, right in chain if (not contract["strike"] or strike == contract["strike"]) and (not contract["right"] or right == contract["right"])]
+        else:
+            chain = [(0.0, '')]
+        for strike, right in chain:
+            self.send_contract(req_id, contract, strike, right)
+        self.send(IN.CONTRACT_DATA_END, 1, req_id)
+
+    def send_contract(self, req_id: int, contract: dict, strike: float, right: str):
+        symbol, sec_type, expiry = contract["symbol"], contract["sec_type"], contract["expiry"]
+        con_id = get_seed(symbol, sec_type, expiry, strike, right) % 2 ** 31
+        is_option = sec_type == "OPT"
+        local_symbol = f"{symbol:<6}{expiry[2:]}{right}{int(strike * 1000):08}" if is_option else symbol
+        exchange = "IDEALPRO" if sec_type == "CASH" else "SMART"
+        self.send(IN.CONTRACT_DATA, 8, req_id, symbol, sec_type, expiry if is_option else "", strike, right, exchange,
+                  "USD", local_symbol, symbol, symbol, con_id, 0.01, 1, 100 if is_option else "", "LMT,MKT",
+                  exchange, 1, get_seed(symbol, "STK") % 2 ** 31 if is_option else 0, symbol, "", "", "", "", "",
+                  "US/Eastern", "", "", "", 0, 0, 1, symbol if is_option else "", "STK" if is_option else "", "", "", "")
+
+    def req_sec_def_opt_params(self, fields: list):
+        # reqId, underlyingSymbol, futFopExchange, underlyingSecType, underlyingConId
+        req_id, symbol = int(fields[1]), fields[2]
+        self.simulator.count_request()
+        self.schedule(req_id, lambda: self.send_sec_def_opt_params(req_id, symbol))
+
+    def send_sec_def_opt_params(self, req_id: int, symbol: str):
+        # the weekly series of the next 8 weeks, every chain has the same strikes
+        today = dt.date.today()
+        fridays = [today + dt.timedelta(days=(4 - today.weekday()) % 7 + 7 * week) for week in range(8)]
+        strikes = sorted({strike for strike, _ in self.simulator.market.get_chain(symbol, "")})
+        self.send(IN.SECURITY_DEFINITION_OPTION_PARAMETER, req_id, "SMART", get_seed(symbol, "STK", "", 0.0, "") % 2 ** 31,
+                  symbol, 100, len(fridays), *[friday.strftime('%Y%m%d') for friday in fridays], len(strikes), *strikes)
+        self.send(IN.SECURITY_DEFINITION_OPTION_PARAMETER_END, req_id)
+
+    def req_mkt_data(self, fields: list):
+        # version, reqId, conId, symbol, secType, lastTradeDate, strike, right, ...
+        req_id = int(fields[2])
+        contract = self.read_contract(fields, 4)
+        with self.condition:
+            self.cancelled.discard(req_id)
+        self.stream(req_id, lambda: self.send_tick(req_id, contract))
+
+    def send_tick(self, req_id: int, contract: dict):
+        spot = self.simulator.market.get_live_spot_price(contract["symbol"], contract["sec_type"], self.simulator.get_time())
+        price = round(self.simulator.market.get_base_price(contract, spot), 4)
+        self.send(IN.TICK_PRICE, 6, req_id, TickTypeEnum.LAST, price, 100, 0)
+
+    def req_real_time_bars(self, fields: list):
+        # version, reqId, conId, symbol, secType, lastTradeDate, strike, right, multiplier, exchange, primaryExchange,
+        # currency, localSymbol, tradingClass, barSize, whatToShow, useRTH
+        req_id = int(fields[2])
+        contract = self.read_contract(fields, 4)
+        what_to_show = fields[16]
+        self.simulator.count_request()
+        with self.condition:
+            self.cancelled.discard(req_id)
+        if int(fields[15]) != 5 or what_to_show not in ("TRADES", "BID", "ASK", "MIDPOINT"):
+            self.schedule(req_id, lambda: self.send_error(req_id, 420, "Invalid Real-time Query"))
+        elif not self.simulator.market.has_data(contract):
+            self.schedule(req_id, lambda: self.send_error(req_id, 354, "Requested market data is not subscribed"))
+        else:
+            self.stream(req_id, lambda: self.send_real_time_bar(req_id, contract, what_to_show))
+
+    def send_real_time_bar(self, req_id: int, contract: dict, what_to_show: str):
+        bar_time = int(self.simulator.get_time()) // 5 * 5 - 5  # the last bar that ended
+        spot = self.simulator.market.get_live_spot_price(contract["symbol"], "STK", bar_time)
+        end = dt.datetime.utcfromtimestamp(bar_time + 5)
+        if not len(bars := self.simulator.market.get_bars(contract, end, 5, 5, what_to_show, spot)):
+            return
+        _, bar_open, high, low, close = bars[0].tolist()
+        digits = 4 if contract["sec_type"] == "CASH" else 2
+        self.send(IN.REAL_TIME_BARS, 3, req_id, bar_time, f"{bar_open:.{digits}f}", f"{high:.{digits}f}",
+                  f"{low:.{digits}f}", f"{close:.{digits}f}", 0, -1, 0)
+        self.simulator.count_bars(1)
+
+
+class IBSimulator(socketserver.ThreadingTCPServer):
+    """
+    The simulated TWS. Serves any number of client connections, each on its own thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, latency: float = 0.0,
+                 latency_jitter: float = 0.0, pacing_error_rate: float = 0.0, no_data_rate: float = 0.0,
+                 drop_rate: float = 0.0, enforce_pacing: bool = False, market: SimulatedMarket = None,
+                 realtime_interval: float = 5.0, disconnect_interval: float = None):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        :param latency: mean time in seconds from a request until its answer
+        :param latency_jitter: standard deviation of the latency
+        :param pacing_error_rate: fraction of the historical requests answered with a pacing violation
+        :param no_data_rate: fraction of the option contracts that have no data
+        :param drop_rate: fraction of the historical requests that are never answered
+        :param enforce_pacing: answer with a pacing violation on requests that break IB pacing limitations
+        :param market: source of the chains and bars
+        :param realtime_interval: seconds between two real time bars and price ticks. The simulated clock of live data
+        runs 5 / realtime_interval times faster than the real one
+        :param disconnect_interval: seconds between two drops of all the connections, None to never drop them
+        """
+        super().__init__((host, port), Connection)
+        self.simulator = self
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.pacing_error_rate = pacing_error_rate
+        self.drop_rate = drop_rate
+        self.enforce_pacing = enforce_pacing
+        self.market = market if market is not None else SimulatedMarket(no_data_rate=no_data_rate)
+        self.realtime_interval = realtime_interval
+        self.disconnect_interval = disconnect_interval
+        self.start_time = (time.time(), time.monotonic())
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.sent_times = []
+        self.last_sent_time = {}
+        self.requests = 0
+        self.bars = 0
+        self.errors = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> threading.Thread:
+        """
+        Serve on a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        if self.disconnect_interval:
+            threading.Thread(target=self.drop_periodically, daemon=True).start()
+        return thread
+
+    def drop_connections(self):
+        """
+        Close all the client connections, as a restart of TWS does
+        """
+        with self.lock:
+            connections = list(self.connections)
+        logging.getLogger("IBLog").info(f"Simulator: dropping {len(connections)} connections")
+        for connection in connections:
+            connection.drop()
+
+    def drop_periodically(self):
+        while True:
+            time.sleep(self.disconnect_interval)
+            self.drop_connections()
+
+    def interrupt(self, duration: float, data_lost: bool = False):
+        """
+        Simulate TWS losing its connection to IB: 1100 is sent to all the clients, and 1101 or 1102 once it's restored.
+        Requests in flight are never answered.
+        :param duration: seconds until the connection is restored
+        :param data_lost: send 1101 (market data subscriptions were lost) instead of 1102
+        """
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            with connection.condition:
+                connection.cancelled.update(req_id for _, _, req_id, _ in connection.scheduled if data_lost or req_id not in connection.streams)
+                if data_lost:
+                    connection.streams.clear()
+            connection.send_error(-1, 1100, "Connectivity between IB and Trader Workstation has been lost.")
+        time.sleep(duration)
+        for connection in connections:
+            if data_lost:
+                connection.send_error(-1, 1101, "Connectivity between IB and TWS has been restored- data lost.")
+            else:
+                connection.send_error(-1, 1102, "Connectivity between IB and TWS has been restored- data maintained.")
+
+    def get_time(self) -> float:
+        """
+        :return: the simulated time of live data, in seconds since the epoch
+        """
+        return self.start_time[0] + (time.monotonic() - self.start_time[1]) * 5 / self.realtime_interval
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_bars(self, bars: int):
+        with self.lock:
+            self.bars += bars
+
+    def check_request(self, contract: dict, request: list, bar_size: int, duration: int, what_to_show: str) -> str:
+        """
+        Decide the fate of a historical data request
+        :return: the message of the 162 error it's answered with, None if it's answered with data
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            error = None
+            if bar_size is None or duration <= 0 or duration > MAX_DURATIONS.get(bar_size, 86400):
+                error = "Historical Market Data Service error message:Time length exceed max."
+            elif random.random() < self.pacing_error_rate:
+                error = PACING_VIOLATION
+            elif self.enforce_pacing:
+                # BID_ASK requests count twice, identical requests may not be sent within 15 seconds
+                key = (tuple(contract.values()), tuple(request))
+                self.sent_times = [sent for sent in self.sent_times if now - sent < 600]
+                if len(self.sent_times) >= 60 or now - self.last_sent_time.get(key, -15) < 15:
+                    error = PACING_VIOLATION
+                self.sent_times += [now] * get_pacing_cost(what_to_show)
+                self.last_sent_time[key] = now
+            if error is None and not self.market.has_data(contract):
+                error = f"{NO_DATA}: {contract['symbol']} {contract['expiry']} {contract['strike']} {contract['right']} {what_to_show}"
+            if error is not None:
+                self.errors += 1
+            return error
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "bars": self.bars, "errors": self.errors}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local TWS simulator")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds until a request is answered")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--pacing-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-data-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--enforce-pacing", action="store_true")
+    parser.add_argument("--realtime-interval", type=float, default=5.0, help="seconds between two real time bars")
+    parser.add_argument("--disconnect-interval", type=float, default=None, help="seconds between two drops of all the connections")
+    args = parser.parse_args()
+    simulator = IBSimulator(args.host, args.port, args.latency, args.latency_jitter, args.pacing_error_rate,
+                            args.no_data_rate, args.drop_rate, args.enforce_pacing, realtime_interval=args.realtime_interval,
+                            disconnect_interval=args.disconnect_interval)
+    logging.getLogger("IBLog").info(f"Simulator listening on {args.host}:{simulator.port}")
+    simulator.start().join()
@@ -1,5 +1,5 @@
-import time
-import threading
+import os
+import re
 import numpy as np
 import configparser
 from random import randint
@@ -17,9 +17,31 @@ class Config:
         # optional
         self.start_time = datetime.strptime('0930', '%H%M')
         self.end_time = datetime.strptime('1600', '%H%M')
-        self.request_interval = 60
+        self.request_interval = 0  # minutes, 0 for the longest duration IB allows
+        self.what_to_show = ['ASK', 'BID']
         self.pct_strikes_from_atm = 7
         self.shift_hours = 0
+        self.cache_dir = ""
+        self.chain_cache_days = 1
+        self.no_data_days = 5
+        self.request_timeout = 180
+        self.max_attempts = 5
+        self.host = "127.0.0.1"
+        self.port = 7496
+        self.client_id = randint(100, 999)
+        self.connect_timeout = 30
+        self.fast_decoding = True
+        self.gateways = []  # (host, port, client id) of each gateway requests are spread over, see IBPool
+        self.metrics_file = ""
+        self.metrics_interval = 10
+        self.live_buffer_size = 64 * 1024
+        self.max_live_lines = 100
+        self.verify_days = True
+        self.shared_memory = False
+        self.shared_memory_slots = 256
+        self.shared_memory_bars = 8192
+        self.compact_days = False
+        self.compress_days = False
 
         self.parse_config_file(path)
 
@@ -57,8 +79,78 @@ class Config:
             self.shift_hours = int(config_parsed['Optional']['shift_hours'])
         if 'request_interval' in config_parsed['Optional'].keys():
             self.request_interval = int(config_parsed['Optional']['request_interval'])
+        if 'what_to_show' in config_parsed['Optional'].keys():
+            # ASK,BID for separate requests of each side, or BID_ASK for a single request of both
+            self.what_to_show = [x.strip().upper() for x in config_parsed['Optional']['what_to_show'].split(',')]
+            if any(x not in ('ASK', 'BID', 'BID_ASK') for x in self.what_to_show):
+                raise Exception("what_to_show must be ASK,BID or BID_ASK")
         if 'pct_strikes_from_atm' in config_parsed['Optional'].keys():
             self.pct_strikes_from_atm = float(config_parsed['Optional']['pct_strikes_from_atm']) / 100
+        self.cache_dir = os.path.join(self.output_dir, 'cache')
+        if 'cache_dir' in config_parsed['Optional'].keys():
+            self.cache_dir = config_parsed['Optional']['cache_dir']
+        if 'chain_cache_days' in config_parsed['Optional'].keys():
+            self.chain_cache_days = float(config_parsed['Optional']['chain_cache_days'])
+        if 'no_data_days' in config_parsed['Optional'].keys():
+            # days after an option contract returned no data on which it is not requested again
+            self.no_data_days = float(config_parsed['Optional']['no_data_days'])
+        if 'request_timeout' in config_parsed['Optional'].keys():
+            self.request_timeout = float(config_parsed['Optional']['request_timeout'])
+        if 'max_attempts' in config_parsed['Optional'].keys():
+            self.max_attempts = int(config_parsed['Optional']['max_attempts'])
+        if 'host' in config_parsed['Optional'].keys():
+            self.host = config_parsed['Optional']['host']
+        if 'port' in config_parsed['Optional'].keys():
+            self.port = int(config_parsed['Optional']['port'])
+        if 'client_id' in config_parsed['Optional'].keys():
+            self.client_id = int(config_parsed['Optional']['client_id'])
+        if 'connect_timeout' in config_parsed['Optional'].keys():
+            self.connect_timeout = float(config_parsed['Optional']['connect_timeout'])
+        if 'fast_decoding' in config_parsed['Optional'].keys():
+            # decode all the bars of a historical data message at once into numpy, see IBDecoder. bin output only
+            self.fast_decoding = config_parsed['Optional'].getboolean('fast_decoding')
+        if 'gateways' in config_parsed['Optional'].keys():
+            # host:port or host:port:client_id of each gateway, the first one replaces host, port and client_id
+            self.gateways = [self.parse_gateway(x) for x in config_parsed['Optional']['gateways'].split(',') if x.strip()]
+            if self.gateways:
+                self.host, self.port, self.client_id = self.gateways[0]
+        self.metrics_file = os.path.join(self.output_dir, 'metrics.prom')
+        if 'metrics_file' in config_parsed['Optional'].keys():
+            self.metrics_file = config_parsed['Optional']['metrics_file']  # .json for JSON, Prometheus text otherwise
+        if 'metrics_interval' in config_parsed['Optional'].keys():
+            self.metrics_interval = float(config_parsed['Optional']['metrics_interval'])
+        if 'live_buffer_size' in config_parsed['Optional'].keys():
+            self.live_buffer_size = int(config_parsed['Optional']['live_buffer_size'])  # bars kept in memory in live mode
+        if 'max_live_lines' in config_parsed['Optional'].keys():
+            # real time bars subscriptions open at the same time, each takes a market data line of the account
+            self.max_live_lines = int(config_parsed['Optional']['max_live_lines'])
+        if 'verify_days' in config_parsed['Optional'].keys():
+            # scan the collected days for duplicate and missing bars, and fetch the missing ones again, see IBGaps
+            self.verify_days = config_parsed['Optional'].getboolean('verify_days')
+        if 'shared_memory' in config_parsed['Optional'].keys():
+            # publish the bars to shared memory as well, see IBShared
+            self.shared_memory = config_parsed['Optional'].getboolean('shared_memory')
+        if 'shared_memory_slots' in config_parsed['Optional'].keys():
+            self.shared_memory_slots = int(config_parsed['Optional']['shared_memory_slots'])  # contracts and sides per day
+        if 'shared_memory_bars' in config_parsed['Optional'].keys():
+            self.shared_memory_bars = int(config_parsed['Optional']['shared_memory_bars'])  # bars kept per contract and side
+        if 'compact_days' in config_parsed['Optional'].keys():
+            # write a columnar file with the sides of each bar joined beside every complete day, see IBCompact
+            self.compact_days = config_parsed['Optional'].getboolean('compact_days')
+        if 'compress_days' in config_parsed['Optional'].keys():
+            # replace the bars files of the complete days by compressed files once the run ends, see IBCodec. bin output only
+            self.compress_days = config_parsed['Optional'].getboolean('compress_days')
+
+    @staticmethod
+    def parse_gateway(gateway: str) -> tuple:
+        """
+        :param gateway: host:port or host:port:client_id
+        :return: (host, port, client id), with a random client id if it's not specified
+        """
+        parts = [x.strip() for x in gateway.split(':')]
+        if len(parts) not in (2, 3):
+            raise Exception(f"Gateway must be host:port or host:port:client_id, got '{gateway.strip()}'")
+        return parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else randint(100, 999)
 
     def get_dates_list(self, start_date: str, days_to_get: int):
         """
@@ -80,21 +172,46 @@ class Config:
         self.dates = [x for x in date_list if x.weekday() < 5]
 
 
-def run_loop(app):
-    app.run()
+def get_output_file_name(config: Config, asset: str, date: datetime) -> str:
+    """
+    :param config: config params
+    :param asset: requested asset, as written in the config
+    :param date: requested date
+    :return: path of the output file of the asset on that date, its directory is created if needed
+    """
+    base_asset, _ = is_weekly_options(asset)
+    directory = os.path.join(config.output_dir, base_asset)
+    directory = f"{directory}_OPTIONS" if config.sec_type == 'OPT' else directory
+    os.makedirs(directory, exist_ok=True)
+    file_name_ending = f"OPTION-{date.date()}" if config.sec_type == 'OPT' else f"{date.date()}"
+    return os.path.join(directory, f"RawData-{asset}-{file_name_ending}.{config.output_type}")
+
+
+def parse_output_file_name(path: str) -> (str, str, datetime):
+    """
+    The reverse of get_output_file_name, for files that have no header
+    :param path: path of an output file
+    :return: asset, sec type and date. OPT files are named OPTION and kept in an _OPTIONS directory, FX assets are
+    currency pairs like EUR.USD
+    """
+    match = re.fullmatch(r'RawData-(.+?)-(OPTION-)?(\d{4}-\d{2}-\d{2})', os.path.splitext(os.path.basename(path))[0])
+    if match is None:
+        raise Exception(f"{path} is not named as an output file")
+    asset = match.group(1)
+    if match.group(2) or os.path.basename(os.path.dirname(os.path.abspath(path))).endswith("_OPTIONS"):
+        sec_type = 'OPT'
+    else:
+        sec_type = 'FX' if '.' in asset else 'STK'
+    return asset, sec_type, datetime.strptime(match.group(3), '%Y-%m-%d')
 
 
 def init_app_listener(app):
     """
-    Initiate connection with TWS
-    :param app: current application
+    Initiate connection with TWS, and return once it's ready for requests. The connection is restored whenever it's
+    lost, see IBConnection
+    :param app: current application, its connection holds the host, port and client id of TWS
     """
-    app.connect('127.0.0.1', 7496, randint(100, 999))
-    time.sleep(5)
-    # Start the socket in a thread
-    api_thread = threading.Thread(target=run_loop, args=[app])
-    api_thread.setDaemon(True)
-    api_thread.start()
+    app.connection.connect()
 
 
 def get_req_id(used_ids):
@@ -109,6 +226,18 @@ def get_req_id(used_ids):
     return req_id
 
 
+def get_bar_time(bar_date: str, shift_hours: int = 0) -> str:
+    """
+    Time of a bar as written to txt files
+    :param bar_date: date of the bar as sent by TWS, 'YYYYMMDD  HH:MM:SS'
+    :param shift_hours: hours to subtract from the time
+    :return: the shifted time as HHMMSS
+    """
+    if not shift_hours:
+        return bar_date[10:12] + bar_date[13:15] + bar_date[16:18]
+    return (datetime.strptime(bar_date, '%Y%m%d  %H:%M:%S') - timedelta(hours=shift_hours)).strftime('%H%M%S')
+
+
 def get_opt_arr_from_line(line: str):
     fields = line.split(',')
     fields[-1] = fields[-1].strip('\n')
@@ -0,0 +1,223 @@
+import os
+import time
+import queue
+import logging
+import threading
+import numpy as np
+
+from IBMetrics import Metrics
+from IBShared import SharedBarPublisher
+
+# Layout of a single bar as written to the binary output file. Call is represented as 1 and Put as 0, Ask as 1 and Bid as 0.
+# Time is the (shifted) time of the bar in seconds since the epoch, as datetime64 so its unit is part of the dtype.
+OPT_BAR_DTYPE = np.dtype([('time', '<M8[s]'), ('strike', '<f4'), ('right', '<f4'), ('side', '<f4'),
+                          ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+BAR_DTYPE = np.dtype([('time', '<M8[s]'), ('side', '<f4'), ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+# Layouts of files written before, where time was HHMMSS as float
+LEGACY_OPT_BAR_DTYPE = np.dtype([('time', '<f4'), ('strike', '<f4'), ('right', '<f4'), ('side', '<f4'),
+                                 ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+LEGACY_BAR_DTYPE = np.dtype([('time', '<f4'), ('side', '<f4'), ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+TIME_LENGTH = len("YYYYMMDD  HH:MM:SS")
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+_CLOSE = object()
+
+
+def get_staging_dtype(dtype: np.dtype) -> np.dtype:
+    """
+    Bars are buffered with their time as the string TWS sent, and parsed only when the buffer is flushed
+    :return: dtype of a buffered record: dtype with a datetime64 time replaced by a string
+    """
+    if 'time' not in dtype.names or dtype['time'].kind != 'M':
+        return dtype
+    return np.dtype([(name, f'S{TIME_LENGTH}' if name == 'time' else dtype[name]) for name in dtype.names])
+
+
+def parse_bar_times(dates: np.ndarray, shift_hours: int = 0) -> np.ndarray:
+    """
+    Vectorized parsing of bar times as sent by TWS with formatDate 1, 'YYYYMMDD  HH:MM:SS' (or 'YYYYMMDD' for daily
+    bars). The digits are read straight from the bytes, and the date is converted to days with the days-from-civil
+    algorithm, so there is no per-bar string handling at all.
+    :param dates: array of the time strings, as bytes
+    :param shift_hours: hours to subtract from the times. Shifting seconds since the epoch is correct across midnight
+    :return: array of datetime64[s]
+    """
+    digits = np.ascontiguousarray(dates, dtype=f'S{TIME_LENGTH}').view(np.uint8).reshape(len(dates), TIME_LENGTH)
+    digits = np.maximum(digits.T.astype(np.int32) - ord('0'), 0)  # padding of short strings counts as 0
+
+    def number(first: int, length: int) -> np.ndarray:
+        result = digits[first].copy()
+        for position in range(first + 1, first + length):
+            result *= 10
+            result += digits[position]
+        return result
+
+    year, month, day = number(0, 4), number(4, 2), number(6, 2)
+    # http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    seconds = days.astype(np.int64) * 86400 + number(10, 2) * 3600 + number(13, 2) * 60 + number(16, 2) - shift_hours * 3600
+    return seconds.astype('<M8[s]')
+
+
+class BarWriter(threading.Thread):
+    """
+    Writes the bars to the output file on a background thread, so disk latency never blocks the socket decoding.
+    Bars are queued by put(), collected into a preallocated buffer, and written in large chunks once the buffer is
+    full or flush_interval seconds have passed. Closing the writer flushes and fsyncs the file.
+    When the time field is a datetime64, bars are queued with the time string of TWS, and the whole buffer is parsed
+    and shifted at once when it's flushed.
+    Binary records can also be published to shared memory as they are written, see IBShared.
+    """
+    def __init__(self, output_file, dtype: np.dtype = None, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, metrics: Metrics = None, shift_hours: int = 0,
+                 publisher: SharedBarPublisher = None):
+        """
+        :param output_file: open file object. binary when dtype is given, text otherwise
+        :param dtype: numpy dtype of a single record, or None for text records
+        :param buffer_size: number of records to collect before writing them
+        :param flush_interval: maximal time in seconds a record waits in memory before being written
+        :param metrics: metrics of the run, written bars, queue depth and disk time are added to them
+        :param shift_hours: hours to subtract from the times of the bars
+        :param publisher: shared memory segment the records are published to, binary records only
+        """
+        super().__init__(daemon=True)
+        self.output_file = output_file
+        self.dtype = dtype
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.shift_hours = shift_hours
+        self.publisher = publisher
+        self.queue = queue.SimpleQueue()
+        self.buffer = np.empty(buffer_size, dtype=get_staging_dtype(dtype)) if dtype is not None else []
+        self.buffered = 0
+        self.exception = None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.label = os.path.basename(getattr(output_file, 'name', str(id(self))))
+        self.start()
+
+    def put(self, record):
+        """
+        Queue a record for writing. Called from the EReader thread, so it must stay cheap.
+        :param record: tuple matching the dtype, with the time as sent by TWS, or a string line for text output
+        """
+        self.queue.put(record)
+
+    def put_rows(self, rows: np.ndarray):
+        """
+        Queue records that are already of dtype, with their times parsed, to be written as they are
+        :param rows: array of dtype
+        """
+        self.queue.put(rows)
+
+    def call_after_flush(self, callback):
+        """
+        Run callback on the writer thread once every record queued before it is written to the file.
+        Used to journal completed requests only after their bars reached the file.
+        :param callback: function without arguments
+        """
+        self.queue.put(callback)
+
+    def close(self):
+        """
+        Write everything that is still queued, fsync and close the output file
+        """
+        self.queue.put(_CLOSE)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def run(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(self.flush_interval - (time.monotonic() - last_flush), 0.001))
+                except queue.Empty:
+                    item = None
+                if item is _CLOSE:
+                    break
+                if callable(item):
+                    self.flush()
+                    with self.metrics.timer("ib_disk_seconds_total", op="write"):
+                        self.output_file.flush()
+                    item()
+                elif isinstance(item, np.ndarray):
+                    self.write_rows(item)
+                elif item is not None:
+                    self.add(item)
+                if self.buffered and (self.buffered >= self.buffer_size or time.monotonic() - last_flush >= self.flush_interval):
+                    self.flush()
+                if not self.buffered:
+                    last_flush = time.monotonic()
+            self.flush()
+            with self.metrics.timer("ib_disk_seconds_total", op="fsync"):
+                self.output_file.flush()
+                os.fsync(self.output_file.fileno())
+        except Exception as e:
+            logging.getLogger("IBLog").exception("Writer thread failed")
+            self.exception = e
+        finally:
+            self.metrics.remove_gauge("ib_writer_queue_depth", file=self.label)
+            self.output_file.close()
+
+    def add(self, record):
+        """
+        Add a record to the buffer
+        :param record: tuple matching the dtype, or a string line for text output
+        """
+        if self.dtype is not None:
+            self.buffer[self.buffered] = record
+        else:
+            self.buffer.append(record)
+        self.buffered += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records to the file in a single write
+        """
+        if not self.buffered:
+            return
+        with self.metrics.timer("ib_disk_seconds_total", op="write"):
+            if self.dtype is not None:
+                rows = self.get_rows()
+                rows.tofile(self.output_file)
+            else:
+                self.output_file.write(''.join(self.buffer))
+                self.buffer.clear()
+        if self.publisher is not None and self.dtype is not None:
+            self.publisher.publish(rows)
+        self.metrics.inc("ib_bars_written_total", self.buffered)
+        self.metrics.set_gauge("ib_writer_queue_depth", self.queue.qsize(), file=self.label)
+        self.buffered = 0
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        Write records of dtype right after the buffered ones
+        """
+        self.flush()
+        with self.metrics.timer("ib_disk_seconds_total", op="write"):
+            rows.tofile(self.output_file)
+        self.metrics.inc("ib_bars_written_total", len(rows))
+        if self.publisher is not None:
+            self.publisher.publish(rows)
+
+    def get_rows(self) -> np.ndarray:
+        """
+        :return: the buffered records converted to dtype
+        """
+        buffered = self.buffer[:self.buffered]
+        if self.buffer.dtype == self.dtype:
+            return buffered
+        rows = np.empty(self.buffered, dtype=self.dtype)
+        for name in self.dtype.names:
+            rows[name] = parse_bar_times(buffered[name], self.shift_hours) if name == 'time' else buffered[name]
+        return rows
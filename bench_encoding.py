@@ -0,0 +1,122 @@
+"""
+Micro-benchmark of the per-bar encoding cost of binary output, for each sec type.
+'old' is the previous path: parse and shift the time with strptime/strftime, format the bar to a csv line and parse it
+back with get_opt_arr_from_line/get_arr_from_line.
+'new' is the typed path: encode_bar straight into a buffered record, and the batch parsing of the buffered times when
+the buffer is flushed, amortized per bar.
+Then a whole HISTORICAL_DATA message of an hour of 5 secs bars is decoded and encoded, once by ibapi's decoder with a
+callback per bar, and once by BatchDecoder into a single array.
+Usage: python bench_encoding.py [number of bars]
+"""
+import sys
+import timeit
+import datetime as dt
+import numpy as np
+
+from ibapi.common import BarData
+from ibapi.contract import Contract
+from ibapi.decoder import Decoder
+from ibapi.message import IN
+
+from IBApp import DataRequest, OPT, STK, FX
+from IBDecoder import BatchDecoder
+from IBUtils import get_opt_arr_from_line, get_arr_from_line
+from IBWriter import get_staging_dtype, parse_bar_times, LEGACY_OPT_BAR_DTYPE, LEGACY_BAR_DTYPE, DEFAULT_BUFFER_SIZE
+
+
+def old_time(bar_date: str, shift_hours: int = 0) -> str:
+    update_time = dt.datetime.strptime(bar_date, '%Y%m%d  %H:%M:%S')
+    update_time = update_time.replace(hour=update_time.hour - shift_hours)
+    return update_time.strftime('%H%M%S')
+
+
+def old_opt_encoding(data_request: DataRequest, bar) -> tuple:
+    strike = data_request.contract.strike
+    call_or_put = data_request.contract.right
+    bid_or_ask = "S" if data_request.bid_or_ask == "ASK" else "B"
+    string = f"{old_time(bar.date)},{strike},{call_or_put},{bid_or_ask},{format(bar.open, '.3f')},{format(bar.high, '.3f')},{format(bar.low, '.3f')},{format(bar.close, '.3f')}\n"
+    return tuple(get_opt_arr_from_line(string))
+
+
+def old_encoding(data_request: DataRequest, bar) -> tuple:
+    bid_or_ask = "S" if data_request.bid_or_ask == "ASK" else "B"
+    string = f"{old_time(bar.date)},{bid_or_ask},{format(bar.open, '.3f')},{format(bar.high, '.3f')},{format(bar.low, '.3f')},{format(bar.close, '.3f')}\n"
+    return tuple(get_arr_from_line(string))
+
+
+def get_bar() -> BarData:
+    bar = BarData()
+    bar.date = "20210111  09:30:05"
+    bar.open, bar.high, bar.low, bar.close = 3.45, 3.5, 3.4, 3.47
+    return bar
+
+
+def get_contract(sec_type: str) -> Contract:
+    contract = Contract()
+    contract.secType = sec_type
+    contract.strike = 380.0 if sec_type == "OPT" else 0.0
+    contract.right = "C" if sec_type == "OPT" else ""
+    return contract
+
+
+def bench(number: int):
+    bar = get_bar()
+    print(f"{'sec type':<10}{'old us/bar':>12}{'new us/bar':>12}{'speedup':>10}")
+    for sec_type, cls, old, legacy_dtype in (("OPT", OPT, old_opt_encoding, LEGACY_OPT_BAR_DTYPE),
+                                             ("STK", STK, old_encoding, LEGACY_BAR_DTYPE), ("FX", FX, old_encoding, LEGACY_BAR_DTYPE)):
+        data_request = DataRequest(get_contract(sec_type), None, 60, "ASK")
+        old_buffer = np.empty(1, dtype=legacy_dtype)
+        buffer = np.array([cls.encode_bar(data_request, bar)] * DEFAULT_BUFFER_SIZE, dtype=get_staging_dtype(cls.bar_dtype))
+        # assign into a record the same way the writer thread does, so both paths pay for the final conversion
+        old_cost = timeit.timeit(lambda: old_buffer.__setitem__(0, old(data_request, bar)), number=number) / number * 1e6
+        new_cost = timeit.timeit(lambda: buffer.__setitem__(0, cls.encode_bar(data_request, bar)), number=number) / number * 1e6
+        new_cost += timeit.timeit(lambda: parse_bar_times(buffer['time']), number=10) / 10 / len(buffer) * 1e6
+        print(f"{sec_type:<10}{old_cost:>12.3f}{new_cost:>12.3f}{old_cost / new_cost:>9.1f}x")
+
+
+class EncodingWrapper:
+    """
+    Stands in for IBapi: encodes the bars of the message the way the app does, without writing them
+    """
+    def __init__(self, app, data_request: DataRequest):
+        self.app = app
+        self.data_request = data_request
+        self.records = []
+
+    def historicalData(self, req_id: int, bar):
+        self.records.append(self.app.encode_bar(self.data_request, bar))
+
+    def historicalDataBatch(self, req_id: int, bars: np.ndarray):
+        self.records = self.app.encode_bars(self.data_request, bars)
+
+    def historicalDataEnd(self, req_id: int, start: str, end: str):
+        pass
+
+
+def get_historical_data_message(bars: int = 720) -> tuple:
+    """
+    :return: fields of a HISTORICAL_DATA message, as read from the socket
+    """
+    start = dt.datetime(2021, 1, 11, 9, 30)
+    fields = [str(IN.HISTORICAL_DATA), "1234", "20210111  09:30:00", "20210111  10:30:00", str(bars)]
+    for i in range(bars):
+        fields += [(start + dt.timedelta(seconds=5 * i)).strftime('%Y%m%d  %H:%M:%S'), "3.45", "3.5", "3.4", "3.47", "-1", "-1.0", "-1"]
+    return tuple(field.encode() for field in fields)
+
+
+def bench_decoding(number: int):
+    fields = get_historical_data_message()
+    data_request = DataRequest(get_contract("OPT"), None, 60, "ASK")
+    app = OPT.__new__(OPT)  # only the encoding methods are used
+    app.bar_dtype, app.shift_hours = OPT.bar_dtype, 0
+    print(f"\n{'message of':<12}{'ibapi ms':>10}{'batch ms':>10}{'speedup':>10}")
+    costs = []
+    for decoder_class in (Decoder, BatchDecoder):
+        decoder = decoder_class(EncodingWrapper(app, data_request), 157)
+        costs.append(timeit.timeit(lambda: decoder.interpret(fields), number=number) / number * 1e3)
+    print(f"{'720 bars':<12}{costs[0]:>10.3f}{costs[1]:>10.3f}{costs[0] / costs[1]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    bench_decoding(200)
@@ -0,0 +1,98 @@
+"""
+End-to-end throughput benchmark of the collection flow against the local TWS simulator, for each sec type.
+Every run collects simulated days through getHistoricalData.get_historical_data, over a real socket, and reports the
+bars per second, requests per minute and wall time per day. IB pacing limitations are lifted except for the number of
+requests in flight, so the numbers measure our own overhead. The last column is the time per day the same requests
+would take under the real limit of 60 requests per 10 minutes.
+Usage: python bench_throughput.py [--days 2] [--latency 0.05] [--sec-types OPT,STK,FX] [--pacing-error-rate 0.01]
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+import datetime as dt
+
+from IBApp import IBFactory
+from IBFormat import BarFile
+from IBPacing import PacingScheduler, MAX_IN_FLIGHT, MAX_REQUESTS_PER_PERIOD, PACING_PERIOD
+from IBSimulator import IBSimulator
+from IBUtils import Config
+from getHistoricalData import get_historical_data
+
+ASSETS = {"OPT": "SPY", "STK": "SPY", "FX": "EUR.USD"}
+FIRST_DATE = dt.datetime(2021, 1, 11)
+
+
+def get_dates(days: int) -> list:
+    dates = []
+    date = FIRST_DATE
+    while len(dates) < days:
+        if date.weekday() < 5:
+            dates.append(date)
+        date += dt.timedelta(days=1)
+    return dates
+
+
+def write_config(directory: str, sec_type: str, days: int, port: int) -> str:
+    """
+    :return: path of a config file collecting the simulated days of a single asset
+    """
+    path = os.path.join(directory, f"{sec_type}.ini")
+    with open(path, 'w') as f:
+        f.write(f"[General]\noutput_type = bin\noutput_dir = {os.path.join(directory, sec_type)}\nsec_type = {sec_type}\n"
+                f"assets = {ASSETS[sec_type]}\nstart_date = {','.join(date.strftime('%Y%m%d') for date in get_dates(days))}\n"
+                f"[Optional]\nstart_time = 0930\nend_time = 1600\nrequest_interval = 60\npct_strikes_from_atm = 5\n"
+                f"host = 127.0.0.1\nport = {port}\nclient_id = {100 + len(os.listdir(directory))}\n")
+    return path
+
+
+def count_bars(output_dir: str) -> int:
+    bars = 0
+    for directory, _, files in os.walk(output_dir):
+        bars += sum(len(BarFile(os.path.join(directory, name))) for name in files if name.endswith(".bin"))
+    return bars
+
+
+def bench_sec_type(simulator: IBSimulator, directory: str, sec_type: str, days: int) -> dict:
+    config = Config(write_config(directory, sec_type, days, simulator.port))
+    app = IBFactory.createIBapi(config)
+    app.pacing = PacingScheduler(max_requests=10 ** 9, max_in_flight=MAX_IN_FLIGHT, identical_period=0, safety_margin=0)
+    # time from the first message of TWS, so the connection setup is not measured
+    connected_times = []
+    on_next_valid_id = app.nextValidId
+    app.nextValidId = lambda order_id: (connected_times.append(time.monotonic()), on_next_valid_id(order_id))
+    stats_before = simulator.get_stats()
+    get_historical_data(app, config)
+    wall_time = time.monotonic() - connected_times[0]
+    app.connection.close()
+    stats = {key: value - stats_before[key] for key, value in simulator.get_stats().items()}
+    return {"sec_type": sec_type, "wall_time": wall_time, "days": days, "bars": count_bars(config.output_dir), **stats}
+
+
+def main(args):
+    logging.getLogger("IBLog").setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("MainLogger").setLevel(logging.INFO if args.verbose else logging.WARNING)
+    simulator = IBSimulator(port=0, latency=args.latency, latency_jitter=args.latency / 2,
+                            pacing_error_rate=args.pacing_error_rate, no_data_rate=args.no_data_rate)
+    simulator.start()
+    print(f"{'sec type':<10}{'days':>6}{'requests':>10}{'bars':>10}{'bars/s':>10}{'req/min':>10}{'s/day':>8}{'paced min/day':>15}")
+    with tempfile.TemporaryDirectory() as directory:
+        for sec_type in args.sec_types.split(','):
+            result = bench_sec_type(simulator, directory, sec_type.strip().upper(), args.days)
+            paced_minutes = result["requests"] / MAX_REQUESTS_PER_PERIOD * PACING_PERIOD / 60 / result["days"]
+            print(f"{result['sec_type']:<10}{result['days']:>6}{result['requests']:>10}{result['bars']:>10}"
+                  f"{result['bars'] / result['wall_time']:>10.0f}{result['requests'] / result['wall_time'] * 60:>10.0f}"
+                  f"{result['wall_time'] / result['days']:>8.2f}{paced_minutes:>15.1f}")
+    simulator.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against the TWS simulator")
+    parser.add_argument("--days", type=int, default=2, help="number of days collected per sec type")
+    parser.add_argument("--sec-types", default="OPT,STK,FX")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean seconds until the simulator answers a request")
+    parser.add_argument("--pacing-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-data-rate", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true")
+    main(parser.parse_args())
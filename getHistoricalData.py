@@ -1,38 +1,25 @@
-import time
 import os
 import tkinter as tk
 import logging
+import datetime as dt
 from tkinter import messagebox
-from datetime import datetime, timedelta
 
-from IBApp import DataRequest, IBFactory
-from IBUtils import init_app_listener, is_weekly_options, Config
+from IBApp import DataRequest, DayJob, IBFactory
+from IBUtils import get_output_file_name, is_weekly_options, Config
+from IBJournal import is_day_complete
+from IBPipeline import JobPipeline
+from IBGaps import verify_day
+from IBCodec import compress
+from IBCompact import compact
+from IBMetrics import MetricsReporter
+from IBPool import IBPool
+from IBPlanner import RequestPlanner, predict_wall_time, format_duration
 
 logging.getLogger("MainLogger")
 logging.basicConfig(format='%(message)s')
 logging.getLogger("MainLogger").setLevel(logging.INFO)
 
 
-def check_pacing_violations(app):
-    """
-    Only 60 data request are allowed in 10 minutes, and 50 request may be active at the same time.
-    We need to check there are no violations of these limitations before sending a new data request.
-    :param app: the current IBapi object
-    """
-    while not app.isConnected():
-        time.sleep(1)
-
-    # check if the first request in the queue was sent more than 10 minutes ago. if so, remove it from queue.
-    while len(app.sent_time_queue) > 58:
-        if (datetime.now() - app.sent_time_queue[0]).seconds / 60 > 10:
-            app.sent_time_queue.pop(0)
-        time.sleep(0.01)
-
-    # check that there are no more than 50 open requests
-    while app.open_requests > 49:
-        time.sleep(0.01)
-
-
 def is_file_exists(filepath: str) -> bool:
     """
     If file already exists, ask whether to overwrite or not.
@@ -48,78 +35,125 @@ def is_file_exists(filepath: str) -> bool:
     return False
 
 
-def get_times_and_interval(start_time: datetime, end_time: datetime, date: datetime, request_interval: int) -> (datetime, int, datetime):
+def get_day_jobs(config: Config) -> list:
     """
-    The first request might have a shorter span since it's not guaranteed the requested interval will fit completely to
-    the day. for example trading in the US starts at 9:30 and ends at 16:00 so if we want a 60 minutes intervals, the first
-    one will be only 30 minutes.
-    :param start_time: start of trading time
-    :param end_time: end of trading time
-    :param date: requested date
-    :param request_interval: interval
-    :return:
+    Build the list of days to collect, for all assets and dates in the config.
+    Days that are already complete are skipped, and so are existing files we don't want to overwrite. Asking about
+    them upfront means no question pops in the middle of a run.
+    :param config: config params
+    :return: list of DayJob objects, in order
     """
-    tmp = date.replace(hour=end_time.hour, minute=end_time.minute)
-    start_time = date.replace(hour=start_time.hour, minute=start_time.minute)
-    while tmp - timedelta(minutes=request_interval) > start_time:
-        tmp -= timedelta(minutes=request_interval)
-    query_time = tmp
-    end_time = date.replace(hour=end_time.hour, minute=end_time.minute) + timedelta(minutes=5)
-    interval_size = (query_time - start_time).seconds / 60
-    return end_time, int(interval_size), query_time
-
-
-def main(config: Config):
-    app = IBFactory.createIBapi(config)
-
-    logging.getLogger("MainLogger").info(''.join(["Dates: "] + [date.strftime('%d/%m/%Y') + ", " for date in config.dates] + ["\n"]))
-
-    init_app_listener(app)
-
+    day_jobs = []
     for asset in config.assets:
-        base_asset, is_weekly = is_weekly_options(asset)  # decide if that's weekly options or not
-
-        # set output directory for files
-        directory = os.path.join(config.output_dir, base_asset)
-        directory = f"{directory}_OPTIONS" if config.sec_type == 'OPT' else directory
-        os.makedirs(directory, exist_ok=True)
-
         for date in config.dates:
-            start_timer = datetime.now()
-            logging.getLogger("MainLogger").info(f"{asset} - {date.strftime('%Y%m%d')}")
-
-            app.get_all_needed_contracts(base_asset, date, is_weekly, config)
+            file_name = get_output_file_name(config, asset, date)
 
-            end_time, interval_size, query_time = get_times_and_interval(config.start_time, config.end_time, date, config.request_interval)
-
-            file_name_ending = f"OPTION-{query_time.date()}" if config.sec_type == 'OPT' else f"{query_time.date()}"
-            file_name = os.path.join(directory, f"RawData-{asset}-{file_name_ending}.{config.output_type}")
-
-            if is_file_exists(file_name):
+            # a journal beside the output file means a previous run of this day was interrupted, so we resume it
+            journal_path = f"{file_name}.journal"
+            if is_day_complete(journal_path):
+                logging.getLogger("MainLogger").info(f"{file_name} is already complete")
+                continue
+            if not os.path.exists(journal_path) and is_file_exists(file_name):
                 # if file already exists and we don't want to overwrite - continue to next date
                 continue
-            app.output_file = open(file_name, f"{'w+' if app.output_type == 'txt' else 'wb+'}")
+            day_jobs.append(DayJob(asset, date, file_name))
+    return day_jobs
 
-            while query_time < end_time:
-                app.remove_contracts()
 
-                contracts_to_get = app.get_wanted_contracts(asset)
-                for contract in contracts_to_get:
-                    check_pacing_violations(app)
-                    app.send_historical_data_request(DataRequest(contract, query_time, interval_size, 'ASK'))
+def main(config: Config):
+    get_historical_data(IBFactory.createIBapi(config), config)
 
-                    check_pacing_violations(app)
-                    app.send_historical_data_request(DataRequest(contract, query_time, interval_size, 'BID'))
 
-                interval_size = config.request_interval
-                query_time += timedelta(minutes=interval_size)
-            while app.open_requests > 0:
-                time.sleep(0.1)
-            app.output_file.close()
-            logging.getLogger("MainLogger").info(f"Process time of day - {divmod((datetime.now() - start_timer).total_seconds(), 60)}")
+def get_historical_data(app, config: Config):
+    """
+    Collect all the days of the config
+    :param app: the IBapi instance, not connected yet
+    :param config: config params
+    """
+    logging.getLogger("MainLogger").info(''.join(["Dates: "] + [date.strftime('%d/%m/%Y') + ", " for date in config.dates] + ["\n"]))
 
-    while app.open_requests > 0:
-        time.sleep(0.1)
+    day_jobs = get_day_jobs(config)
+
+    planner = RequestPlanner(config)
+    logging.getLogger("MainLogger").info(planner.describe([day_job.date for day_job in day_jobs], None if config.sec_type == 'OPT' else 1))
+
+    # metrics are written periodically during the run, see IBMetrics
+    reporter = MetricsReporter(app.metrics, config.metrics_file, config.metrics_interval) if config.metrics_file else None
+    if reporter is not None:
+        reporter.start()
+
+    # with several gateways the requests are spread over all of them, app resolves the contracts and manages the days
+    pool = IBPool(app, config)
+    with app.metrics.phase("connect"):
+        pool.connect()
+
+    if config.sec_type == 'OPT':
+        # the expiries of all the days of an asset are found at once, the chain of each day is then resolved for its expiry
+        for asset in config.assets:
+            base_asset, is_weekly = is_weekly_options(asset)
+            asset_jobs = [day_job for day_job in day_jobs if day_job.asset == asset]
+            expiries = app.get_expiries(base_asset, [day_job.date for day_job in asset_jobs], is_weekly)
+            for day_job, expiry in zip(asset_jobs, expiries):
+                day_job.expiry = dt.datetime.combine(expiry.astype(dt.date), dt.time())
+            logging.getLogger("MainLogger").info(f"{asset}: {len(asset_jobs)} days over {len(set(expiries.tolist()))} expiries")
+
+    # the contracts of the next day are resolved while the requests of the current one are still in flight, and a
+    # day is closed in the background once its last request ends
+    with app.metrics.phase("send"):
+        for day_number, day_job in enumerate(JobPipeline(app, config, day_jobs)):
+            app.start_day(day_job)
+            day_cost = planner.get_pacing_cost(day_job.date, len(app.get_wanted_contracts(day_job)))
+            logging.getLogger("MainLogger").info(f"{day_job.asset} - {day_job.date.strftime('%Y%m%d')}: {day_cost} pacing units, predicted wall time of the remaining days {format_duration(predict_wall_time(day_cost * (len(day_jobs) - day_number), sessions=len(pool)))}")
+
+            for query_time, interval_size in planner.get_windows(day_job.date):
+                app.remove_contracts(day_job)
+
+                contracts_to_get = app.get_wanted_contracts(day_job)
+                for contract in contracts_to_get:
+                    for bid_or_ask in planner.what_to_show:
+                        data_request = DataRequest(contract, query_time, interval_size, bid_or_ask, day_job)
+                        if not day_job.journal.is_done(data_request):
+                            # sending blocks until IB pacing limitations allow the request
+                            pool.send_historical_data_request(data_request)
+            app.end_day(day_job)
+
+    with app.metrics.phase("drain"):
+        for day_job in day_jobs:
+            day_job.done.wait()
+        pool.wait_until_idle()
+    app.no_data_registry.save()
+
+    # duplicates are dropped and missing bars are requested again, once per run
+    if config.verify_days:
+        with app.metrics.phase("verify"):
+            # days with requests that were given up on are resumed by the next run, they're verified once complete
+            refetch_jobs = [(day_job, refetch_job) for day_job in day_jobs
+                            if not day_job.failed and (refetch_job := verify_day(app, config, day_job, pool)) is not None]
+            for day_job, refetch_job in refetch_jobs:
+                refetch_job.done.wait()
+                day_job.failed += refetch_job.failed
+            pool.wait_until_idle()
+
+    if config.compact_days:
+        with app.metrics.phase("compact"):
+            for day_job in day_jobs:
+                if not day_job.failed and is_day_complete(f"{day_job.file_name}.journal") and os.path.exists(day_job.file_name):
+                    logging.getLogger("MainLogger").info(f"{day_job.file_name}: compacted into {compact(day_job.file_name, sec_type=config.sec_type)}")
+
+    # the journal of a compressed day stays, so the day is still skipped by the next runs. A day with requests that
+    # were given up on keeps its bars file, the next run appends to it
+    if config.compress_days and config.output_type == "bin":
+        with app.metrics.phase("compress"):
+            for day_job in day_jobs:
+                if not day_job.failed and is_day_complete(f"{day_job.file_name}.journal") and os.path.exists(day_job.file_name):
+                    size = os.path.getsize(day_job.file_name)
+                    compressed_path = compress(day_job.file_name)
+                    os.remove(day_job.file_name)
+                    logging.getLogger("MainLogger").info(f"{day_job.file_name}: compressed {size / os.path.getsize(compressed_path):.1f}x into {compressed_path}")
+
+    if reporter is not None:
+        reporter.stop()
+    logging.getLogger("MainLogger").info(app.metrics.get_summary())
     logging.getLogger("MainLogger").info("Terminating...")
     app.done = True
 
@@ -0,0 +1,68 @@
+import logging
+import datetime as dt
+
+from IBApp import DayJob, IBFactory
+from IBLive import LiveSession
+from IBUtils import init_app_listener, get_output_file_name, is_weekly_options, Config
+from IBMetrics import MetricsReporter
+
+logging.getLogger("MainLogger")
+logging.basicConfig(format='%(message)s')
+logging.getLogger("MainLogger").setLevel(logging.INFO)
+
+
+def main(config: Config):
+    get_live_data(IBFactory.createIBapi(config), config)
+
+
+def get_live_data(app, config: Config):
+    """
+    Collect all the assets of the config live, from now until the end time of the day. Each asset is written to the
+    same file the historical flow writes that day to. Stopping the run with Ctrl+C leaves the days resumable.
+    :param app: the IBapi instance, not connected yet
+    :param config: config params
+    """
+    if config.output_type != "bin":
+        raise Exception("Live mode only writes bin output")
+    app.mode = "live"
+    today = dt.datetime.combine(dt.date.today(), dt.time())
+
+    reporter = MetricsReporter(app.metrics, config.metrics_file, config.metrics_interval) if config.metrics_file else None
+    if reporter is not None:
+        reporter.start()
+
+    with app.metrics.phase("connect"):
+        init_app_listener(app)
+
+    # chains are resolved one asset at a time, the sessions then run side by side
+    sessions = []
+    with app.metrics.phase("resolve"):
+        for asset in config.assets:
+            day_job = DayJob(asset, today, get_output_file_name(config, asset, today))
+            base_asset, is_weekly = is_weekly_options(asset)
+            if config.sec_type == 'OPT':
+                day_job.option_chain_data = app.get_option_chain(base_asset, today, is_weekly, config)
+            sessions.append(LiveSession(app, config, day_job))
+
+    with app.metrics.phase("live"):
+        for session in sessions:
+            session.start()
+        try:
+            for session in sessions:
+                session.join()
+        except KeyboardInterrupt:
+            logging.getLogger("MainLogger").info("Stopping the live sessions")
+            for session in sessions:
+                session.stop()
+            for session in sessions:
+                session.join()
+
+    if reporter is not None:
+        reporter.stop()
+    logging.getLogger("MainLogger").info(app.metrics.get_summary())
+    logging.getLogger("MainLogger").info("Terminating...")
+    app.done = True
+
+
+if __name__ == "__main__":
+    main(Config("config.ini"))
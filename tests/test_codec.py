@@ -0,0 +1,113 @@
+import datetime as dt
+
+import numpy as np
+import pytest
+
+from IBCodec import CompressedBarFile, compress, quantize, RAW_PRICES, PRICE_FIELDS
+from IBFormat import BarFile, write_header, finalize
+from IBWriter import OPT_BAR_DTYPE, BAR_DTYPE
+
+DATE = dt.datetime(2021, 1, 11)
+SESSION_START = np.datetime64('2021-01-11T09:30:00', 's')
+
+
+def make_rows(dtype: np.dtype, n: int, key: dict, prices: np.ndarray) -> np.ndarray:
+    rows = np.zeros(n, dtype=dtype)
+    rows['time'] = SESSION_START + np.arange(n) * np.timedelta64(5, 's')
+    for name, value in key.items():
+        rows[name] = value
+    rows['close'] = prices
+    rows['open'] = prices - np.float32(0.01)
+    rows['high'] = prices + np.float32(0.02)
+    rows['low'] = prices - np.float32(0.03)
+    return rows
+
+
+def write_bars_file(path, rows: np.ndarray, sec_type: str) -> str:
+    with open(path, 'wb') as f:
+        write_header(f, rows.dtype, sec_type, "SPY", DATE, DATE if sec_type == 'OPT' else None)
+        rows.tofile(f)
+    finalize(str(path))
+    return str(path)
+
+
+def on_grid(n: int, start: float, seed: int = 0) -> np.ndarray:
+    """
+    :return: a random walk of n prices on a grid of 0.01
+    """
+    return (np.round(start * 100 + np.random.default_rng(seed).integers(-3, 4, n).cumsum()) / 100).astype(np.float32)
+
+
+@pytest.fixture
+def opt_file(tmp_path):
+    rows = [make_rows(OPT_BAR_DTYPE, 500, {"strike": 380, "right": 1, "side": 1}, on_grid(500, 4.5)),
+            make_rows(OPT_BAR_DTYPE, 500, {"strike": 380, "right": 1, "side": 0}, on_grid(500, 4.4, seed=1)),
+            make_rows(OPT_BAR_DTYPE, 300, {"strike": 385.5, "right": 0, "side": 1}, on_grid(300, 7.25)),
+            # a contract with a single bar, a block of a single row
+            make_rows(OPT_BAR_DTYPE, 1, {"strike": 390, "right": 0, "side": 0}, on_grid(1, 9.1))]
+    return write_bars_file(tmp_path / "RawData-SPY-OPTION-2021-01-11.bin", np.concatenate(rows), 'OPT')
+
+
+def assert_same_rows(rows: np.ndarray, expected: np.ndarray):
+    # compared bit for bit, NaN prices included
+    assert rows.dtype == expected.dtype
+    assert np.ascontiguousarray(rows).tobytes() == np.ascontiguousarray(expected).tobytes()
+
+
+def assert_same_file(path: str, compressed_path: str):
+    bars_file, compressed = BarFile(path), CompressedBarFile(compressed_path)
+    assert compressed.dtype == bars_file.dtype
+    assert compressed.index_fields == bars_file.index_fields
+    assert_same_rows(compressed.read_all(), np.asarray(bars_file.data))
+    assert_same_rows(compressed.get_contracts(), np.asarray(bars_file.get_contracts()))
+    for entry in bars_file.get_contracts():
+        key = {name: entry[name] for name in bars_file.index_fields}
+        assert_same_rows(compressed.get_bars(**key), bars_file.get_bars(**key))
+
+
+def test_round_trip(opt_file):
+    assert_same_file(opt_file, compress(opt_file))
+
+
+def test_time_window(opt_file):
+    compressed = CompressedBarFile(compress(opt_file))
+    start_time, end_time = dt.datetime(2021, 1, 11, 9, 31), dt.datetime(2021, 1, 11, 9, 35)
+    bars = compressed.get_bars(380, 'C', 'ASK', start_time, end_time)
+    assert len(bars) == 48
+    assert_same_rows(bars, BarFile(opt_file).get_bars(380, 'C', 'ASK', start_time, end_time))
+
+
+def test_single_row_blocks(opt_file, tmp_path):
+    assert_same_file(opt_file, compress(opt_file, str(tmp_path / "single.ibz"), block_rows=1))
+
+
+def test_several_blocks_per_contract(opt_file, tmp_path):
+    compressed_path = compress(opt_file, str(tmp_path / "blocks.ibz"), block_rows=64)
+    assert len(CompressedBarFile(compressed_path).index) > len(BarFile(opt_file).get_contracts())
+    assert_same_file(opt_file, compressed_path)
+
+
+def test_raw_prices_fallback(tmp_path):
+    # prices that need more than MAX_DECIMALS decimals are stored as raw float32
+    prices = (1 + np.random.default_rng(0).random(200)).astype(np.float32) / np.float32(10000)
+    rows = make_rows(BAR_DTYPE, 200, {"side": 1}, prices)
+    assert quantize(np.stack([rows[name] for name in PRICE_FIELDS]))[0] == RAW_PRICES
+    path = write_bars_file(tmp_path / "RawData-SPY-2021-01-11.bin", rows, 'STK')
+    assert_same_file(path, compress(path))
+
+
+def test_raw_prices_fallback_single_row(tmp_path):
+    # NaN prices are never on a grid
+    rows = make_rows(BAR_DTYPE, 1, {"side": 0}, np.array([np.nan], dtype=np.float32))
+    assert quantize(np.stack([rows[name] for name in PRICE_FIELDS]))[0] == RAW_PRICES
+    path = write_bars_file(tmp_path / "RawData-SPY-2021-01-11.bin", rows, 'STK')
+    assert_same_file(path, compress(path))
+
+
+def test_not_finalized(tmp_path):
+    path = tmp_path / "RawData-SPY-2021-01-11.bin"
+    with open(path, 'wb') as f:
+        write_header(f, BAR_DTYPE, 'STK', "SPY", DATE)
+        make_rows(BAR_DTYPE, 10, {"side": 1}, on_grid(10, 380)).tofile(f)
+    with pytest.raises(Exception):
+        compress(str(path))
@@ -0,0 +1,77 @@
+import os
+import datetime as dt
+
+import pytest
+
+from IBApp import DataRequest, DayJob, IBFactory
+from IBJournal import is_day_complete
+from IBRequests import TrackedRequest
+from IBUtils import Config, get_output_file_name
+from getHistoricalData import get_day_jobs
+
+CONFIG = """[General]
+output_type = bin
+output_dir = {output_dir}
+sec_type = STK
+assets = SPY
+start_date = 20210111
+
+[Optional]
+max_attempts = 1
+metrics_file = 
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.ini"
+    path.write_text(CONFIG.format(output_dir=tmp_path / "output"))
+    return Config(str(path))
+
+
+def collect_day(app, config: Config, error_code: int = None) -> DayJob:
+    """
+    Run a day of a single request, answered by an error or by its end
+    """
+    day_job = DayJob(config.assets[0], config.dates[0], get_output_file_name(config, config.assets[0], config.dates[0]))
+    app.start_day(day_job)
+    data_request = DataRequest(app.get_wanted_contracts(day_job)[0], day_job.date + dt.timedelta(hours=16), 390, 'ASK', day_job)
+    data_request.req_id = 1000
+    day_job.request_sent()
+    app.requests.sent(data_request.req_id, TrackedRequest(data_request))
+    if error_code is None:
+        app.historicalDataEnd(data_request.req_id, "", "")
+    else:
+        app.error(data_request.req_id, error_code, "No security definition has been found for the request")
+    app.end_day(day_job)
+    assert day_job.done.wait(10)
+    return day_job
+
+
+def test_given_up_day_is_collected_again(config):
+    app = IBFactory.createIBapi(config)
+    day_job = collect_day(app, config, error_code=200)
+    assert day_job.failed == 1
+    assert not is_day_complete(day_job.journal_path)
+    day_jobs = get_day_jobs(config)
+    assert [(job.asset, job.date) for job in day_jobs] == [(day_job.asset, day_job.date)]
+    assert day_jobs[0].is_resumed
+
+
+def test_complete_day_is_skipped(config):
+    app = IBFactory.createIBapi(config)
+    day_job = collect_day(app, config)
+    assert not day_job.failed
+    assert is_day_complete(day_job.journal_path)
+    assert get_day_jobs(config) == []
+
+
+def test_failed_refetch_revokes_complete_day(config):
+    app = IBFactory.createIBapi(config)
+    collect_day(app, config)
+    # a later request of the same day, like the ones that fill its gaps, is given up on
+    refetch_job = collect_day(app, config, error_code=200)
+    assert refetch_job.failed == 1
+    assert not is_day_complete(refetch_job.journal_path)
+    assert os.path.exists(refetch_job.file_name)
+    assert len(get_day_jobs(config)) == 1